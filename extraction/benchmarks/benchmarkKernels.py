@@ -0,0 +1,267 @@
+# benchmarkKernels - throughput and memory of the extraction kernels on
+# synthetic data (see syntheticData.py), without database or /eodata:
+#
+#   python -m benchmarks.benchmarkKernels
+#   python -m benchmarks.benchmarkKernels --cold --save baseline.json
+#   python -m benchmarks.benchmarkKernels --baseline baseline.json
+#
+# from the extraction directory. Every case runs in its own process on the
+# same seeded data. The first call, which compiles the kernel or loads it
+# from the numba cache (--cold compiles into an empty cache), is timed
+# separately from the steady state, the best of --repeat calls. Peak memory
+# is the growth of the resident set of the case process over its set up.
+# With --baseline, the run fails if a case is more than --tolerance slower
+# in parcels per second than in the baseline.
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks import syntheticData
+from utils import imageTimings
+
+BATCH = 10000
+
+
+def residentMB():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+
+def batched(rows, size=BATCH):
+    return [rows[a:a + size] for a in range(0, len(rows), size)]
+
+
+def caseSetup(case, args):
+    # Inputs of a case on the synthetic data. Returns the call to time, the
+    # number of parcels and the number of parcel pixels it processes
+    from utils import indexedNumbaWindowedRasterStats as inw
+    from utils import indexedNumbaHistogram as inh
+    from utils import multiProductExtraction as mpe
+    from utils import parcelIndex, parcelStore, readPlan, wkbReader
+
+    dims = (args.bands, args.rows, args.cols)
+    ulx, uly, dx = 600000.0, 5800000.0, 10.0
+    parcels = syntheticData.parcelMasks(args.parcels, dims, args.median,
+                                        args.sigma)
+    rows = syntheticData.parcelRowset(parcels, ulx, uly, dx)
+    rowsets = batched(rows)
+    npixels = int(sum(m.sum() for _, _, m in parcels))
+    nparcels = len(parcels)
+
+    if case == 'wkbImage':
+        def run():
+            for pid, raw in rows:
+                wkbReader.wkbImage(raw)
+        return run, nparcels, npixels
+    if case == 'wkbBatch':
+        def run():
+            for rowset in rowsets:
+                wkbReader.wkbBatch(rowset)
+        return run, nparcels, npixels
+
+    # Decoded masks and the CSR index of the window
+    masks = [wkbReader.wkbImage(raw) for pid, raw in rows]
+    builder = parcelIndex.IndexBuilder(dims)
+    for rowset in rowsets:
+        builder.append(*inw.indexRowset(rowset, ulx, uly, dx, dims))
+    pids, offsets, pixels = builder.index()
+
+    if case == 'getIndices':
+        def run():
+            for pulx, puly, img in masks:
+                inw.getIndices(pulx, puly, img[0], ulx, uly, dx, dims)
+        return run, nparcels, npixels
+    if case == 'truncate':
+        # All mask pixels in window coordinates, a tenth of them outside
+        r = (pixels // dims[2]).astype(np.int64)
+        c = (pixels % dims[2]).astype(np.int64)
+        shift = dims[1] // 10
+        def run():
+            inw.truncate(r + shift, c, 0, dims[1] - 1, 0, dims[2] - 1)
+        return run, nparcels, npixels
+    if case == 'getBatchIndices':
+        batches = [wkbReader.wkbBatch(rowset) for rowset in rowsets]
+        def run():
+            for _, ipx, ipy, widths, heights, moffsets, bmasks in batches:
+                inw.getBatchIndices(ipx, ipy, widths, heights, moffsets,
+                                    bmasks, ulx, uly, dx, dims[1], dims[2])
+        return run, nparcels, npixels
+    if case == 'getStoreIndices':
+        store, grid = parcelStore.buildStore(rowsets, dx, 10000)
+        store['grid'] = grid
+        def run():
+            for batch in parcelStore.storeBatches(store, ulx, uly, dx, dims,
+                                                  BATCH):
+                pass
+        return run, nparcels, npixels
+
+    data = syntheticData.window(*dims, args.dtype)
+    flat = data.reshape(dims[0], dims[1] * dims[2])
+    batches = list(parcelIndex.batches((pids, offsets, pixels), BATCH))
+
+    if case == 'getStats':
+        # The per parcel loop of indexedNumbaRasterStats
+        def run():
+            for i in range(len(pids)):
+                p = pixels[offsets[i]:offsets[i + 1]]
+                for b in range(dims[0]):
+                    inw.getStats(flat[b][p], 0.0)
+        return run, nparcels, npixels * dims[0]
+    if case == 'getBatchStats':
+        def run():
+            for bpids, boffsets, bpixels in batches:
+                inw.getBatchStats(flat, boffsets, bpixels, 0.0)
+        return run, nparcels, npixels * dims[0]
+    if case == 'getBatchMeans':
+        def run():
+            for bpids, boffsets, bpixels in batches:
+                inw.getBatchMeans(flat, boffsets, bpixels, 0.0)
+        return run, nparcels, npixels
+    if case == 'getLabelStats':
+        def run():
+            labels = inw.getLabelImage(offsets, pixels, dims[1] * dims[2])
+            inw.getLabelStats(flat, labels, len(pids), 0.0)
+        return run, nparcels, npixels * dims[0]
+    if case == 'getCoarseIndex':
+        window20 = mpe.coarseWindow((0, 0, dims[2], dims[1], ulx, uly), 2,
+                                    dims[2] // 2, dims[1] // 2)
+        def run():
+            mpe.getCoarseIndex(offsets, pixels, 0, 0, dims[2], 2, *window20,
+                               mpe.MIN_SUBPIXELS)
+        return run, nparcels, npixels
+    if case == 'sparsePlan':
+        def run():
+            readPlan.sparsePlan((pids, offsets, pixels), dims,
+                                (0, 0, dims[2], dims[1]), 1024)
+        return run, nparcels, npixels
+    if case == 'batchLoop':
+        # Decode, index and statistics per fetched batch, as indexRasterStats
+        # does when streaming from the database
+        def run():
+            for rowset in rowsets:
+                bpids, boffsets, bpixels = inw.indexRowset(rowset, ulx, uly,
+                                                          dx, dims)
+                inw.getBatchStats(flat, boffsets, bpixels, 0.0)
+        return run, nparcels, npixels * dims[0]
+
+    scl = syntheticData.window(1, dims[1], dims[2], 'uint8')[0].reshape(-1)
+    if case == 'unique':
+        # The per parcel np.unique the histogram extraction used before
+        # getClassCounts, as a reference
+        def run():
+            for i in range(len(pids)):
+                np.unique(scl[pixels[offsets[i]:offsets[i + 1]]],
+                          return_counts=True)
+        return run, nparcels, npixels
+    if case == 'getClassCounts':
+        counts = np.zeros((BATCH, inh.SCL_CLASSES), dtype=np.int64)
+        def run():
+            for bpids, boffsets, bpixels in batches:
+                inh.getClassCounts(scl, boffsets, bpixels, counts)
+        return run, nparcels, npixels
+    raise ValueError(f"Unknown case {case}")
+
+
+CASES = ['wkbImage', 'wkbBatch', 'getIndices', 'truncate', 'getBatchIndices',
+         'getStoreIndices', 'getStats', 'getBatchStats', 'getBatchMeans',
+         'getLabelStats', 'getCoarseIndex', 'sparsePlan', 'unique',
+         'getClassCounts', 'batchLoop']
+
+
+def runCase(job):
+    # Run one case in a pool process, returns its measurements
+    case, args = job
+    run, nparcels, npixels = caseSetup(case, args)
+
+    imageTimings.resetPeak()
+    base = residentMB()
+    t0 = time.perf_counter()
+    run()
+    first = time.perf_counter() - t0
+
+    steady = []
+    for r in range(args.repeat):
+        t0 = time.perf_counter()
+        run()
+        steady.append(time.perf_counter() - t0)
+    best = min(steady)
+
+    return {'case': case, 'first_s': first, 'steady_s': best,
+            'parcels_per_s': nparcels / best, 'pixels_per_s': npixels / best,
+            'peak_mb': max(0.0, imageTimings.peakMB() - base)}
+
+
+def compare(results, baseline, tolerance):
+    # Cases slower than the baseline by more than tolerance
+    before = {r['case']: r for r in baseline}
+    slower = []
+    for r in results:
+        if r['case'] in before and r['parcels_per_s'] < \
+                (1 - tolerance) * before[r['case']]['parcels_per_s']:
+            slower.append((r['case'], r['parcels_per_s'] /
+                           before[r['case']]['parcels_per_s']))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Extraction kernel benchmarks on synthetic data')
+    parser.add_argument('cases', nargs='*', default=CASES)
+    parser.add_argument('--rows', type=int, default=5490)
+    parser.add_argument('--cols', type=int, default=5490)
+    parser.add_argument('--bands', type=int, default=4)
+    parser.add_argument('--dtype', default='uint16',
+                        choices=list(syntheticData.BAND_RANGES))
+    parser.add_argument('--parcels', type=int, default=50000)
+    parser.add_argument('--median', type=float, default=400,
+                        help='median parcel area in pixels')
+    parser.add_argument('--sigma', type=float, default=1.0,
+                        help='log-normal sigma of the parcel areas')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cold', action='store_true',
+                        help='compile into an empty numba cache')
+    parser.add_argument('--save')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.cold:
+        # Inherited by the spawned case processes before numba is imported
+        os.environ['NUMBA_CACHE_DIR'] = tempfile.mkdtemp(prefix='numba')
+
+    print(f"{args.parcels} parcels (median {args.median} pixels) in a",
+          f"{args.bands} x {args.rows} x {args.cols} {args.dtype} window")
+    print(f"{'case':<16} {'first s':>9} {'steady s':>9} {'parcels/s':>11}",
+          f"{'Mpixels/s':>10} {'peak MB':>8}")
+
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    for case in args.cases:
+        # A fresh process per case, so that peak memory is its own
+        with ctx.Pool(1) as pool:
+            r = pool.apply(runCase, ((case, args),))
+        results.append(r)
+        print(f"{r['case']:<16} {r['first_s']:>9.3f} {r['steady_s']:>9.3f}",
+              f"{r['parcels_per_s']:>11.0f} {r['pixels_per_s'] / 1e6:>10.1f}",
+              f"{r['peak_mb']:>8.1f}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f)['results'], args.tolerance)
+        for case, ratio in slower:
+            print(f"{case} at {100 * ratio:.0f}% of the baseline")
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
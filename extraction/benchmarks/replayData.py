@@ -0,0 +1,173 @@
+# replayData - synthetic /eodata tree and database for the replay harness
+#
+# All images of a replay are on one grid (ORIGIN, EPSG) and cover the same
+# area: S2 L2A JP2 bands (10 m and 20 m), CARD-BS ENVI .img/.hdr Gamma0
+# bands (10 m) or CARD-COH6 GeoTIFFs (20 m), under the paths
+# buildVRTfromMount expects. The database gets the catalogue, one AOI over
+# the image area, the parcel vector table and its parcel raster tables at 10
+# and 20 m, and empty result tables.
+import os
+from datetime import datetime, timedelta
+
+import psycopg2.extras
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.warp import transform_bounds
+
+from benchmarks import syntheticData
+
+EPSG = 32632
+ORIGIN = (600000.0, 5800000.0)
+TILE = 'T32UNG'
+
+S2_BANDS = {'B02': 10, 'B03': 10, 'B04': 10, 'B08': 10, 'B05': 20,
+            'B06': 20, 'B07': 20, 'B8A': 20, 'B11': 20, 'B12': 20,
+            'SCL': 20}
+
+# The res argument of the docker-compose commands of a card
+CARD_RES = {'bs': 10, 'c6': 20, 's2': 0}
+
+TABLES_SQL = f"""
+CREATE EXTENSION IF NOT EXISTS postgis;
+CREATE EXTENSION IF NOT EXISTS postgis_raster;
+DROP TABLE IF EXISTS public.dias_catalogue, public.aois, public.parcels,
+    public.parcels_{EPSG}_10_rast, public.parcels_{EPSG}_20_rast,
+    public.sigs, public.hists, public.hists_scl;
+CREATE TABLE public.dias_catalogue (id serial PRIMARY KEY, reference text,
+    obstime timestamp, status text, card text,
+    footprint geometry(Polygon, 4326));
+CREATE TABLE public.aois (ogc_fid serial PRIMARY KEY, name text,
+    wkb_geometry geometry(Polygon, 4326));
+CREATE TABLE public.parcels (ogc_fid integer PRIMARY KEY,
+    wkb_geometry geometry(Polygon, {EPSG}));
+CREATE INDEX ON public.parcels USING gist (wkb_geometry);
+CREATE TABLE public.parcels_{EPSG}_10_rast (pid integer PRIMARY KEY,
+    rast raster);
+CREATE TABLE public.parcels_{EPSG}_20_rast (pid integer PRIMARY KEY,
+    rast raster);
+CREATE TABLE public.sigs (pid integer, band text, count integer, mean real,
+    std real, min real, max real, p25 real, p50 real, p75 real,
+    obsid integer);
+CREATE TABLE public.hists (pid integer, obsid integer, hist json);
+CREATE TABLE public.hists_scl (pid integer, obsid integer,
+    counts integer[]);
+"""
+
+
+def tableConfig():
+    # The tables section of db_config.json for the replay database
+    return {'aoi_table': 'public.aois', 'parcel_table': 'public.parcels',
+            'catalog_table': 'public.dias_catalogue',
+            'sigs_table': 'public.sigs', 'hists_table': 'public.hists',
+            'hists_array_table': 'public.hists_scl'}
+
+
+def reference(card, obstime):
+    # Product names in the formats the extraction splits
+    tstamp = obstime.strftime('%Y%m%dT%H%M%S')
+    if card == 's2':
+        return f"S2A_MSIL2A_{tstamp}_N0300_R108_{TILE}_{tstamp}"
+    if card == 'bs':
+        return f"S1A_IW_GRDH_1SDV_{tstamp}_{tstamp}_038000_047000_0000_CARD_BS"
+    return f"S1A_IW_SLC__1SDV_{tstamp}_{tstamp}_038000_047000_0000_CARD_COH6"
+
+
+def makeDirs(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+
+def writeRaster(path, data, driver, dx):
+    with rasterio.open(path, 'w', driver=driver, height=data.shape[1],
+                       width=data.shape[2], count=data.shape[0],
+                       dtype=data.dtype.name, crs=f"EPSG:{EPSG}", nodata=0,
+                       transform=from_origin(*ORIGIN, dx, dx)) as dst:
+        dst.write(data)
+
+
+def writeImage(root, card, ref, obstime, size, seed):
+    # The files of one image under root, size is the width and height in
+    # 10 m pixels
+    day = obstime.strftime('%Y/%m/%d')
+    if card == 's2':
+        tstamp = obstime.strftime('%Y%m%dT%H%M%S')
+        granule = f"{root}/Sentinel-2/MSI/L2A/{day}/{ref}/GRANULE/L2A_{TILE}_A000000_{tstamp}/IMG_DATA"
+        for i, (b, dx) in enumerate(S2_BANDS.items()):
+            n = size * 10 // dx
+            data = syntheticData.window(1, n, n, 'uint8' if b == 'SCL' else 'uint16', seed + i)
+            path = f"{granule}/R{dx}m/{TILE}_{tstamp}_{b}_{dx}m.jp2"
+            makeDirs(path)
+            writeRaster(path, data, 'JP2OpenJPEG', dx)
+    elif card == 'bs':
+        for i, b in enumerate(['VV', 'VH']):
+            # The ENVI driver writes the .hdr next to the .img
+            path = f"{root}/Sentinel-1/SAR/CARD-BS/{day}/{ref}/{ref}.data/Gamma0_{b}.img"
+            makeDirs(path)
+            writeRaster(path, syntheticData.window(1, size, size, 'float32', seed + i), 'ENVI', 10)
+    else:
+        path = f"{root}/Sentinel-1/SAR/CARD-COH6/{day}/{ref}/{ref}.tif"
+        makeDirs(path)
+        writeRaster(path, syntheticData.window(2, size // 2, size // 2, 'float32', seed), 'GTiff', 20)
+
+
+def buildTree(root, card, nimages, size, start=datetime(2021, 4, 1), seed=0):
+    # nimages images of card, one every 5 days from start. Returns their
+    # (reference, obstime)
+    images = []
+    for i in range(nimages):
+        obstime = start + timedelta(days=5 * i, hours=10, minutes=30)
+        ref = reference(card, obstime)
+        writeImage(root, card, ref, obstime, size, seed + 100 * i)
+        images.append((ref, obstime))
+        print(f"{ref} written")
+    return images
+
+
+def imageExtent(size):
+    # Upper left and lower right of the image area
+    return ORIGIN[0], ORIGIN[1], ORIGIN[0] + size * 10, ORIGIN[1] - size * 10
+
+
+def footprint(size):
+    # The image area as EWKT in EPSG:4326, the bounding box of its corners
+    ulx, uly, lrx, lry = imageExtent(size)
+    w, s, e, n = transform_bounds(f"EPSG:{EPSG}", "EPSG:4326", ulx, lry, lrx,
+                                  uly)
+    return f"SRID=4326;POLYGON(({w} {s},{e} {s},{e} {n},{w} {n},{w} {s}))"
+
+
+def seedDatabase(conn, card, images, size, parcels, aoi):
+    # Tables for a replay of images (from buildTree) with the parcels of
+    # syntheticData.parcelMasks on the 10 m grid
+    with conn.cursor() as curs:
+        curs.execute(TABLES_SQL)
+        curs.execute("INSERT INTO public.aois (name, wkb_geometry) VALUES (%s, %s)",
+                     (aoi, footprint(size)))
+        psycopg2.extras.execute_values(
+            curs, """INSERT INTO public.dias_catalogue
+            (reference, obstime, status, card, footprint) VALUES %s""",
+            [(ref, obstime, 'ingested', card, footprint(size))
+             for ref, obstime in images])
+
+        ulx, uly = ORIGIN
+        psycopg2.extras.execute_values(
+            curs, "INSERT INTO public.parcels VALUES %s",
+            [(pid + 1, ulx + col0 * 10, uly - (row0 + mask.shape[0]) * 10,
+              ulx + (col0 + mask.shape[1]) * 10, uly - row0 * 10)
+             for pid, (row0, col0, mask) in enumerate(parcels)],
+            template=f"(%s, ST_MakeEnvelope(%s, %s, %s, %s, {EPSG}))",
+            page_size=10000)
+        for dx, grid in [(10, parcels), (20, syntheticData.coarseParcels(parcels, 2))]:
+            psycopg2.extras.execute_values(
+                curs, f"INSERT INTO public.parcels_{EPSG}_{dx}_rast VALUES %s",
+                syntheticData.parcelRowset(grid, ulx, uly, dx),
+                template="(%s, ST_RastFromWKB(%s))", page_size=10000)
+        curs.execute("ANALYZE")
+    conn.commit()
+    print(f"{len(images)} images, {len(parcels)} parcels seeded")
+
+
+def imageDates(images):
+    # startdate and enddate of the args section covering images
+    obstimes = [obstime for ref, obstime in images]
+    return (min(obstimes) - timedelta(days=1)).strftime('%Y-%m-%d'), \
+        (max(obstimes) + timedelta(days=1)).strftime('%Y-%m-%d')
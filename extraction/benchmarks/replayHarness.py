@@ -0,0 +1,337 @@
+# replayHarness - replay the extraction of a synthetic stack end to end, from
+# the claim of an image to its final status, with concurrent workers:
+#
+#   python -m benchmarks.replayHarness s2 --images 20 --workers 4
+#   python -m benchmarks.replayHarness bs --dsn "host=localhost dbname=scratch user=postgres password=..."
+#
+# from the extraction directory. It writes a synthetic /eodata tree and seeds
+# a throwaway PostGIS database (see replayData.py): a postgis/postgis
+# container started with python_on_whales, or the scratch database of
+# --dsn, whose replay tables are dropped and created again. The workers run
+# factoredWindowedExtraction.py <card> <res> worker (or pipeline) in a run
+# directory with a db_config.json for that database and eodata_dir set to
+# the synthetic tree, so the full path from claimImages to updateImageStatus
+# is exercised. Status changes are followed with the notifications of
+# utils/stackMonitor. The report gives images per hour, the queue wait and
+# latency (claim to final status) of the images, the time per stage from the
+# timings the workers record (utils/imageTimings), and the rows, table sizes
+# and WAL bytes written to the database.
+import argparse
+import json
+import os
+import select
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import psycopg2
+import psycopg2.extensions
+
+from benchmarks import replayData, syntheticData
+from utils import dbSession, imageTimings, stackMonitor
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULT_TABLES = ['public.sigs', 'public.hists', 'public.hists_scl']
+
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+
+def startDatabase(image):
+    # A throwaway PostGIS container, removed when stopped. Returns the
+    # container and its connection settings
+    from python_on_whales import docker
+
+    port = freePort()
+    container = docker.run(image, detach=True, remove=True,
+                           name=f"replay_{os.getpid()}",
+                           publish=[(port, 5432)],
+                           envs={'POSTGRES_PASSWORD': 'replay'})
+    print(f"PostGIS container {container.name} on port {port}")
+    return container, {'host': 'localhost', 'dbname': 'postgres',
+                       'dbuser': 'postgres', 'port': port,
+                       'dbpasswd': 'replay'}
+
+
+def dsnConnection(dsn):
+    # Connection settings of db_config.json from a libpq dsn
+    params = psycopg2.extensions.parse_dsn(dsn)
+    return {'host': params.get('host', 'localhost'),
+            'dbname': params.get('dbname', 'postgres'),
+            'dbuser': params.get('user', 'postgres'),
+            'port': params.get('port', 5432),
+            'dbpasswd': params.get('password', '')}
+
+
+def connectWhenReady(connection, timeout=120):
+    # The container takes a while to accept connections
+    t0 = time.time()
+    while True:
+        try:
+            return psycopg2.connect(dbSession.connectionString(
+                {'connection': connection}))
+        except psycopg2.OperationalError:
+            if time.time() - t0 > timeout:
+                raise
+            time.sleep(1)
+
+
+def settingValue(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def writeConfig(workdir, connection, dates, eodata, settings):
+    # db_config.json of the run directory. The extraction section has the
+    # defaults of the repository, with the index cache on for the S2 tiles
+    # and without band cache, changed by --set
+    extraction = {'index_cache': 'cache', 'engine': 'parcel',
+                  'hists_format': 'json', 'flush_size': 100000,
+                  'read_budget_mb': 0, 'read_threads': 4,
+                  'prefetch_depth': 1, 'db_pool_size': 1, 'claim_batch': 1,
+                  'timings_file': 'timings.jsonl', 'eodata_dir': eodata}
+    for s in settings:
+        key, value = s.split('=', 1)
+        extraction[key] = settingValue(value)
+    config = {'database': {'connection': connection,
+                           'tables': replayData.tableConfig(),
+                           'args': {'aoi_field': 'name', 'name': 'replay',
+                                    'startdate': dates[0],
+                                    'enddate': dates[1]}},
+              'extraction': extraction}
+    with open(os.path.join(workdir, 'db_config.json'), 'w') as f:
+        json.dump(config, f, indent=4)
+    return config
+
+
+def writeVolume(conn):
+    # Rows inserted in and size of the result tables, and the WAL position
+    with conn.cursor() as curs:
+        # Statistics of this transaction are a snapshot, start afresh
+        curs.execute("SELECT pg_stat_clear_snapshot()")
+        curs.execute("SELECT pg_current_wal_lsn()")
+        volume = {'wal_lsn': curs.fetchone()[0]}
+        for t in RESULT_TABLES:
+            curs.execute("""SELECT n_tup_ins, pg_total_relation_size(relid)
+                FROM pg_stat_user_tables WHERE relid = %s::regclass""", (t,))
+            volume[t] = curs.fetchone()
+    conn.commit()
+    return volume
+
+
+def walBytes(conn, before, after):
+    with conn.cursor() as curs:
+        curs.execute("SELECT pg_wal_lsn_diff(%s, %s)",
+                     (after['wal_lsn'], before['wal_lsn']))
+        wal = int(curs.fetchone()[0])
+    conn.commit()
+    return wal
+
+
+def runWorkers(workdir, card, res, mode, nworkers, listen, timeout):
+    # Run the workers until they are done, recording the status change
+    # notifications as (seconds from start, change)
+    events = []
+    logs = [open(os.path.join(workdir, f"worker_{i}.log"), 'w')
+            for i in range(nworkers)]
+    t0 = time.time()
+    workers = [subprocess.Popen(
+        [sys.executable, os.path.join(CODE_DIR, 'factoredWindowedExtraction.py'),
+         card, str(res), mode], cwd=workdir, stdout=log,
+        stderr=subprocess.STDOUT) for log in logs]
+
+    stopped = False
+    while True:
+        running = [w for w in workers if w.poll() is None]
+        if select.select([listen], [], [], 1)[0]:
+            listen.poll()
+        for n in listen.notifies:
+            events.append((time.time() - t0, json.loads(n.payload)))
+        listen.notifies.clear()
+        if not running:
+            break
+        if timeout and not stopped and time.time() - t0 > timeout:
+            print(f"Timeout after {timeout} s, stopping the workers")
+            for w in running:
+                w.terminate()
+            stopped = True
+
+    for log in logs:
+        log.close()
+    return events, time.time() - t0, [w.returncode for w in workers]
+
+
+def imageTimes(events):
+    # Per image the claim time and the final status change
+    claimed = {}
+    finished = {}
+    for t, change in events:
+        if change['new'] == 'inprogress':
+            claimed.setdefault(change['id'], t)
+        elif change['old'] == 'inprogress' and change['new'] != 'ingested':
+            finished[change['id']] = (t, change['new'])
+    return claimed, finished
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    return {'p50': float(np.percentile(values, 50)),
+            'p90': float(np.percentile(values, 90)),
+            'max': float(np.max(values))}
+
+
+def stageTimes(path):
+    # Seconds per stage over the images of the timings file, with the
+    # share of each stage in the total time of all images
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    total = sum(r['total_s'] for r in records)
+    stages = {}
+    for stage in imageTimings.STAGES + ['other']:
+        seconds = [r['stages'].get(stage, 0.0) for r in records]
+        if any(seconds):
+            stages[stage] = dict(percentiles(seconds),
+                                 share=sum(seconds) / total if total else 0.0)
+    return stages
+
+
+def report(args, events, wall, before, after, wal, stages):
+    claimed, finished = imageTimes(events)
+    statuses = {}
+    for t, status in finished.values():
+        statuses[status] = statuses.get(status, 0) + 1
+    last = max([t for t, status in finished.values()], default=wall)
+    latency = [finished[i][0] - claimed[i] for i in finished if i in claimed]
+    waits = [claimed[i] for i in finished if i in claimed]
+
+    result = {'card': args.card, 'res': args.res, 'mode': args.mode,
+              'workers': args.workers, 'images': args.images,
+              'size': args.size, 'parcels': args.parcels,
+              'settings': args.set, 'wall_s': wall, 'statuses': statuses,
+              'images_per_hour': 3600 * len(finished) / last if last else 0.0,
+              'latency_s': percentiles(latency), 'wait_s': percentiles(waits),
+              'stages_s': stages, 'wal_bytes': wal, 'tables': {}}
+    for t in RESULT_TABLES:
+        rows = after[t][0] - before[t][0]
+        result['tables'][t] = {'rows': rows,
+                               'bytes': after[t][1] - before[t][1]}
+
+    print(f"{len(finished)} of {args.images} images finished in {wall:.1f} s",
+          f"by {args.workers} workers ({args.mode}):",
+          ", ".join(f"{n} {s}" for s, n in sorted(statuses.items())))
+    print(f"{result['images_per_hour']:.1f} images per hour")
+    for name, p in [('latency (claim to final status)', result['latency_s']),
+                    ('queue wait (start to claim)', result['wait_s'])]:
+        if p:
+            print(f"{name}: p50 {p['p50']:.1f} s, p90 {p['p90']:.1f} s,",
+                  f"max {p['max']:.1f} s")
+    if stages:
+        print(f"{'stage':<8} {'p50 s':>8} {'p90 s':>8} {'max s':>8} {'share':>6}")
+        for stage, p in stages.items():
+            print(f"{stage:<8} {p['p50']:>8.2f} {p['p90']:>8.2f}",
+                  f"{p['max']:>8.2f} {100 * p['share']:>5.1f}%")
+    print(f"{wal / 2**20:.1f} MB WAL written",
+          f"({wal / 2**10 / max(1, len(finished)):.0f} kB per image)")
+    for t, v in result['tables'].items():
+        if v['rows']:
+            print(f"{t}: {v['rows']} rows, {v['bytes'] / 2**20:.1f} MB")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='End to end extraction replay on synthetic data')
+    parser.add_argument('card', choices=['s2', 'bs', 'c6'])
+    parser.add_argument('--res', type=int,
+                        help='res argument of the workers, as in the docker-compose files')
+    parser.add_argument('--mode', default='worker',
+                        choices=['worker', 'pipeline'])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--images', type=int, default=12)
+    parser.add_argument('--size', type=int, default=2000,
+                        help='image width and height in 10 m pixels')
+    parser.add_argument('--parcels', type=int, default=20000)
+    parser.add_argument('--median', type=float, default=150,
+                        help='median parcel area in 10 m pixels')
+    parser.add_argument('--set', action='append', default=[],
+                        help='extraction setting of db_config.json, key=value')
+    parser.add_argument('--dsn', help='scratch database instead of a container')
+    parser.add_argument('--image', default='postgis/postgis:15-3.4')
+    parser.add_argument('--workdir')
+    parser.add_argument('--timeout', type=float)
+    parser.add_argument('--no-warmup', action='store_true')
+    parser.add_argument('--save')
+    args = parser.parse_args()
+    if args.res is None:
+        args.res = replayData.CARD_RES[args.card]
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='replay'))
+    os.makedirs(os.path.join(workdir, 'data'), exist_ok=True)
+    eodata = os.path.join(workdir, 'eodata')
+    print(f"Replay in {workdir}")
+
+    images = replayData.buildTree(eodata, args.card, args.images, args.size)
+    parcels = syntheticData.parcelMasks(args.parcels, (1, args.size, args.size),
+                                        args.median)
+
+    container = None
+    if args.dsn:
+        connection = dsnConnection(args.dsn)
+    else:
+        container, connection = startDatabase(args.image)
+    try:
+        conn = connectWhenReady(connection)
+        replayData.seedDatabase(conn, args.card, images, args.size, parcels,
+                                'replay')
+        stackMonitor.installTrigger(conn, 'public.dias_catalogue')
+        config = writeConfig(workdir, connection,
+                             replayData.imageDates(images), eodata, args.set)
+        timings = os.path.join(workdir,
+                               config['extraction'].get('timings_file') or '')
+        if os.path.isfile(timings):
+            os.remove(timings)
+
+        if not args.no_warmup:
+            subprocess.run([sys.executable,
+                            os.path.join(CODE_DIR, 'warmupKernels.py')],
+                           cwd=workdir, check=True)
+
+        listen = connectWhenReady(connection)
+        listen.autocommit = True
+        with listen.cursor() as curs:
+            curs.execute(f"LISTEN {stackMonitor.CHANNEL}")
+
+        before = writeVolume(conn)
+        events, wall, codes = runWorkers(workdir, args.card, args.res,
+                                         args.mode, args.workers, listen,
+                                         args.timeout)
+        after = writeVolume(conn)
+        if any(codes):
+            print(f"Worker exit codes {codes}, see {workdir}/worker_*.log")
+        result = report(args, events, wall, before, after,
+                        walBytes(conn, before, after),
+                        stageTimes(timings))
+        listen.close()
+        conn.close()
+    finally:
+        if container is not None:
+            container.stop()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# syntheticData - synthetic image windows and parcel rasters, so that the
+# extraction can be measured without database or /eodata
+#
+# Parcels are ellipses with a log-normal area distribution and a random
+# aspect ratio, scattered over the window. Their rasters are encoded as
+# PostGIS raster WKB (as st_asbinary(rast) returns them for the parcel raster
+# tables), with one 8BUI band that is 1 inside the parcel and 0 outside.
+import struct
+
+import numpy as np
+
+# Value ranges of the band types, 0 is nodata
+BAND_RANGES = {'uint8': (1, 12), 'uint16': (1, 10000), 'float32': (0.001, 1.0)}
+
+
+def window(bands, rows, cols, dtype='uint16', seed=0):
+    # A (bands, rows, cols) window without nodata, SCL classes for uint8,
+    # S2 reflectances for uint16 and backscatter or coherence for float32
+    rng = np.random.default_rng(seed)
+    low, high = BAND_RANGES[dtype]
+    if dtype == 'float32':
+        return rng.uniform(low, high, (bands, rows, cols)).astype(np.float32)
+    return rng.integers(low, high, (bands, rows, cols), dtype=dtype)
+
+
+def parcelMasks(n, dims, median=400, sigma=1.0, seed=0):
+    # n parcels with a log-normal area around median pixels, as
+    # (row0, col0, mask) in the window of shape dims
+    rng = np.random.default_rng(seed)
+    areas = np.clip(rng.lognormal(np.log(median), sigma, n), 1, 200000)
+    aspects = rng.uniform(0.3, 3.0, n)
+    parcels = []
+    for area, aspect in zip(areas, aspects):
+        # Bounding box of an ellipse of this area
+        box = 4 * area / np.pi
+        width = int(min(dims[2], max(1, np.round(np.sqrt(box * aspect)))))
+        height = int(min(dims[1], max(1, np.round(box / width))))
+        row0 = int(rng.integers(0, dims[1] - height + 1))
+        col0 = int(rng.integers(0, dims[2] - width + 1))
+        y, x = np.mgrid[0:height, 0:width]
+        mask = (((y + 0.5) / height - 0.5)**2 +
+                ((x + 0.5) / width - 0.5)**2 <= 0.25).astype(np.uint8)
+        mask[height // 2, width // 2] = 1
+        parcels.append((row0, col0, mask))
+    return parcels
+
+
+def wkbRaster(ipx, ipy, mask, dx, srid=32632):
+    # Little endian PostGIS raster WKB with mask as its 8BUI band, nodata 0
+    height, width = mask.shape
+    header = struct.pack('<BHHddddddiHH', 1, 0, 1, dx, dx, ipx, ipy, 0.0, 0.0,
+                         srid, width, height)
+    return header + bytes([0x40 | 4, 0]) + mask.astype(np.uint8).tobytes()
+
+
+def parcelRowset(parcels, ulx, uly, dx):
+    # (pid, wkb) rows for the parcels of parcelMasks in the window at ulx,
+    # uly. Mask rows map to window rows as in getIndices (drow - r), so the
+    # corner of a parcel is at its last window row.
+    rows = []
+    for pid, (row0, col0, mask) in enumerate(parcels):
+        ipx = ulx + col0 * dx
+        ipy = uly - (row0 + mask.shape[0] - 1) * dx
+        rows.append((pid + 1, wkbRaster(ipx, ipy, mask, dx)))
+    return rows
+
+
+def coarseParcels(parcels, factor):
+    # The parcels of parcelMasks on a grid factor times coarser, a coarse
+    # pixel is in a parcel if any of its fine pixels is. Mask rows are in
+    # WKB order, the last window row first (see parcelRowset).
+    coarse = []
+    for row0, col0, mask in parcels:
+        height, width = mask.shape
+        crow0 = row0 // factor
+        ccol0 = col0 // factor
+        cheight = (row0 + height - 1) // factor - crow0 + 1
+        cwidth = (col0 + width - 1) // factor - ccol0 + 1
+        cmask = np.zeros((cheight, cwidth), dtype=np.uint8)
+        r, c = np.nonzero(mask)
+        rows = (row0 + height - 1 - r) // factor
+        cmask[crow0 + cheight - 1 - rows, (col0 + c) // factor - ccol0] = 1
+        coarse.append((crow0, ccol0, cmask))
+    return coarse
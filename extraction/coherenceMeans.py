@@ -0,0 +1,20 @@
+# coherenceMeans - parcel means of a series of single band VRTs on the same
+# grid (e.g. the dates of a CARD-COH12 stack), with the parcel index built
+# once and the VRTs spread over a pool of processes:
+#
+#   python coherenceMeans.py data/*.vrt
+import sys
+
+from utils import dbSession
+from utils.indexedNumbaWindowedRasterStats import indexRasterMeansBatch
+
+# The pool processes are spawned and import this module, so the run is
+# guarded
+if __name__ == '__main__':
+    session = dbSession.DbSession()
+    status = indexRasterMeansBatch(sys.argv[1:], session,
+                                   session.extraction('means_processes'))
+    session.close()
+
+    for s in sorted(set(status.values())):
+        print(f"{list(status.values()).count(s)} VRTs {s}")
@@ -0,0 +1,31 @@
+# exportParcelStore - export a parcel raster table into the local parcel store
+# (see utils/parcelStore.py), so that extraction workers read the parcels
+# from disk instead of the database:
+#
+#   python exportParcelStore.py 32632 10
+#
+# exports {parcel_table}_32632_10_rast into the parcel_store directory of
+# the extraction section of db_config.json. Run it again after the parcel
+# table changes.
+import sys
+import time
+
+from utils import dbSession, parcelStore
+
+crs = sys.argv[1]
+dx = sys.argv[2]
+
+session = dbSession.DbSession()
+storedir = session.extraction('parcel_store')
+if not storedir:
+    print("No parcel_store configured in db_config.json")
+    sys.exit(1)
+
+parcel_raster_table = f"{session.dbconfig['tables']['parcel_table']}_{crs}_{dx}_rast"
+
+t0 = time.time()
+conn = session.reader()
+n = parcelStore.exportStore(conn, parcel_raster_table,
+                            parcelStore.storePath(storedir, parcel_raster_table))
+session.release(conn)
+print(f"{n} parcels of {parcel_raster_table} exported in {time.time() - t0:.1f} s")
@@ -1,51 +1,274 @@
 import sys
 import os
 import glob
+import queue
 import shutil
+import signal
+import threading
 
-from utils import findImageCandidate, updateImageStatus, buildVRTfromMount, indexedNumbaWindowedRasterStats, indexedNumbaHistogram
+from utils import findImageCandidate, updateImageStatus, buildVRTfromMount, indexedNumbaWindowedRasterStats, indexedNumbaHistogram, multiProductExtraction, bandReader, dbSession, imageTimings, workerMetrics
 
-if not os.path.ismount('/eodata'):
-    print("This script requires a mounted /eodata subdir (FATAL)")
-    sys.exit(1)
+S2_BANDS10 = ['B02', 'B03', 'B04', 'B08']
+S2_BANDS20 = ['B05', 'B11']
 
-tstype = sys.argv[1]
-res = int(sys.argv[2])
+# Set on SIGTERM/SIGINT, a worker finishes its current image and exits
+stopping = threading.Event()
 
-g = findImageCandidate.findImageCandidate(tstype)
 
-if g:
+def imageBands(tstype, res):
     if tstype == 's2':
         if res == -1:
-            bands = ['SCL']
+            return ['SCL']
         elif res == 10:
-            bands = ['B02', 'B03', 'B04', 'B08']
+            return S2_BANDS10
         else:
-            bands = ['B05', 'B11']
-    elif tstype == 'bs':
-        bands = ['VV', 'VH']
+            return S2_BANDS20
+    elif tstype in ['bs', 'c6']:
+        return ['VV', 'VH']
     elif tstype == 'c1':
-        bands = ['VV']
+        return ['VV']
 
-    if buildVRTfromMount.buildVRTfromMount(g, tstype, bands, 'eodata'):
-        print(f"{g[0]} transferred to disk and VRT built")
-        if res == -1:
-            if indexedNumbaHistogram.indexRasterHistogram(g) > 0:
-                updateImageStatus.updateImageStatus(g[0], 'extracted', 'inprogress')
-            else:
-                updateImageStatus.updateImageStatus(g[0], 'No parcels', 'inprogress')
+
+def mountDir(session):
+    # The mounted S3 store, or the tree eodata_dir points to (e.g. the
+    # synthetic tree of benchmarks/replayHarness.py)
+    return session.extraction('eodata_dir', 'eodata').strip('/')
+
+
+def buildImageVRTs(g, tstype, res, session):
+    mountdir = mountDir(session)
+    with imageTimings.span('paths'):
+        if tstype == 's2' and res == 0:
+            # SCL, 10 m and 20 m products in one run, the image is claimed once
+            return buildVRTfromMount.buildVRTfromMount(g, tstype, ['SCL'], mountdir, f"{g[1]}_scl", session) and \
+                buildVRTfromMount.buildVRTfromMount(g, tstype, S2_BANDS10, mountdir, f"{g[1]}_10", session) and \
+                buildVRTfromMount.buildVRTfromMount(g, tstype, S2_BANDS20, mountdir, f"{g[1]}_20", session)
+        return buildVRTfromMount.buildVRTfromMount(g, tstype, imageBands(tstype, res), mountdir, None, session)
+
+
+def prefetchImage(g, tstype, res, session):
+    # Window data read ahead for extractImage, None if the extraction reads
+    # itself, or an error status string
+    if tstype == 's2' and res == 0:
+        return indexedNumbaWindowedRasterStats.prefetchWindow(f"data/{g[1]}_10.vrt", session)
+    elif res == -1:
+        try:
+            return bandReader.readBands(f"data/{g[1]}.vrt", None, session.extraction('read_threads', 1))
+        except Exception as e:
+            print(e)
+            return "Rio error"
+    elif session.extraction('read_budget_mb'):
+        # Strips are read during extraction
+        return None
+    return indexedNumbaWindowedRasterStats.prefetchWindow(f"data/{g[1]}.vrt", session)
+
+
+def extractImage(g, tstype, res, session, prefetched=None):
+    # Extract an image with built VRTs and set its final status
+    if isinstance(prefetched, str):
+        updateImageStatus.updateImageStatus(g[0], prefetched, 'inprogress', session)
+    elif tstype == 's2' and res == 0:
+        status = multiProductExtraction.extractS2(g[0], g[1], S2_BANDS10, S2_BANDS20, prefetched, session)
+        updateImageStatus.updateImageStatus(g[0], status, 'inprogress', session)
+    elif res == -1:
+        rows = indexedNumbaHistogram.indexRasterHistogram(g, prefetched, session)
+        if rows is None:
+            updateImageStatus.updateImageStatus(g[0], 'Copy error', 'inprogress', session)
+        elif rows > 0:
+            updateImageStatus.updateImageStatus(g[0], 'extracted', 'inprogress', session)
         else:
-            status = indexedNumbaWindowedRasterStats.indexRasterStats(g[0], g[1], bands, tstype)
-            updateImageStatus.updateImageStatus(g[0], status, 'inprogress')
+            updateImageStatus.updateImageStatus(g[0], 'No parcels', 'inprogress', session)
     else:
-        updateImageStatus.updateImageStatus(g[0], 'eodata issue', 'inprogress')
+        status = indexedNumbaWindowedRasterStats.indexRasterStats(g[0], g[1], imageBands(tstype, res), tstype, prefetched, session)
+        updateImageStatus.updateImageStatus(g[0], status, 'inprogress', session)
+
+
+def cleanupImage(g):
+    with imageTimings.span('cleanup'):
+        flist = glob.glob(f"data/{g[1]}*")
+        for f in flist:
+            os.remove(f)
+        # Decoded bands in the band cache are kept for retries and reruns
+        cachelist = [c for c in glob.glob(f"/1/DIAS/**/{g[1]}*", recursive = True)
+                     if os.path.isdir(c)]
+        if len(cachelist) > 0:
+            shutil.rmtree(cachelist[0])
+
+
+class ImageClaims:
+    # Images claimed claim_batch at a time and handed out one by one. For
+    # S2, images on tiles done before by this process go first, their
+    # parcel indices are loaded already.
 
-    flist = glob.glob(f"data/{g[1]}*")
-    for f in flist:
-        os.remove(f)
-    cachelist = glob.glob(f"/1/DIAS/**/{g[1]}*", recursive = True)
-    if len(cachelist) > 0:
-        shutil.rmtree(cachelist[0])
+    def __init__(self, tstype, session):
+        self.tstype = tstype
+        self.session = session
+        self.size = session.extraction('claim_batch', 1)
+        self.claimed = []
+        self.tiles = set()
+
+    def next(self):
+        if not self.claimed:
+            prefer = self.tiles if self.tstype == 's2' else None
+            with imageTimings.span('claim'):
+                self.claimed = findImageCandidate.claimImages(self.tstype, self.size, self.session, prefer)
+        if not self.claimed:
+            return None
+        g = tuple(self.claimed.pop(0))
+        if self.tstype == 's2':
+            self.tiles.add(findImageCandidate.imageTile(g[1]))
+        imageTimings.image(g)
+        return g
+
+    def release(self):
+        # Claimed images that were not started go back to the queue
+        for g in self.claimed:
+            updateImageStatus.updateImageStatus(g[0], 'ingested', 'inprogress', self.session)
+        self.claimed = []
+
+
+def stopWorker(signum, frame):
+    print(f"Signal {signum} received, stopping after the current image")
+    stopping.set()
+
+
+def runWorker(tstype, res, session):
+    # Extract images one after another in this process until no candidate is
+    # left or a signal arrives. The pooled connections, the compiled kernels
+    # and the loaded parcel indices are kept from one image to the next.
+    claims = ImageClaims(tstype, session)
+    nimages = 0
+    while not stopping.is_set():
+        imageTimings.start(tstype, res, session)
+        g = claims.next()
+        if not g:
+            imageTimings.finish(session)
+            break
+        if buildImageVRTs(g, tstype, res, session):
+            print(f"{g[0]} transferred to disk and VRT built")
+            extractImage(g, tstype, res, session)
+        else:
+            updateImageStatus.updateImageStatus(g[0], 'eodata issue', 'inprogress', session)
+        cleanupImage(g)
+        imageTimings.finish(session)
+        nimages += 1
+    claims.release()
+
+    print(f"{nimages} images extracted")
+    return nimages
+
+
+def claimAndRead(tstype, res, session, images):
+    # Pipeline stage: claim, build VRTs and read images ahead, until no
+    # candidate is left. put blocks while the queue is full, which bounds
+    # the number of images held in memory.
+    claims = ImageClaims(tstype, session)
+    try:
+        while not stopping.is_set():
+            imageTimings.start(tstype, res, session)
+            g = claims.next()
+            if not g:
+                imageTimings.finish(session)
+                break
+            try:
+                if not buildImageVRTs(g, tstype, res, session):
+                    updateImageStatus.updateImageStatus(g[0], 'eodata issue', 'inprogress', session)
+                    cleanupImage(g)
+                    imageTimings.finish(session)
+                    continue
+                print(f"{g[0]} transferred to disk and VRT built")
+                prefetched = prefetchImage(g, tstype, res, session)
+            except Exception:
+                # The image is neither queued nor claimed any more, so it
+                # goes back to the queue here
+                updateImageStatus.updateImageStatus(g[0], 'ingested', 'inprogress', session)
+                cleanupImage(g)
+                imageTimings.discard(imageTimings.handOff())
+                raise
+            # The timings go with the image to the extraction thread
+            images.put((g, prefetched, imageTimings.handOff()))
+    finally:
+        claims.release()
+        images.put(None)
+
+
+def runPipeline(tstype, res, session):
+    # Extract image N while image N+1 is claimed and read
+    images = queue.Queue(maxsize=session.extraction('prefetch_depth', 1))
+    reader = threading.Thread(target=claimAndRead, args=(tstype, res, session, images))
+    reader.start()
+
+    nimages = 0
+    item = True
+    try:
+        while not stopping.is_set():
+            item = images.get()
+            if item is None:
+                break
+            g, prefetched, timings = item
+            imageTimings.takeOver(timings)
+            extractImage(g, tstype, res, session, prefetched)
+            cleanupImage(g)
+            imageTimings.finish(session)
+            nimages += 1
+    finally:
+        # On errors or signals, images read ahead are given back to the queue
+        stopping.set()
+        imageTimings.activate(None)
+        while item is not None:
+            item = images.get()
+            if item is not None:
+                updateImageStatus.updateImageStatus(item[0][0], 'ingested', 'inprogress', session)
+                cleanupImage(item[0])
+                imageTimings.discard(item[2])
+        reader.join()
+    print(f"{nimages} images extracted")
+    return nimages
+
+
+tstype = sys.argv[1]
+res = int(sys.argv[2])
+
+# Configuration and connections shared by all steps of this run (or all
+# images of a worker), one read and one write connection instead of one or
+# two per step
+session = dbSession.DbSession(pooled=True)
+
+if not session.extraction('eodata_dir') and not os.path.ismount('/eodata'):
+    print("This script requires a mounted /eodata subdir (FATAL)")
+    session.close()
+    sys.exit(1)
+
+if len(sys.argv) > 3 and sys.argv[3] in ['worker', 'pipeline']:
+    signal.signal(signal.SIGTERM, stopWorker)
+    signal.signal(signal.SIGINT, stopWorker)
+    # Live counters of this replica, merged by the orchestrator
+    workerMetrics.start(tstype, session)
+    if sys.argv[3] == 'pipeline':
+        nimages = runPipeline(tstype, res, session)
+    else:
+        nimages = runWorker(tstype, res, session)
+    workerMetrics.stop()
+    session.close()
+    if nimages == 0:
+        print("No candidate ingested image found")
+    sys.exit(0)
+
+imageTimings.start(tstype, res, session)
+with imageTimings.span('claim'):
+    g = findImageCandidate.findImageCandidate(tstype, session)
+
+if g:
+    imageTimings.image(g)
+    if buildImageVRTs(g, tstype, res, session):
+        print(f"{g[0]} transferred to disk and VRT built")
+        extractImage(g, tstype, res, session)
+    else:
+        updateImageStatus.updateImageStatus(g[0], 'eodata issue', 'inprogress', session)
+    cleanupImage(g)
+    imageTimings.finish(session)
 
 else:
    print("No candidate ingested image found")
+
+session.close()
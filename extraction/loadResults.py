@@ -0,0 +1,35 @@
+# loadResults - copy the Parquet results of "output": "parquet" runs (see
+# utils/columnarWriter.py) into the result tables:
+#
+#   python loadResults.py
+#   python loadResults.py public.sigs public.hists
+#
+# loads the finished files of all tables under output_dir (or of the given
+# tables), one transaction per file. Loaded files are moved to the same
+# place under {output_dir}.loaded, or removed with --remove, so the loader
+# can run again while workers are still writing, or after a failure.
+import argparse
+import os
+import time
+
+from utils import columnarWriter, dbSession
+
+parser = argparse.ArgumentParser(
+    description='Copy Parquet extraction results into PostgreSQL')
+parser.add_argument('tables', nargs='*')
+parser.add_argument('--remove', action='store_true',
+                    help='remove loaded files instead of moving them')
+args = parser.parse_args()
+
+session = dbSession.DbSession()
+root = session.extraction('output_dir', 'results')
+tables = args.tables or sorted(os.listdir(root))
+loaded = None if args.remove else f"{root.rstrip('/')}.loaded"
+
+conn = session.writer()
+for table in tables:
+    t0 = time.time()
+    n = columnarWriter.loadFiles(conn, root, table, loaded)
+    print(f"{n} rows loaded into {table} in {time.time() - t0:.1f} s")
+session.release(conn)
+session.close()
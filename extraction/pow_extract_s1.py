@@ -1,9 +1,12 @@
+import os
 import sys
-import time
+import json
 
 from python_on_whales import docker
 import psycopg2
 
+from utils import stackMonitor, workerMetrics
+
 from datetime import datetime
 
 # Set up database connection and test
@@ -12,6 +15,15 @@ conn_str = "host='185.178.86.9' dbname='outreach' user='postgres' password='db4C
 conn = psycopg2.connect(conn_str)
 curs = conn.cursor()
 
+# Status changes of the catalogue are notified to waitForStack
+stackMonitor.installTrigger(conn, 'dias_catalogue')
+
+# Metrics of the replicas, merged into metrics_dir/extraction.prom, with the
+# settings of the db_config.json the workers read
+with open('db_config.json', 'r') as f:
+    config = json.load(f)
+metrics = workerMetrics.SwarmMetrics(config)
+
 aoi = sys.argv[1]
 year = aoi.split('_')[1]
 card = 'bs'
@@ -24,6 +36,12 @@ selectSQL = f"""select count(*) from dias_catalogue, aois where card = '{card}'
       and obstime between '{startDate}' and '{endDate}' and 
       footprint && wkb_geometry and name = '{aoi}'
       and status in ('ingested')"""
+
+countSQL = f"""select count(*) filter (where status = 'ingested'),
+      count(*) filter (where status = 'inprogress') from dias_catalogue, aois where card = '{card}' 
+      and obstime between '{startDate}' and '{endDate}' and 
+      footprint && wkb_geometry and name = '{aoi}'
+      and status in ('ingested', 'inprogress')"""
     
 curs.execute(selectSQL)
 
@@ -34,24 +52,20 @@ print(f"{r[0]} entries to be processed")
 # Set up the swarm and deploy the stack
 docker.swarm.init(advertise_address='192.168.0.14')
 
+# Compile the numba kernels into the cache of the mounted code, so that the
+# workers do not compile them at start up
+print("Compiling numba kernels")
+docker.run("glemoine62/dias_numba_py:latest", ["python", "warmupKernels.py"],
+           volumes=[(os.getcwd(), "/usr/src/app")], remove=True)
+
 print("Deploying bs stack")
+metrics.reset()
 swarmpit_stack = docker.stack.deploy("bs", compose_files=["./docker-compose_s1_bs.yml"])
 
-sleep = 300
-while r[0] > 0:
-    # check every 5 minutes
-    time.sleep(sleep)
+# Returns as soon as the last image of the stack is done
+stackMonitor.waitForStack(conn, countSQL, card, metrics=metrics,
+                          stuck=config.get('extraction', {}).get('stuck_timeout', 3600))
 
-    curs.execute(selectSQL)
-    r = curs.fetchone()
-    
-    if r[0] > 0:
-        print(f"{r[0]} entries to be processed")
-    elif r[0] < 5:
-        sleep = 60
-    else:
-        break    
-        
 print("Stack bs finished")
 swarmpit_stack.remove()
 print("Stack bs removed")
@@ -63,6 +77,12 @@ selectSQL = f"""select count(*) from dias_catalogue, aois where card = '{card}'
       footprint && wkb_geometry and name = '{aoi}'
       and status in ('ingested')"""
 
+countSQL = f"""select count(*) filter (where status = 'ingested'),
+      count(*) filter (where status = 'inprogress') from dias_catalogue, aois where card = '{card}'
+      and obstime between '{startDate}' and '{endDate}' and
+      footprint && wkb_geometry and name = '{aoi}'
+      and status in ('ingested', 'inprogress')"""
+
 curs.execute(selectSQL)
 
 r = curs.fetchone()
@@ -71,23 +91,13 @@ print(f"{r[0]} entries to be processed")
 
 print("Deploying c6 stack")
 
+metrics.reset()
 swarmpit_stack = docker.stack.deploy("c6", compose_files=["./docker-compose_s1_c6.yml"])
 
-sleep = 300
-while r[0]>0:
-    # check every 5 minutes
-    time.sleep(sleep)
+# Returns as soon as the last image of the stack is done
+stackMonitor.waitForStack(conn, countSQL, card, metrics=metrics,
+                          stuck=config.get('extraction', {}).get('stuck_timeout', 3600))
 
-    curs.execute(selectSQL)
-    r = curs.fetchone()
-    
-    if r[0] > 0:
-        print(f"{r[0]} entries to be processed")
-    elif r[0] < 10:
-        sleep = 60
-    else:
-        break    
-        
 print("Stack c6 finished")
 swarmpit_stack.remove()
 print("Stack c6 removed")
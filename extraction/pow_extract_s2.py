@@ -1,13 +1,17 @@
+import os
 import sys
-import time
 import json
 
 # Revision 1.1: 2023-05-26. Added 'final' status at the end of the 3 runs
 # Force reprojection of the aois geometry to 4326
+# Revision 1.2: the scl, s210 and s220 stacks are replaced by the single s2
+# stack, which extracts all three products per claimed image
 
 from python_on_whales import docker
 import psycopg2
 
+from utils import stackMonitor, workerMetrics
+
 from datetime import datetime
 
 with open('db_config.json', 'r') as f:
@@ -22,6 +26,12 @@ connString = f"host={dbconfig['connection']['host']} dbname={dbconfig['connectio
 conn = psycopg2.connect(connString)
 curs = conn.cursor()
 
+# Status changes of the catalogue are notified to waitForStack
+stackMonitor.installTrigger(conn, 'dias_catalogue')
+
+# Metrics of the replicas, merged into metrics_dir/extraction.prom
+metrics = workerMetrics.SwarmMetrics(config)
+
 aoi = dbconfig['args']['name']
 
 card = 's2'
@@ -33,53 +43,22 @@ endDate = dbconfig['args']['enddate']
 # Set up the swarm and deploy the stack
 docker.swarm.init(advertise_address=config['docker']['masterip'])
 
+# Compile the numba kernels into the cache of the mounted code, so that the
+# workers do not compile them at start up
+print("Compiling numba kernels")
+docker.run("glemoine62/dias_numba_py:latest", ["python", "warmupKernels.py"],
+           volumes=[(os.getcwd(), "/usr/src/app")], remove=True)
+
 selectSQL = f"""select count(*) from dias_catalogue, aois where card = '{card}'
       and obstime between '{startDate}' and '{endDate}' and
       footprint && st_transform(wkb_geometry, 4326) and name = '{aoi}'
       and status in ('ingested')"""
 
-curs.execute(selectSQL)
-
-r = curs.fetchone()
-
-print(f"{r[0]} entries to be processed")
-
-
-print("Deploying scl stack")
-swarmpit_stack = docker.stack.deploy("scl", compose_files=["./docker-compose_scl.yml"])
-
-while True:
-    # check every 2 minutes
-    time.sleep(120)
-
-    curs.execute(selectSQL)
-    r = curs.fetchone()
-
-    if r[0] > 0:
-        print(f"{r[0]} entries still to be processed")
-    else:
-        break
-
-print("Stack scl finished")
-swarmpit_stack.remove()
-print("Stack scl removed")
-
-
-# Reset the extracted to ingested
-updateSQL = f"""update dias_catalogue set status = 'ingested'
-      where id in (select id from dias_catalogue, aois where card = '{card}'
+countSQL = f"""select count(*) filter (where status = 'ingested'),
+      count(*) filter (where status = 'inprogress') from dias_catalogue, aois where card = '{card}'
       and obstime between '{startDate}' and '{endDate}' and
       footprint && st_transform(wkb_geometry, 4326) and name = '{aoi}'
-      and status in ('extracted'))"""
-
-try:
-    curs.execute(updateSQL)
-    conn.commit()
-except Error as e:
-    print("Update failed")
-    conn.rollback()
-    conn.close()
-    sys.exit(1)
+      and status in ('ingested', 'inprogress')"""
 
 curs.execute(selectSQL)
 
@@ -88,54 +67,19 @@ r = curs.fetchone()
 print(f"{r[0]} entries to be processed")
 
 
-print("Deploying s210 stack")
-swarmpit_stack = docker.stack.deploy("s210", compose_files=["./docker-compose_s210.yml"])
-
-while True:
-    # check every 3 minutes
-    time.sleep(180)
-
-    curs.execute(selectSQL)
-    r = curs.fetchone()
-
-    if r[0] > 0:
-        print(f"{r[0]} entries to be processed")
-    else:
-        break
-
-print("Stack s210 finished")
-swarmpit_stack.remove()
-print("Stack s210 removed")
-
-
-try:
-    curs.execute(updateSQL)
-    conn.commit()
-except Error as e:
-    print("Update failed")
-    conn.rollback()
-    conn.close()
-    sys.exit(1)
-
-print("Deploying s220 stack")
-
-swarmpit_stack = docker.stack.deploy("s220", compose_files=["./docker-compose_s220.yml"])
-
-while True:
-    # check every 3 minutes
-    time.sleep(180)
-
-    curs.execute(selectSQL)
-    r = curs.fetchone()
+print("Deploying s2 stack")
+metrics.reset()
+# One stack claims each image once and extracts the SCL histograms, 10 m and
+# 20 m band statistics in a single run (factoredWindowedExtraction.py s2 0)
+swarmpit_stack = docker.stack.deploy("s2", compose_files=["./docker-compose_s2.yml"])
 
-    if r[0] > 0:
-        print(f"{r[0]} entries to be processed")
-    else:
-        break
+# Returns as soon as the last image of the stack is done
+stackMonitor.waitForStack(conn, countSQL, card, metrics=metrics,
+                          stuck=config.get('extraction', {}).get('stuck_timeout', 3600))
 
-print("Stack s220 finished")
+print("Stack s2 finished")
 swarmpit_stack.remove()
-print("Stack s220 removed")
+print("Stack s2 removed")
 docker.swarm.leave(force=True)
 print("Swarm left")
 
@@ -0,0 +1,75 @@
+# bandCache - decode each image band once into an uncompressed local copy
+#
+# S2 L2A bands are JPEG2000, which is expensive to decode. With band_cache
+# set, the first extraction of an image decodes its bands into raw ENVI files
+# (.img with a .hdr) in the band cache, keyed by product reference and band,
+# and the VRT points at those. Retries and reruns of the image then read the
+# copy through GDAL instead of decoding the JP2 again. A single s2 run reads
+# every band once, so the first extraction only pays for the copy, and the
+# cache is off by default. The cache is kept below a size limit by evicting
+# the least recently used bands.
+import glob
+import os
+
+from osgeo import gdal
+
+
+def bandPath(cachedir, reference, band):
+    return os.path.join(cachedir, f"{reference}_{band}.img")
+
+
+def cacheSize(cachedir):
+    # (mtime, path, size) of all cached bands, oldest first
+    entries = []
+    for img in glob.glob(os.path.join(cachedir, '*.img')):
+        if img.endswith('.tmp.img'):
+            continue
+        try:
+            st = os.stat(img)
+            hdrsize = os.path.getsize(img[:-4] + '.hdr')
+        except OSError:
+            continue
+        entries.append((st.st_mtime, img, st.st_size + hdrsize))
+    return sorted(entries)
+
+
+def evict(cachedir, maxbytes):
+    # Remove least recently used bands until the cache fits in maxbytes
+    entries = cacheSize(cachedir)
+    total = sum([e[2] for e in entries])
+    for mtime, img, size in entries:
+        if total <= maxbytes:
+            break
+        for f in [img, img[:-4] + '.hdr', img + '.aux.xml']:
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+        total -= size
+        print(f"{img} evicted from band cache")
+
+
+def cachedBand(srcpath, cachedir, reference, band, maxgb):
+    # Path of the decoded copy of srcpath, decoding it first if not cached
+    path = bandPath(cachedir, reference, band)
+    if os.path.exists(path):
+        # Touch for LRU, atime is not reliable on our mounts
+        os.utime(path)
+        return path
+
+    os.makedirs(cachedir, exist_ok=True)
+    tmppath = path.replace('.img', f".{os.getpid()}.tmp.img")
+    if gdal.Translate(tmppath, srcpath, format='ENVI') is None:
+        print(f"Decoding {srcpath} into band cache failed")
+        return srcpath
+
+    # The header goes first, a band is only cached once its .img exists
+    os.replace(tmppath[:-4] + '.hdr', path[:-4] + '.hdr')
+    os.replace(tmppath, path)
+    for f in glob.glob(tmppath[:-4] + '.*'):
+        os.remove(f)
+    print(f"{srcpath} decoded into {path}")
+
+    evict(cachedir, maxgb * 1024**3)
+    return path
+
@@ -0,0 +1,50 @@
+# bandReader - read the bands of a (separate) VRT concurrently
+#
+# The VRTs built by buildVRTfromMount stack one source file per band, and a
+# plain src.read decodes them one after another. Here every band is read by
+# its own thread on its own dataset handle (rasterio datasets must not be
+# shared between threads), into a slice of one preallocated array. GDAL
+# releases the GIL while reading, so the read takes about as long as the
+# slowest band instead of the sum of all bands.
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from . import imageTimings
+
+
+def readBand(vrt, b, window, out):
+    with rasterio.open(vrt) as src:
+        src.read(b + 1, window=window, out=out)
+
+
+def readBands(vrt, window=None, threads=1):
+    # All bands of vrt in window (the whole image if None) as a (bands, rows,
+    # cols) array, with up to threads bands read at the same time
+    with imageTimings.span('read'):
+        data = readBandArray(vrt, window, threads)
+    imageTimings.count('read_bytes', data.nbytes)
+    imageTimings.count('read_pixels', data.shape[1] * data.shape[2])
+    return data
+
+
+def readBandArray(vrt, window, threads):
+    with rasterio.open(vrt) as src:
+        if threads <= 1 or src.count == 1:
+            return src.read(window=window)
+        count = src.count
+        dtype = src.dtypes[0]
+        if window is None:
+            window = Window(0, 0, src.width, src.height)
+
+    data = np.empty((count, int(window.height), int(window.width)),
+                    dtype=dtype)
+    with ThreadPoolExecutor(min(threads, count)) as pool:
+        futures = [pool.submit(readBand, vrt, b, window, data[b])
+                   for b in range(count)]
+        # Re-raises the first read error in the caller
+        for f in futures:
+            f.result()
+    return data
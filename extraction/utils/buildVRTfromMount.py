@@ -6,12 +6,16 @@ from datetime import datetime
 from osgeo import gdal
 
 from . import updateImageStatus as uis
+from . import bandCache, dbSession, imageTimings
 
 # CREODIAS public S3 archive access
 
 
-def buildVRTfromMount(cand, cardtype, bands, mountdir):
-    # cand is a tuple
+def buildVRTfromMount(cand, cardtype, bands, mountdir, vrtname=None,
+                      session=None):
+    # cand is a tuple, vrtname defaults to the reference
+    if session is None:
+        session = dbSession.DbSession()
     oid = cand[0]
     reference = cand[1]
     obstime = cand[2]
@@ -26,12 +30,12 @@ def buildVRTfromMount(cand, cardtype, bands, mountdir):
             hdrpath = f"/{mountdir}/Sentinel-1/SAR/CARD-BS/{datetime.strftime(obstime, '%Y/%m/%d')}/{reference}/{reference}.data/Gamma0_{b}.hdr"
             if not os.path.exists(imgpath):
                 print(f"Resource {imgpath} not available in mounted S3 storage (FATAL)")
-                if (uis.updateImageStatus(oid, f"!S3 {b}.img", 'inprogress')):
+                if (uis.updateImageStatus(oid, f"!S3 {b}.img", 'inprogress', session)):
                     return False
                 return False
             elif not os.path.exists(hdrpath):
                 print(f"Resource {hdrpath} not available in mounted S3 storage (FATAL)")
-                if (uis.updateImageStatus(oid, f"!S3 {b}.hdr", 'inprogress')):
+                if (uis.updateImageStatus(oid, f"!S3 {b}.hdr", 'inprogress', session)):
                     return False
                 return False
             else:
@@ -43,7 +47,7 @@ def buildVRTfromMount(cand, cardtype, bands, mountdir):
         imgpath = f"/{mountdir}/Sentinel-1/SAR/CARD-COH6/{datetime.strftime(obstime, '%Y/%m/%d')}/{reference}/{reference}.tif"
         if not os.path.exists(imgpath):
             print(f"Resource {imgpath} not available in mounted S3 storage (FATAL)")
-            if (uis.updateImageStatus(oid, f"!S3 .tif", 'inprogress')):
+            if (uis.updateImageStatus(oid, f"!S3 .tif", 'inprogress', session)):
                 return False
             return False
         else:
@@ -59,7 +63,7 @@ def buildVRTfromMount(cand, cardtype, bands, mountdir):
 
         if not flist:
             print(f"Resource {imgpath} not available in S3 storage (FATAL)")
-            if (uis.updateImageStatus(oid, f"!S3 subdir", 'inprogress')):
+            if (uis.updateImageStatus(oid, f"!S3 subdir", 'inprogress', session)):
                 return False
             return False
 
@@ -68,6 +72,9 @@ def buildVRTfromMount(cand, cardtype, bands, mountdir):
         mgrs_tile = reference.split('_')[5]
         full_tstamp = reference.split('_')[2]
 
+        # JP2 bands are decoded once into the band cache, if configured
+        cachedir = session.extraction('band_cache')
+
         for b in bands:
             res = 0
             if b in ['B02', 'B03', 'B04', 'B08']:
@@ -81,10 +88,16 @@ def buildVRTfromMount(cand, cardtype, bands, mountdir):
             fullpath = f"{imgpath}{subdir}/IMG_DATA/{selection}"
             if not os.path.exists(fullpath):
                 print(f"Resource {fullpath} not available in mounted S3 storage (FATAL)")
-                if (uis.updateImageStatus(oid, f"!S3 .jp2", 'inprogress')):
+                if (uis.updateImageStatus(oid, f"!S3 .jp2", 'inprogress', session)):
                     return False
                 return False
+            elif cachedir:
+                with imageTimings.span('read'):
+                    imglist.append(bandCache.cachedBand(
+                        fullpath, cachedir, reference, b,
+                        session.extraction('band_cache_gb', 50)))
             else:
                 imglist.append(fullpath)
-    gdal.BuildVRT(f"data/{reference}.vrt", imglist, options=vrt_options)
+    with imageTimings.span('vrt'):
+        gdal.BuildVRT(f"data/{vrtname or reference}.vrt", imglist, options=vrt_options)
     return True
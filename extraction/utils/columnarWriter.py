@@ -0,0 +1,237 @@
+# columnarWriter - extraction results as Parquet files instead of rows in
+# PostgreSQL, and the bulk loader that copies finished files into the tables
+#
+# ParquetWriter has the write/close interface of resultWriter.BinaryCopyWriter
+# and is selected with "output": "parquet" (resultWriter.openWriter). Files go
+# to a hive partitioned tree per result table,
+#
+#   {output_dir}/{table}/aoi={aoi}/card={card}/obsid={obsid}/part-*.parquet
+#
+# with obsid (or rtfid for the means) taken from the scalar column of each
+# write, so it is not repeated in the file. Statistics are float32 and band
+# names dictionary encoded. A file is written under a hidden .tmp name and
+# renamed when the writer is closed, so readers and the loader only see
+# finished files. Files are named by host, process and time, so workers
+# never write the same file. As with BinaryCopyWriter, a failed write (e.g. a
+# full disk) stops the writer and close returns None; its .tmp files are
+# removed.
+import glob
+import os
+import socket
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from . import imageTimings, resultWriter
+
+# Arrow types of the result columns
+TYPES = {
+    'pid': pa.int32(),
+    'band': pa.dictionary(pa.int8(), pa.string()),
+    'count': pa.int32(),
+    'mean': pa.float32(),
+    'std': pa.float32(),
+    'min': pa.float32(),
+    'max': pa.float32(),
+    'p25': pa.float32(),
+    'p50': pa.float32(),
+    'p75': pa.float32(),
+    'obsid': pa.int32(),
+    'rtfid': pa.string(),
+    'hist': pa.string(),
+    'counts': pa.list_(pa.int32()),
+}
+
+
+def columnArray(c, v, n):
+    # Arrow array of n rows for column c, from an array or a constant
+    t = TYPES[c]
+    if pa.types.is_dictionary(t):
+        if isinstance(v, (str, bytes)):
+            return pa.DictionaryArray.from_arrays(
+                pa.array(np.zeros(n, dtype=np.int8)), pa.array([v]))
+        return pa.array(list(v), type=pa.string()).dictionary_encode().cast(t)
+    if pa.types.is_list(t):
+        # Class counts as an (n, classes) array
+        v = np.asarray(v, dtype=np.int32)
+        return pa.ListArray.from_arrays(
+            pa.array(np.arange(0, n * v.shape[1] + 1, v.shape[1],
+                               dtype=np.int32)),
+            pa.array(v.reshape(-1)))
+    if isinstance(v, (str, bytes)) or np.ndim(v) == 0:
+        return pa.array([v] * n, type=t)
+    if pa.types.is_string(t):
+        return pa.array(list(v), type=t)
+    return pa.array(np.asarray(v, dtype=t.to_pandas_dtype()), type=t)
+
+
+class ParquetWriter:
+
+    def __init__(self, root, table, columns, partition, keys=(),
+                 flush_size=100000):
+        # partition holds the partition values of all rows, e.g. aoi and
+        # card, keys the columns whose (scalar) values partition the rows
+        for c in columns:
+            if c not in TYPES:
+                raise ValueError(f"Column {c} has no Parquet type")
+        self.table = table
+        self.columns = list(columns)
+        self.keys = [k for k in keys if k in self.columns]
+        self.fields = [c for c in self.columns if c not in self.keys]
+        self.schema = pa.schema([(c, TYPES[c]) for c in self.fields])
+        self.dir = os.path.join(root, table, *[f"{k}={v}" for k, v in
+                                               partition.items()])
+        self.name = f"part-{socket.gethostname()}-{os.getpid()}-{time.time_ns()}.parquet"
+        self.flush_size = flush_size
+        # Pending tables, open file writers and file paths per partition
+        self.pending = {}
+        self.files = {}
+        self.rows = 0
+        self.failed = False
+
+    def write(self, values):
+        # values maps every column to an array of rows or a scalar that is
+        # the same for all rows. Returns the number of rows buffered.
+        n = max([len(v) for v in values.values()
+                 if not isinstance(v, (str, bytes)) and np.ndim(v) > 0])
+        if n == 0:
+            return 0
+
+        with imageTimings.span('write'):
+            part = tuple(str(values[k]) for k in self.keys)
+            batch = pa.Table.from_arrays(
+                [columnArray(c, values[c], n) for c in self.fields],
+                schema=self.schema)
+            tables = self.pending.setdefault(part, [])
+            tables.append(batch)
+            if sum(t.num_rows for t in tables) >= self.flush_size:
+                self.flush(part)
+        return n
+
+    def flush(self, part):
+        # Write the pending rows of a partition as one row group. After a
+        # failed write nothing more is written.
+        tables = self.pending.pop(part, [])
+        if not tables or self.failed:
+            return
+        try:
+            table = pa.concat_tables(tables).unify_dictionaries() \
+                .combine_chunks()
+            if part not in self.files:
+                path = os.path.join(self.dir, *[f"{k}={v}" for k, v in
+                                                zip(self.keys, part)],
+                                    self.name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = os.path.join(os.path.dirname(path), f".{self.name}.tmp")
+                self.files[part] = (pq.ParquetWriter(tmp, self.schema,
+                                                     compression='zstd'),
+                                    tmp, path)
+            self.files[part][0].write_table(table)
+            self.rows += table.num_rows
+            imageTimings.count('rows', table.num_rows)
+        except (pa.ArrowException, OSError) as e:
+            print("Parquet error", e)
+            self.failed = True
+            self.pending = {}
+
+    def close(self):
+        # The rows written, None if any write failed
+        with imageTimings.span('write'):
+            for part in list(self.pending):
+                self.flush(part)
+            for writer, tmp, path in self.files.values():
+                try:
+                    writer.close()
+                    if not self.failed:
+                        os.replace(tmp, path)
+                        continue
+                except (pa.ArrowException, OSError) as e:
+                    print("Parquet error", e)
+                    self.failed = True
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+        self.files = {}
+        if self.failed:
+            return None
+        return self.rows
+
+
+def finishedFiles(root, table):
+    # Finished files of a result table, hidden .tmp files are being written
+    return sorted(glob.glob(os.path.join(root, table, '**', 'part-*.parquet'),
+                            recursive=True))
+
+
+def partitionValues(root, table, path):
+    # The key=value directories between the table directory and the file
+    rel = os.path.relpath(os.path.dirname(path), os.path.join(root, table))
+    return dict(p.split('=', 1) for p in rel.split(os.sep) if '=' in p)
+
+
+def loadFile(conn, table, path, values):
+    # Copy one file into table in a single transaction, with the partition
+    # values that are columns of the table. Rows are copied per band, so
+    # that the band text is constant and goes through the block encoder.
+    # Returns the rows copied, None if the copy failed.
+    data = pq.read_table(path)
+    types = resultWriter.columnTypes(conn, table)
+    constants = {}
+    for k, v in values.items():
+        if k in types:
+            constants[k] = int(v) if types[k] in resultWriter.FIXED_TYPES else v
+    columns = data.column_names + list(constants)
+    writer = resultWriter.BinaryCopyWriter(conn, table, columns,
+                                           data.num_rows + 1)
+
+    if 'band' in data.column_names:
+        band = data.column('band').combine_chunks()
+        parts = [(b.as_py(), data.filter(pc.equal(band.indices, i)))
+                 for i, b in enumerate(band.dictionary)]
+    else:
+        parts = [(None, data)]
+
+    n = 0
+    for b, part in parts:
+        if part.num_rows == 0:
+            continue
+        rows = dict(constants)
+        for c in part.column_names:
+            col = part.column(c)
+            if c == 'band':
+                rows[c] = b
+            elif pa.types.is_list(col.type):
+                counts = col.combine_chunks()
+                rows[c] = counts.values.to_numpy().reshape(len(counts), -1)
+            elif pa.types.is_string(col.type):
+                rows[c] = col.to_pylist()
+            else:
+                rows[c] = col.to_numpy()
+        n += writer.write(rows)
+    if writer.close() != n:
+        return None
+    return n
+
+
+def loadFiles(conn, root, table, loaded=None):
+    # Copy the finished files of table into it, one transaction per file.
+    # Loaded files are moved to the same place under loaded (removed if
+    # None), so a rerun only copies the files that are left.
+    total = 0
+    for path in finishedFiles(root, table):
+        n = loadFile(conn, table, path, partitionValues(root, table, path))
+        if n is None:
+            print(f"{path} not loaded")
+            continue
+        if loaded:
+            dest = os.path.join(loaded, os.path.relpath(path, root))
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            os.replace(path, dest)
+        else:
+            os.remove(path)
+        total += n
+    return total
@@ -0,0 +1,92 @@
+# dbSession - configuration and database connections of an extraction run
+#
+# db_config.json is read once per session, and the session is passed down the
+# extraction call chain. Connections are taken for a role, 'read' (catalogue,
+# AOI and parcel queries) or 'write' (status updates and result COPY), and
+# given back with release. A pooled session, as used by long running workers,
+# keeps up to db_pool_size idle connections per role between images. An
+# unpooled session opens a connection on request and closes it on release.
+# connect returns None if no connection can be had, and connection releases
+# its connection also when the block raises.
+import json
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.pool
+
+
+def connectionString(dbconfig):
+    return "host={} dbname={} user={} port={} password={}".format(
+        dbconfig['connection']['host'], dbconfig['connection']['dbname'],
+        dbconfig['connection']['dbuser'], dbconfig['connection']['port'],
+        dbconfig['connection']['dbpasswd'])
+
+
+class DbSession:
+
+    def __init__(self, path='db_config.json', pooled=False):
+        with open(path, 'r') as f:
+            self.config = json.load(f)
+        self.dbconfig = self.config['database']
+        self.connString = connectionString(self.dbconfig)
+
+        self.pools = {}
+        self.roles = {}
+        if pooled:
+            size = self.config.get('extraction', {}).get('db_pool_size', 1)
+            for role in ['read', 'write']:
+                # Idle connections above minconn are closed on release
+                self.pools[role] = psycopg2.pool.ThreadedConnectionPool(
+                    size, 4 * size, self.connString)
+
+    def extraction(self, key, default=None):
+        # A setting of the extraction section of the configuration
+        return self.config.get('extraction', {}).get(key, default)
+
+    def connect(self, role):
+        # A connection for role, None if the server cannot be reached or
+        # all connections of the pool are taken
+        try:
+            if role not in self.pools:
+                return psycopg2.connect(self.connString)
+            pool = self.pools[role]
+            conn = pool.getconn()
+            if conn.closed:
+                # Dropped by the server while idle in the pool
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+        except (psycopg2.OperationalError, psycopg2.pool.PoolError) as e:
+            print(e)
+            return None
+        self.roles[id(conn)] = role
+        return conn
+
+    @contextmanager
+    def connection(self, role):
+        # with session.connection('write') as conn: the connection (None if
+        # none) is released when the block is left
+        conn = self.connect(role)
+        try:
+            yield conn
+        finally:
+            if conn:
+                self.release(conn)
+
+    def reader(self):
+        return self.connect('read')
+
+    def writer(self):
+        return self.connect('write')
+
+    def release(self, conn):
+        # Give a connection back, open transactions are rolled back
+        role = self.roles.pop(id(conn), None)
+        if role is None:
+            conn.close()
+        else:
+            self.pools[role].putconn(conn)
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.closeall()
+        self.pools = {}
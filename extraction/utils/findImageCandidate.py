@@ -1,47 +1,64 @@
-# findImageCandidate - find oldest ingested image, return S3 key
+# findImageCandidate - claim the oldest ingested images, return S3 keys
 #
-import json
-import psycopg2
-
-from . import updateImageStatus as uis
-
-
-def findImageCandidate(cardtype):
-    # Spatial database details
-    with open('db_config.json', 'r') as f:
-        dbconfig = json.load(f)['database']
-    dbconn = dbconfig['connection']
-
-    conn_str = f"host={dbconn['host']} dbname={dbconn['dbname']}\
-        user={dbconn['dbuser']} port={dbconn['port']}\
-        password={dbconn['dbpasswd']}"
-
-    inconn = psycopg2.connect(conn_str)
-    if not inconn:
-        print("No in connection established")
-        return(None)
-
-    # Get the first image record that is not yet processed
-    imagesql = f"SELECT id, reference, obstime from {dbconfig['tables']['catalog_table']}, {dbconfig['tables']['aoi_table']}\
-    where footprint && wkb_geometry and {dbconfig['args']['aoi_field']} = '{dbconfig['args']['name']}'\
-    and obstime between '{dbconfig['args']['startdate']}' and '{dbconfig['args']['enddate']}'\
-    and status ='ingested'\
-    and card='{cardtype}' order by obstime asc limit 1"
-    # print(imagesql)
-    with inconn:
-        with inconn.cursor() as trans_cur:
-            trans_cur.execute(imagesql)
-            if trans_cur.rowcount != 1:
-                print("No images with status 'ingested' found")
-                return(None)
-            else:
-                result = trans_cur.fetchone()
-                oid = result[0]
-                reference = result[1]
-                obstime = result[2]
-                # Fails if this record is changed in the meantime
-                if (uis.updateImageStatus(oid, 'inprogress', 'ingested')):
-                    print(f"{reference} found for processing")
-                    return oid, reference, obstime
-                else:
-                    return None
+# Images are claimed with a single UPDATE ... RETURNING on a FOR UPDATE SKIP
+# LOCKED selection, so concurrent workers each get their own images in one
+# round trip instead of racing for the same oldest row.
+from . import dbSession
+
+
+def imageTile(reference):
+    # MGRS tile of a Sentinel-2 reference, e.g. T32UNG
+    return reference.split('_')[5]
+
+
+def claimImages(cardtype, n, session=None, prefer=None):
+    # Claim up to n ingested images, oldest first, and set them in progress.
+    # Images on the MGRS tiles in prefer (tiles the worker has the parcel
+    # index of) go first. Returns a list of (oid, reference, obstime).
+    if session is None:
+        session = dbSession.DbSession()
+    dbconfig = session.dbconfig
+
+    claimSql = f"""UPDATE {dbconfig['tables']['catalog_table']}
+        SET status = 'inprogress'
+        WHERE id IN (
+            SELECT c.id FROM {dbconfig['tables']['catalog_table']} c,
+                {dbconfig['tables']['aoi_table']} a
+            WHERE c.footprint && a.wkb_geometry
+            AND a.{dbconfig['args']['aoi_field']} = %s
+            AND c.obstime BETWEEN %s AND %s
+            AND c.status = 'ingested' AND c.card = %s
+            ORDER BY split_part(c.reference, '_', 6) = ANY(%s::text[]) DESC,
+                c.obstime ASC
+            LIMIT %s
+            FOR UPDATE OF c SKIP LOCKED)
+        RETURNING id, reference, obstime"""
+    prefer = list(prefer or [])
+    with session.connection('write') as conn:
+        if not conn:
+            print("No connection established")
+            return []
+        with conn.cursor() as claim_cur:
+            claim_cur.execute(claimSql, (dbconfig['args']['name'],
+                                         dbconfig['args']['startdate'],
+                                         dbconfig['args']['enddate'],
+                                         cardtype, prefer, n))
+            claimed = claim_cur.fetchall()
+        conn.commit()
+
+    # RETURNING has no order
+    claimed.sort(key=lambda r: (imageTile(r[1]) not in prefer, r[2]))
+    for r in claimed:
+        print(f"{r[1]} found for processing")
+    if not claimed:
+        print("No images with status 'ingested' found")
+    return claimed
+
+
+def findImageCandidate(cardtype, session=None, prefer=None):
+    # session is the dbSession of a long running worker, if None one is set
+    # up for this call only
+    claimed = claimImages(cardtype, 1, session, prefer)
+    if claimed:
+        return tuple(claimed[0])
+    return None
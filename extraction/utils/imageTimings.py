@@ -0,0 +1,252 @@
+# imageTimings - time spent per stage on every extracted image
+#
+# A record per image holds the seconds spent in each stage, counters of the
+# data processed and the peak resident set of the process. When the image is
+# done it is appended as one JSON line to timings_file and, if set, inserted
+# into timings_table (created if missing). The stages are
+#
+#   claim    claiming the image in the catalogue
+#   paths    finding the band files of the image under the mount
+#   vrt      building its VRTs
+#   read     reading and decoding the window
+#   queued   read ahead, waiting for the extraction (pipeline mode)
+#   parcels  parcel query and fetch, parcel store or index cache lookup
+#   decode   parcel raster WKB decoding
+#   index    parcel pixel offsets in the window
+#   stats    band statistics and histograms
+#   write    COPY of the results
+#   status   catalogue status updates
+#   cleanup  removing the VRTs
+#
+# and 'other' is the rest (extent query, index cache writes, glue). The
+# record of the image a thread works on is current for that thread, so the
+# extraction takes spans and counts where the work is done instead of
+# passing the record down the call chain. Spans nest, an inner span pauses
+# the outer one, so the stages add up to the image total. Without a current
+# record (timings off, coherenceMeans) spans and counts do nothing.
+# Finished records also go to the observers, e.g. utils/workerMetrics.
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import psycopg2
+
+STAGES = ['claim', 'paths', 'vrt', 'read', 'queued', 'parcels', 'decode',
+          'index', 'stats', 'write', 'status', 'cleanup']
+
+TABLE_SQL = """CREATE TABLE IF NOT EXISTS {} (obsid integer, reference text,
+    card text, res integer, worker text, status text, started timestamptz,
+    total_s real, stages jsonb, counts jsonb, peak_rss_mb real)"""
+
+current = threading.local()
+tablesChecked = set()
+# Callables of finished records, and the records of images in progress
+observers = []
+active = set()
+
+
+def resetPeak():
+    # Reset the resident set high-water mark to the current resident set.
+    # Linux only, elsewhere the peak is that of the process.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peakMB():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kB on Linux
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ImageTimings:
+
+    def __init__(self, card, res):
+        self.card = card
+        self.res = res
+        self.oid = None
+        self.reference = None
+        self.status = None
+        self.started = datetime.now(timezone.utc)
+        self.t0 = time.perf_counter()
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.counts = {}
+        # Open spans as [stage, start of the time not counted yet]
+        self.stack = []
+        self.handed = None
+
+    def record(self):
+        total = time.perf_counter() - self.t0
+        stages = {k: round(v, 4) for k, v in self.stages.items()}
+        stages['other'] = round(max(0.0, total - sum(self.stages.values())), 4)
+        return {'obsid': self.oid, 'reference': self.reference,
+                'card': self.card, 'res': self.res,
+                'worker': f"{socket.gethostname()}:{os.getpid()}",
+                'status': self.status, 'started': self.started.isoformat(),
+                'total_s': round(total, 4), 'stages': stages,
+                'counts': self.counts, 'peak_rss_mb': round(peakMB(), 1)}
+
+
+def start(card, res, session):
+    # A record for the next image, current for this thread, or None if
+    # neither timings_file nor timings_table is set and nothing observes
+    if not session.extraction('timings_file') and \
+            not session.extraction('timings_table') and not observers:
+        return None
+    # In pipeline mode the next image is read while this one is extracted.
+    # The peak is only reset between images, so that of overlapping images
+    # covers both.
+    if not active:
+        resetPeak()
+    timings = ImageTimings(card, res)
+    active.add(timings)
+    activate(timings)
+    return timings
+
+
+def activate(timings):
+    # Make timings (None for none) current for this thread, e.g. when the
+    # extraction thread takes over an image the reader thread read ahead
+    current.timings = timings
+
+
+def image(g):
+    # The claimed image of the current record
+    timings = getattr(current, 'timings', None)
+    if timings is not None:
+        timings.oid = int(g[0])
+        timings.reference = g[1]
+
+
+def handOff():
+    # The current record, no longer current for this thread, to be taken
+    # over by another thread with takeOver
+    timings = getattr(current, 'timings', None)
+    if timings is not None:
+        timings.handed = time.perf_counter()
+    activate(None)
+    return timings
+
+
+def discard(timings):
+    # Drop a record without writing it, e.g. of an image given back
+    active.discard(timings)
+
+
+def inProgress(now):
+    # (obsid, stage, seconds since the claim, seconds in the stage) of the
+    # claimed images in progress. Read by other threads, so the open span
+    # is copied before use.
+    images = []
+    for timings in list(active):
+        if timings.oid is None:
+            continue
+        stack = list(timings.stack)
+        if stack:
+            stage, since = stack[-1]
+        elif timings.handed is not None:
+            stage, since = 'queued', timings.handed
+        else:
+            stage, since = 'other', timings.t0
+        images.append((timings.oid, stage, now - timings.t0, now - since))
+    return images
+
+
+def takeOver(timings):
+    if timings is not None and timings.handed is not None:
+        timings.stages['queued'] += time.perf_counter() - timings.handed
+        timings.handed = None
+    activate(timings)
+
+
+@contextmanager
+def span(stage):
+    timings = getattr(current, 'timings', None)
+    if timings is None:
+        yield
+        return
+    now = time.perf_counter()
+    if timings.stack:
+        outer = timings.stack[-1]
+        timings.stages[outer[0]] += now - outer[1]
+    timings.stack.append([stage, now])
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        stage, t = timings.stack.pop()
+        timings.stages[stage] += now - t
+        if timings.stack:
+            timings.stack[-1][1] = now
+
+
+def count(key, n):
+    timings = getattr(current, 'timings', None)
+    if timings is not None:
+        timings.counts[key] = timings.counts.get(key, 0) + int(n)
+
+
+def imageStatus(oid, status):
+    # The last status set for the image of the current record
+    timings = getattr(current, 'timings', None)
+    if timings is not None and timings.oid == int(oid):
+        timings.status = status
+
+
+def insertRecord(record, table, session):
+    with session.connection('write') as conn:
+        if not conn:
+            print("No connection established")
+            return
+        try:
+            with conn.cursor() as curs:
+                if table not in tablesChecked:
+                    curs.execute(TABLE_SQL.format(table))
+                curs.execute(f"""INSERT INTO {table} VALUES (%s, %s, %s, %s,
+                    %s, %s, %s, %s, %s, %s, %s)""",
+                             (record['obsid'], record['reference'],
+                              record['card'], record['res'], record['worker'],
+                              record['status'], record['started'],
+                              record['total_s'], json.dumps(record['stages']),
+                              json.dumps(record['counts']),
+                              record['peak_rss_mb']))
+            conn.commit()
+            tablesChecked.add(table)
+        except psycopg2.DatabaseError as e:
+            print(e)
+            conn.rollback()
+
+
+def finish(session):
+    # Write the current record, if an image was claimed for it, and clear
+    # it for this thread
+    timings = getattr(current, 'timings', None)
+    activate(None)
+    discard(timings)
+    if timings is None or timings.oid is None:
+        return
+    record = timings.record()
+    for observe in observers:
+        observe(record)
+    path = session.extraction('timings_file')
+    if path:
+        # One write per line, so that the lines of workers sharing the file
+        # do not interleave
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    table = session.extraction('timings_table')
+    if table:
+        insertRecord(record, table, session)
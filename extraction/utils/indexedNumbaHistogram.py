@@ -1,8 +1,4 @@
-import io
-import sys
-
 import numpy as np
-import pandas as pd
 import psycopg2
 import psycopg2.extras
 
@@ -10,147 +6,183 @@ import json
 
 import rasterio
 
-from . import wkbReader
+from . import parcelIndex, parcelStore, resultWriter, bandReader, dbSession, imageTimings
+from .indexedNumbaWindowedRasterStats import fetchIndexBatches
 
 import numba
-
-@numba.njit()
-def chop(arr, amin, amax):
-    mask = np.zeros(arr.shape[0], dtype=np.int64) == 0
-    mask[np.where(np.logical_or(arr < amin, arr > amax))[0]] = False
-    return mask
-
-@numba.njit()
-def truncate(r, c, rmin, rmax, cmin, cmax):
-    rmask = chop(r, rmin, rmax)
-    r = r[rmask]
-    c = c[rmask]
-    cmask = chop(c, cmin, cmax)
-    return r[cmask], c[cmask]
-
-#@numba.njit()
-def getIndices(pulx, puly, prast, ulx, uly, dx, dims):
-    ind = prast[0]
-    drow = (uly - puly)/dx
-    dcol = (pulx - ulx)/dx
-    r,c = np.where(ind == 1)
-
-    return truncate(int(np.floor(drow)) - r, int(np.floor(dcol)) + c, 0, dims[1]-1, 0, dims[2]-1)
-
-#@numba.njit()
-def getHistogram(chunk):
-    return np.unique(chunk, return_counts=True)
-
-def indexRasterHistogram(refs):
+from numba import types
+
+from .kernelSignatures import BATCH_OFFSETS, PIXELS, array
+
+# Number of Sentinel-2 scene classification (SCL) classes
+SCL_CLASSES = 12
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def getClassCounts(band, offsets, pixels, counts):
+    # Fill the preallocated class counts (>= parcels, classes) for all
+    # parcels of a CSR batch, on all cores. band is the flattened class image,
+    # values outside the classes are not counted
+    nclasses = counts.shape[1]
+    for i in numba.prange(offsets.shape[0] - 1):
+        counts[i, :] = 0
+        for j in range(offsets[i], offsets[i + 1]):
+            v = band[pixels[j]]
+            if v >= 0 and v < nclasses:
+                counts[i, v] += 1
+
+# Signatures compiled ahead by warmupKernels.py
+SIGNATURES = [
+    (getClassCounts, [(array(types.uint8, 1), o, p, array(types.int64, 2))
+                      for o in BATCH_OFFSETS for p in PIXELS]),
+]
+
+def histJson(counts):
+    # JSON is very picky about numeric type!
+    return [json.dumps({str(k):int(c[k]) for k in np.flatnonzero(c)})
+            for c in counts]
+
+def openHistWriter(config, outconn):
+    # Histograms go either as JSON text into the hists table or as integer
+    # arrays of the class counts (pid, obsid, counts integer[]) into the hists
+    # array table
+    dbconfig = config['database']
+    try:
+        if config.get('extraction', {}).get('hists_format', 'json') == 'array':
+            return resultWriter.openWriter(
+                config, outconn, dbconfig['tables']['hists_array_table'],
+                ['pid', 'obsid', 'counts'], {'card': 's2'}, ['obsid'])
+        return resultWriter.openWriter(
+            config, outconn, dbconfig['tables']['hists_table'],
+            ['pid', 'obsid', 'hist'], {'card': 's2'}, ['obsid'])
+    except (ValueError, psycopg2.DatabaseError) as e:
+        print(e)
+        return None
+
+def writeClassCounts(writer, pids, obsid, counts):
+    # Skip parcels that only cover nodata (class 0)
+    keep = np.flatnonzero(counts[:, 1:].any(axis=1))
+    if len(keep) == 0:
+        return 0
+
+    if 'counts' in writer.columns:
+        return writer.write({'pid': pids[keep], 'obsid': obsid,
+                             'counts': counts[keep]})
+    return writer.write({'pid': pids[keep], 'obsid': obsid,
+                         'hist': histJson(counts[keep])})
+
+def indexRasterHistogram(refs, data=None, session=None):
     # the multiband image is expected as a VRT with single pixel spacing and projection
+    # data is the full image, if it was read ahead
+    # Returns the histograms written, False if the image or database is not
+    # usable, None if the copy of the histograms failed
     with rasterio.open(f"data/{refs[1]}.vrt") as src:
         profile = src.profile
         if profile['count']!= 1:
             print(f"Number of bands in VRT must be 1")
             return False
-        data = src.read()
         imgcrs = src.crs.to_epsg()
 
+    # 2. database configuration, set up once per run by the caller
+    if session is None:
+        session = dbSession.DbSession()
+    config = session.config
+    dbconfig = session.dbconfig
+
+    if data is None:
+        data = bandReader.readBands(f"data/{refs[1]}.vrt", None,
+                                    config.get('extraction', {}).get('read_threads', 1))
+
     dims = data.shape
     ulx = profile['transform'][2]
     uly = profile['transform'][5]
     dx = profile['transform'][0]
     nodata = profile['nodata']
 
-    # 2. database configuration parsing from json
-    with open('db_config.json', 'r') as f:
-        dbconfig = json.load(f)
-    dbconfig = dbconfig['database']
-
     # Input data base is postgis
-    connString = "host={} dbname={} user={} port={} password={}".format(\
-        dbconfig['connection']['host'], dbconfig['connection']['dbname'],\
-        dbconfig['connection']['dbuser'], dbconfig['connection']['port'],\
-        dbconfig['connection']['dbpasswd'])
-
-    inconn = psycopg2.connect(connString)
+    inconn = session.reader()
     if not inconn:
         print("No in connection established")
         return False
 
-    # we need a named cursor to be able to use fetchmany
-    incurs = inconn.cursor(name='fetch_raster_parcels', cursor_factory=psycopg2.extras.DictCursor)
-
     parcel_vector_table = f"{dbconfig['tables']['parcel_table']}"
     parcel_raster_table = f"{dbconfig['tables']['parcel_table']}_{imgcrs}_{int(np.round(dx))}_rast"
 
-    # Select the parcels in this image footprint, in the correct rasterized format
-    pidSql = f"with crs as (select srid from geometry_columns where f_table_name = %s and f_table_schema = %s) \
-    select pid, st_asbinary(rast) from {parcel_raster_table}, {parcel_vector_table} \
-    where pid = ogc_fid and wkb_geometry && \
-    st_transform(st_makeenvelope(%s, %s, %s, %s, %s), (select srid from crs))"
-
-    try:
-        incurs.execute(pidSql, (parcel_vector_table.split('.')[1], parcel_vector_table.split('.')[0], ulx, uly - dims[2]*dx, ulx + dims[1]*dx, uly, imgcrs))
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-        inconn.close()
-        return False
+    # The whole image is read, so the index is cached for the full grid
+    cachedir = config.get('extraction', {}).get('index_cache')
+    cachepath = None
+    builder = None
+    index = None
+    if cachedir:
+        with imageTimings.span('parcels'):
+            cachepath = parcelIndex.cachePath(
+                cachedir, inconn, parcel_raster_table, ulx, uly, dx, dims,
+                config.get('extraction', {}).get('index_cache_gb', 20))
+            if cachepath:
+                index = parcelIndex.loadIndex(cachepath)
+
+    incurs = None
+    store = parcelStore.openStore(config, parcel_raster_table)
+    if index is not None:
+        print(f"Parcel index loaded from {cachepath}")
+        batches = parcelIndex.batches(index, 1000)
+    elif store is not None:
+        if cachepath:
+            builder = parcelIndex.IndexBuilder(dims)
+        batches = parcelStore.storeBatches(store, ulx, uly, dx, dims, 1000,
+                                           builder)
+    else:
+        # we need a named cursor to be able to use fetchmany
+        incurs = inconn.cursor(name='fetch_raster_parcels', cursor_factory=psycopg2.extras.DictCursor)
+
+        # Select the parcels in this image footprint, in the correct rasterized format
+        pidSql = f"with crs as (select srid from geometry_columns where f_table_name = %s and f_table_schema = %s) \
+        select pid, st_asbinary(rast) from {parcel_raster_table}, {parcel_vector_table} \
+        where pid = ogc_fid and wkb_geometry && \
+        st_transform(st_makeenvelope(%s, %s, %s, %s, %s), (select srid from crs))"
+
+        try:
+            with imageTimings.span('parcels'):
+                incurs.execute(pidSql, (parcel_vector_table.split('.')[1], parcel_vector_table.split('.')[0], ulx, uly - dims[2]*dx, ulx + dims[1]*dx, uly, imgcrs))
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(error)
+            session.release(inconn)
+            return False
 
-    totalrows = 0
+        if cachepath:
+            builder = parcelIndex.IndexBuilder(dims)
+        batches = fetchIndexBatches(incurs, ulx, uly, dx, dims, 1000, builder)
 
-    outconn = psycopg2.connect(connString)
+    outconn = session.writer()
     if not outconn:
         print("No out connection established")
+        session.release(inconn)
         return False
 
+    flat = data.reshape(dims[0], dims[1] * dims[2])
+
+    writer = openHistWriter(config, outconn)
+    if writer is None:
+        session.release(inconn)
+        session.release(outconn)
+        return False
+
+    counts = np.zeros((1000, SCL_CLASSES), dtype=np.int64)
+
+    for pids, offsets, pixels in batches:
+        with imageTimings.span('stats'):
+            getClassCounts(flat[0], offsets, pixels, counts)
+        imageTimings.count('parcels', len(pids))
+        writeClassCounts(writer, pids, int(refs[0]), counts[:len(pids)])
+
+    totalrows = writer.close()
+
+    if builder is not None:
+        builder.save(cachepath)
 
-    while True:
-        outcurs = outconn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-
-        rowset = incurs.fetchmany(size=1000)
-        if not rowset:
-            break;
-
-        records = []
-        for r in rowset:
-            rast = r[1]
-
-            pulx, puly, prast = wkbReader.wkbImage(rast)
-
-            rows, cols = getIndices(pulx, puly, prast, ulx, uly, dx, dims)
-            
-            if len(rows)>0 or len(cols)>0:
-                record = {}
-                ref = refs[1]
-                record['pid'] = int(r[0])
-                record['obsid'] = int(refs[0])
-                histvals, histcounts = getHistogram(data[0, np.uint16(rows), np.uint16(cols)])
-                if not ((len(histvals) == 1) and (histvals[0] == 0)):
-                    dc = dict(zip(histvals, histcounts))
-                    # JSON is very picky about numeric type!
-                    dcst = {str(k):int(v) for k, v in dc.items()}
-
-                    if dc:
-                        record['hist'] = json.dumps(dcst)
-                        records.append(record)
-                    else:
-                        print("Empty dict")
-
-        insert_stmt = f"insert into {dbconfig['tables']['hists_table']}  (pid, obsid, hist) values (%(pid)s, %(obsid)s, %(hist)s);"
-
-        if len(records) > 0:
-            try:
-                psycopg2.extras.execute_batch(outcurs, insert_stmt, records)
-                outconn.commit()
-                totalrows += len(records)
-            except psycopg2.IntegrityError as e:
-                print("insert statement {} contains duplicate index".format(insert_stmt))
-            except:
-                #print(records)
-                print(sys.exc_info()[0])
-                sys.exit(1)
-
-            finally:
-                outcurs.close()
-
-    incurs.close()
-    inconn.close()
-    outconn.close()
-    print(f"{totalrows} processed")
+    if incurs is not None:
+        incurs.close()
+    session.release(inconn)
+    session.release(outconn)
+    if totalrows is not None:
+        print(f"{totalrows} processed")
     return totalrows
@@ -1,28 +1,31 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-import io
-import json
+import os
+import multiprocessing
+from multiprocessing import shared_memory
+
 import numba
 import rasterio
 import psycopg2
 import numpy as np
-import pandas as pd
 import psycopg2.extras
 from rasterio.windows import Window
-import psycopg2.extras as extras
 
-from . import wkbReader
+from numba import types
+
+from . import wkbReader, parcelIndex, parcelStore, resultWriter, readPlan, bandReader, dbSession, imageTimings
+from .kernelSignatures import BAND_TYPES, BATCH_OFFSETS, OFFSETS, PIXELS, DIMS, array
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def chop(arr, amin, amax):
     mask = np.zeros(arr.shape[0], dtype=np.int64) == 0
     mask[np.where(np.logical_or(arr < amin, arr > amax))[0]] = False
     return mask
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def truncate(r, c, rmin, rmax, cmin, cmax):
     rmask = chop(r, rmin, rmax)
     r = r[rmask]
@@ -30,20 +33,19 @@ def truncate(r, c, rmin, rmax, cmin, cmax):
     cmask = chop(c, cmin, cmax)
     return r[cmask], c[cmask]
 
-# @numba.njit()
-
-
-def getIndices(pulx, puly, prast, ulx, uly, dx, dims):
-    ind = prast[0]
+@numba.njit(cache=True)
+def getIndices(pulx, puly, mask, ulx, uly, dx, dims):
+    # mask is the first band of the parcel raster (prast[0] of wkbImage),
+    # dims the window shape as a tuple
     drow = (uly - puly) / dx
     dcol = (pulx - ulx) / dx
-    r, c = np.where(ind == 1)
+    r, c = np.where(mask == 1)
 
     return truncate(int(np.floor(drow)) - r, int(np.floor(
         dcol)) + c, 0, dims[1] - 1, 0, dims[2] - 1)
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def getStats(chunk, nodata, checked=False):
     # If this is from a subsequent band, zeros are already eliminated
     if checked:
@@ -65,7 +67,7 @@ def getStats(chunk, nodata, checked=False):
     return None
 
 
-@numba.njit()
+@numba.njit(cache=True)
 def getMeans(chunk, nodata, checked=False):
     # If this is from a subsequent band, zeros are already eliminated
     if checked:
@@ -83,60 +85,288 @@ def getMeans(chunk, nodata, checked=False):
     return None
 
 
-def indexRasterStats(oid, reference, bands, card):
-    # the multiband image is expected as a VRT with single pixel spacing and
-    # projection. First read only metadata so that we can set up windowed reads
-    with rasterio.open(f"data/{reference}.vrt") as src:
-        profile = src.profile
-        imgcrs = src.crs.to_epsg()
+@numba.njit(cache=True)
+def sortedPercentile(arr, q):
+    # Linear interpolation on an already sorted array, as np.percentile does
+    pos = (arr.shape[0] - 1) * q / 100.0
+    lo = int(np.floor(pos))
+    hi = min(lo + 1, arr.shape[0] - 1)
+    return arr[lo] + (arr[hi] - arr[lo]) * (pos - lo)
+
+
+@numba.njit(cache=True)
+def bandStats(flat, pixels, nodata, stats):
+    # Statistics for all bands of a parcel in one pass. flat is the window
+    # cube reshaped to (bands, rows * cols), pixels the flattened parcel
+    # indices. Fills stats (bands, 8) with count, mean, std, min, max, p25,
+    # p50, p75. Returns False if the first band contains nodata
+    nbands = flat.shape[0]
+    count = pixels.shape[0]
+    if count == 0:
+        return False
+
+    buf = np.empty(count, dtype=np.float64)
+    for b in range(nbands):
+        total = 0.0
+        for i in range(count):
+            v = np.float64(flat[b, pixels[i]])
+            buf[i] = v
+            total += v
+        buf.sort()
+
+        # Only the first band is checked for nodata, like getStats does
+        if b == 0 and (buf[0] == nodata or buf[count - 1] == nodata):
+            return False
+
+        mean = total / count
+        var = 0.0
+        for i in range(count):
+            var += (buf[i] - mean) * (buf[i] - mean)
+
+        stats[b, 0] = count
+        stats[b, 1] = mean
+        stats[b, 2] = np.sqrt(var / count)
+        stats[b, 3] = buf[0]
+        stats[b, 4] = buf[count - 1]
+        stats[b, 5] = sortedPercentile(buf, 25.0)
+        stats[b, 6] = sortedPercentile(buf, 50.0)
+        stats[b, 7] = sortedPercentile(buf, 75.0)
+    return True
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def getBatchStats(flat, offsets, pixels, nodata):
+    # bandStats for all parcels of a CSR batch, spread over all cores.
+    # Returns stats (parcels, bands, 8) and the parcels without nodata
+    n = offsets.shape[0] - 1
+    stats = np.zeros((n, flat.shape[0], 8), dtype=np.float64)
+    valid = np.zeros(n, dtype=np.bool_)
+    for i in numba.prange(n):
+        valid[i] = bandStats(flat, pixels[offsets[i]:offsets[i + 1]],
+                             nodata, stats[i])
+    return stats, valid
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def getBatchMeans(flat, offsets, pixels, nodata):
+    # getMeans on the first band for all parcels of a CSR batch. Returns
+    # counts, means and the parcels without nodata
+    n = offsets.shape[0] - 1
+    counts = np.zeros(n, dtype=np.int64)
+    means = np.zeros(n, dtype=np.float64)
+    valid = np.zeros(n, dtype=np.bool_)
+    for i in numba.prange(n):
+        a = offsets[i]
+        count = offsets[i + 1] - a
+        if count == 0:
+            continue
+        total = 0.0
+        dmin = np.inf
+        dmax = -np.inf
+        for j in range(a, a + count):
+            v = np.float64(flat[0, pixels[j]])
+            total += v
+            dmin = min(dmin, v)
+            dmax = max(dmax, v)
+        if dmin != nodata and dmax != nodata:
+            counts[i] = count
+            means[i] = total / count
+            valid[i] = True
+    return counts, means, valid
+
+
+@numba.njit(cache=True)
+def getLabelImage(offsets, pixels, npixels):
+    # Compose a CSR parcel index into a flattened int32 label image with the
+    # parcel position in the index, -1 where there is no parcel. Where
+    # parcel rasters overlap the parcel later in the index wins.
+    labels = np.full(npixels, -1, dtype=np.int32)
+    for i in range(offsets.shape[0] - 1):
+        for j in range(offsets[i], offsets[i + 1]):
+            labels[pixels[j]] = i
+    return labels
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def getLabelStats(flat, labels, nparcels, nodata):
+    # Statistics for all parcels of a label image, as getBatchStats. Counts,
+    # sums, min and max come from one linear scan per band, percentiles and
+    # std from the band values sorted by label.
+    nbands = flat.shape[0]
+    counts = np.zeros(nparcels, dtype=np.int64)
+    for p in range(labels.shape[0]):
+        if labels[p] >= 0:
+            counts[labels[p]] += 1
+
+    # Counting sort of the pixel positions by label
+    starts = np.zeros(nparcels + 1, dtype=np.int64)
+    starts[1:] = np.cumsum(counts)
+    fill = starts[:-1].copy()
+    order = np.empty(starts[nparcels], dtype=np.int64)
+    for p in range(labels.shape[0]):
+        l = labels[p]
+        if l >= 0:
+            order[fill[l]] = p
+            fill[l] += 1
+
+    stats = np.zeros((nparcels, nbands, 8), dtype=np.float64)
+    valid = counts > 0
+    vals = np.empty(order.shape[0], dtype=np.float64)
+    for b in range(nbands):
+        sums = np.zeros(nparcels, dtype=np.float64)
+        mins = np.full(nparcels, np.inf)
+        maxs = np.full(nparcels, -np.inf)
+        for p in range(labels.shape[0]):
+            l = labels[p]
+            if l >= 0:
+                v = np.float64(flat[b, p])
+                sums[l] += v
+                mins[l] = min(mins[l], v)
+                maxs[l] = max(maxs[l], v)
+
+        for k in numba.prange(order.shape[0]):
+            vals[k] = flat[b, order[k]]
+
+        for i in numba.prange(nparcels):
+            if not valid[i]:
+                continue
+            # Only the first band is checked for nodata, like getStats does
+            if b == 0 and (mins[i] == nodata or maxs[i] == nodata):
+                valid[i] = False
+                continue
+            seg = vals[starts[i]:starts[i + 1]]
+            seg.sort()
+            mean = sums[i] / counts[i]
+            var = 0.0
+            for v in seg:
+                var += (v - mean) * (v - mean)
+            stats[i, b, 0] = counts[i]
+            stats[i, b, 1] = mean
+            stats[i, b, 2] = np.sqrt(var / counts[i])
+            stats[i, b, 3] = mins[i]
+            stats[i, b, 4] = maxs[i]
+            stats[i, b, 5] = sortedPercentile(seg, 25.0)
+            stats[i, b, 6] = sortedPercentile(seg, 50.0)
+            stats[i, b, 7] = sortedPercentile(seg, 75.0)
+    return stats, valid
+
+
+def labelStatsBatches(flat, index, dims, labelpath, size):
+    # Label image engine: compose (or load) the label image for the index,
+    # compute all parcel statistics at once and yield them in batches
+    labels = parcelIndex.loadLabels(labelpath) if labelpath else None
+    if labels is None:
+        with imageTimings.span('index'):
+            labels = getLabelImage(index[1], index[2], dims[1] * dims[2])
+        if labelpath:
+            parcelIndex.saveLabels(labelpath, labels)
+    else:
+        print(f"Label image loaded from {labelpath}")
+
+    pids = index[0]
+    with imageTimings.span('stats'):
+        stats, valid = getLabelStats(flat, labels, len(pids), 0.0)
+    imageTimings.count('parcels', len(pids))
+    for a in range(0, len(pids), size):
+        yield pids[a:a + size], stats[a:a + size], valid[a:a + size]
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def getBatchIndices(ipx, ipy, widths, heights, offsets, masks, ulx, uly, dx,
+                    nrows, ncols):
+    # getIndices for all parcel masks of a wkbBatch, as a CSR index of
+    # flattened window offsets. Returns per parcel pixel counts, offsets and
+    # the pixels, in the same order as the masks
+    n = offsets.shape[0] - 1
+    counts = np.zeros(n, dtype=np.int64)
+    for i in numba.prange(n):
+        drow = int(np.floor((uly - ipy[i]) / dx))
+        dcol = int(np.floor((ipx[i] - ulx) / dx))
+        for j in range(offsets[i + 1] - offsets[i]):
+            if masks[offsets[i] + j] == 1:
+                row = drow - j // widths[i]
+                col = dcol + j % widths[i]
+                if row >= 0 and row < nrows and col >= 0 and col < ncols:
+                    counts[i] += 1
+
+    poffsets = np.zeros(n + 1, dtype=np.int64)
+    poffsets[1:] = np.cumsum(counts)
+    pixels = np.empty(poffsets[n], dtype=np.int64)
+    for i in numba.prange(n):
+        drow = int(np.floor((uly - ipy[i]) / dx))
+        dcol = int(np.floor((ipx[i] - ulx) / dx))
+        k = poffsets[i]
+        for j in range(offsets[i + 1] - offsets[i]):
+            if masks[offsets[i] + j] == 1:
+                row = drow - j // widths[i]
+                col = dcol + j % widths[i]
+                if row >= 0 and row < nrows and col >= 0 and col < ncols:
+                    pixels[k] = row * ncols + col
+                    k += 1
+    return counts, poffsets, pixels
+
+
+# Signatures compiled ahead by warmupKernels.py
+SIGNATURES = [
+    (getIndices, [(types.float64, types.float64, array(types.uint8, 2, ro),
+                   types.float64, types.float64, types.float64, DIMS)
+                  for ro in [False, True]]),
+    (getBatchStats, [(array(b, 2), o, p, types.float64) for b in BAND_TYPES
+                     for o in BATCH_OFFSETS for p in PIXELS]),
+    (getBatchMeans, [(array(b, 2), o, p, types.float64) for b in BAND_TYPES
+                     for o in BATCH_OFFSETS for p in PIXELS]),
+    (getLabelImage, [(o, p, types.int64) for o in OFFSETS for p in PIXELS]),
+    (getLabelStats, [(array(b, 2), array(types.int32, 1, ro), types.int64,
+                      types.float64) for b in BAND_TYPES
+                     for ro in [False, True]]),
+    (getBatchIndices, [(array(types.float64, 1), array(types.float64, 1),
+                        array(types.int64, 1), array(types.int64, 1),
+                        array(types.int64, 1), array(types.uint8, 1),
+                        types.float64, types.float64, types.float64,
+                        types.int64, types.int64)]),
+]
+
+
+def indexRowset(rowset, ulx, uly, dx, dims):
+    # Decode a fetchmany rowset of (pid, wkb) into a CSR parcel index of
+    # flattened window offsets, skipping parcels outside the window
+    with imageTimings.span('decode'):
+        pids, ipx, ipy, widths, heights, offsets, masks = wkbReader.wkbBatch(rowset)
+    with imageTimings.span('index'):
+        counts, poffsets, pixels = getBatchIndices(
+            ipx, ipy, widths, heights, offsets, masks, float(ulx), float(uly),
+            float(dx), dims[1], dims[2])
+
+    keep = counts > 0
+    poffsets = np.concatenate(([0], np.cumsum(counts[keep])))
+    return (pids[keep], poffsets,
+            pixels.astype(parcelIndex.pixelType(dims)))
+
+
+def fetchIndexBatches(incurs, ulx, uly, dx, dims, size, builder=None):
+    # Yield CSR batches from the parcel raster query, optionally collecting
+    # them for the parcel index cache
+    while True:
+        with imageTimings.span('parcels'):
+            rowset = incurs.fetchmany(size=size)
+        if not rowset:
+            break
+        imageTimings.count('parcel_bytes', sum(len(r[1]) for r in rowset))
+        batch = indexRowset(rowset, ulx, uly, dx, dims)
+        if builder is not None:
+            builder.append(*batch)
+        yield batch
+
 
+def clipWindow(pclext, profile):
+    # Read window (w0x, w0y, wdx, wdy, ulx, uly) covering the extent
+    # (ulx, uly, lrx, lry) clipped to the image
     imgulx = profile['transform'][2]
     imguly = profile['transform'][5]
-    # dx is needed to select the correct rasterized parcels and band resolutions
     dx = int(np.round(profile['transform'][0]))
-
     imgwidth = profile['width']
     imgheight = profile['height']
-    print(imgulx, imguly)
-    print(f"full image dimension {imgwidth} * {imgheight} requires \
-          {4 * imgwidth * imgheight / (1024 * 1024)} MB")
-
-    # 2. database configuration parsing from json
-    with open('db_config.json', 'r') as f:
-        dbconfig = json.load(f)
-    dbconfig = dbconfig['database']
 
-    # Input data base is postgis
-    connString = "host={} dbname={} user={} port={} password={}".format(
-        dbconfig['connection']['host'], dbconfig['connection']['dbname'],
-        dbconfig['connection']['dbuser'], dbconfig['connection']['port'],
-        dbconfig['connection']['dbpasswd'])
-
-    inconn = psycopg2.connect(connString)
-    if not inconn:
-        print("No in connection established")
-        return "No in db"
-
-    incurs = inconn.cursor()
-
-    catalog_table = f"{dbconfig['tables']['catalog_table']}"
-    parcel_vector_table = f"{dbconfig['tables']['parcel_table']}"
-    parcel_raster_table = f"{dbconfig['tables']['parcel_table']}_{imgcrs}_{dx}_rast"
-
-    # Select the extent of the parcel selection in this image footprint
-    extSql = f"""with ext as (select st_extent(st_transform(wkb_geometry, %s))
-    bbox from aois where name = %s) select st_xmin(bbox) ulx, st_ymax(bbox)
-    uly, st_xmax(bbox) lrx, st_ymin(bbox) lry from ext
-    """
-
-    try:
-        incurs.execute(extSql, (imgcrs, dbconfig['args']['name']))
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-        inconn.close()
-        return "No extent"
-
-    pclext = incurs.fetchone()
     # print(pclext)
     wulx = pclext[0]
     if wulx < imgulx:
@@ -163,133 +393,221 @@ def indexRasterStats(oid, reference, bands, card):
     wdx = int(np.ceil((wlrx - wulx) / dx))
     wdy = int(np.ceil((wuly - wlry) / dx))
 
-    print(w0x, w0y, wdx, wdy)
+    return w0x, w0y, wdx, wdy, wulx, wuly
 
-    # Now we're ready to do a windowed read
-    with rasterio.open(f"data/{reference}.vrt") as src:
-        try:
-            data = src.read(window=Window(w0x, w0y, wdx, wdy))
-        except (Exception, rasterio.errors.RasterioIOError) as e:
-            # This likely occurs only if there is a memory error
-            print(e)
-            inconn.close()
-            return "Rio error"
 
-    dims = data.shape
-    print(f"partial image dimension {dims[1]}*{dims[2]} requires",
-          f"{4*dims[1]*dims[2]/(1024*1024)} MB",
-          f"({100.0*dims[1]*dims[2]/(imgheight*imgwidth)})")
+def aoiWindow(incurs, aoi, imgcrs, profile):
+    # Read window covering the extent of the AOI clipped to the image, or
+    # None if the extent cannot be selected
+    extSql = """with ext as (select st_extent(st_transform(wkb_geometry, %s))
+    bbox from aois where name = %s) select st_xmin(bbox) ulx, st_ymax(bbox)
+    uly, st_xmax(bbox) lrx, st_ymin(bbox) lry from ext
+    """
 
-    ulx = wulx
-    uly = wuly
+    try:
+        incurs.execute(extSql, (imgcrs, aoi))
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return None
 
-    # Close cursor to allow for named cursor
-    incurs.close()
+    return clipWindow(incurs.fetchone(), profile)
+
+
+def parcelExtentWindow(incurs, parcel_vector_table, imgcrs, profile):
+    # Read window covering the extent of the parcel table in the image
+    # projection clipped to the image, or None if the extent cannot be
+    # selected
+    extSql = f"""WITH ext as (
+        SELECT st_transform(st_setsrid(st_extent(wkb_geometry),
+        (SELECT distinct st_srid(wkb_geometry)
+        FROM {parcel_vector_table})), {imgcrs}) bbox FROM {parcel_vector_table})
+        SELECT st_xmin(bbox) ulx, st_ymax(bbox) uly, st_xmax(bbox) lrx,
+            st_ymin(bbox) lry FROM ext;"""
+
+    try:
+        incurs.execute(extSql)
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return None
+
+    return clipWindow(incurs.fetchone(), profile)
+
+
+def prefetchWindow(vrt, session):
+    # The AOI window of vrt and its data, read ahead of indexRasterStats (or
+    # extractS2) while another image is extracted. Returns (window, data) or
+    # an error status string.
+    try:
+        with rasterio.open(vrt) as src:
+            profile = src.profile
+            imgcrs = src.crs.to_epsg()
+    except rasterio.errors.RasterioIOError as e:
+        print(e)
+        return "Rio error"
+
+    dbconfig = session.dbconfig
+    with session.connection('read') as inconn:
+        if not inconn:
+            print("No in connection established")
+            return "No in db"
+        with inconn.cursor() as incurs:
+            window = aoiWindow(incurs, dbconfig['args']['name'], imgcrs,
+                               profile)
+    if window is None:
+        return "No extent"
+
+    try:
+        data = bandReader.readBands(vrt, Window(*window[:4]),
+                                    session.extraction('read_threads', 1))
+    except (Exception, rasterio.errors.RasterioIOError) as e:
+        # This likely occurs only if there is a memory error
+        print(e)
+        return "Rio error"
+    return window, data
+
+
+def parcelIndexSource(config, inconn, oid, imgcrs, dx, window, dims, size):
+    # Parcel index for the read window, as (index, batches, builder,
+    # cachepath). The index is loaded from the cache if there, else batches
+    # stream it from the parcel raster table and builder, if caching, collects
+    # it. Returns an error status string if the parcel query fails.
+    dbconfig = config['database']
+    catalog_table = f"{dbconfig['tables']['catalog_table']}"
+    parcel_vector_table = f"{dbconfig['tables']['parcel_table']}"
+    parcel_raster_table = f"{dbconfig['tables']['parcel_table']}_{imgcrs}_{dx}_rast"
+    ulx, uly = window[4:]
+
+    # The parcel index only depends on the grid and window, so it may
+    # already be cached from an earlier acquisition on the same grid
+    cachedir = config.get('extraction', {}).get('index_cache')
+    cachepath = None
+    if cachedir:
+        with imageTimings.span('parcels'):
+            cachepath = parcelIndex.cachePath(
+                cachedir, inconn, parcel_raster_table, ulx, uly, dx, dims,
+                config.get('extraction', {}).get('index_cache_gb', 20))
+            index = parcelIndex.loadIndex(cachepath) if cachepath else None
+        if index is not None:
+            print(f"Parcel index loaded from {cachepath}")
+            return index, parcelIndex.batches(index, size), None, cachepath
+
+    # Parcels in the window are read from the local parcel store, if the
+    # parcel raster table was exported
+    store = parcelStore.openStore(config, parcel_raster_table)
+    if store is not None:
+        builder = parcelIndex.IndexBuilder(dims) if cachepath else None
+        return (None, parcelStore.storeBatches(store, ulx, uly, dx, dims,
+                                               size, builder),
+                builder, cachepath)
 
     # we need a named cursor to be able to use fetchmany
     incurs = inconn.cursor(name='fetch_raster_parcels',
                            cursor_factory=psycopg2.extras.DictCursor)
 
-    # Select parcels in this image footprint, in the correct rasterized format
-    pidSql = f"""WITH crs As (SELECT srid FROM geometry_columns
+    # Select parcels in this image footprint, in the correct rasterized
+    # format. A cached index must be valid for every acquisition on this
+    # grid, so it is built from all parcels in the window instead.
+    builder = None
+    if cachepath:
+        pidSql = f"""WITH crs As (SELECT srid FROM geometry_columns
+            WHERE f_table_name = %s and f_table_schema = %s)
+        SELECT pid, st_asbinary(rast)
+            FROM {parcel_raster_table}, {parcel_vector_table}
+            WHERE pid = ogc_fid and wkb_geometry && st_transform(
+                st_makeenvelope(%s, %s, %s, %s, %s), (SELECT srid FROM crs))"""
+        pidArgs = (parcel_vector_table.split('.')[1],
+                   parcel_vector_table.split('.')[0],
+                   ulx, uly - dims[1] * dx, ulx + dims[2] * dx, uly, imgcrs)
+        builder = parcelIndex.IndexBuilder(dims)
+    else:
+        pidSql = f"""WITH crs As (SELECT srid FROM geometry_columns
             WHERE f_table_name = %s and f_table_schema = %s)
         SELECT pid, st_asbinary(rast)
             FROM {parcel_raster_table}, {parcel_vector_table}
             WHERE pid = ogc_fid and wkb_geometry && st_transform((
                 SELECT footprint FROM {catalog_table} WHERE id = %s),
                 (SELECT srid FROM crs))"""
+        pidArgs = (parcel_vector_table.split('.')[1],
+                   parcel_vector_table.split('.')[0], oid)
 
     try:
-        incurs.execute(pidSql, (parcel_vector_table.split(
-            '.')[1], parcel_vector_table.split('.')[0], oid))
+        with imageTimings.span('parcels'):
+            incurs.execute(pidSql, pidArgs)
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-        inconn.close()
         return "Parcel SQL"
 
-    totalrows = 0
+    return (None, fetchIndexBatches(incurs, ulx, uly, dx, dims, size, builder),
+            builder, cachepath)
 
-    outconn = psycopg2.connect(connString)
-    if not outconn:
-        print("No out connection established")
-        return "No out db"
 
-    # band renaming for S1
-    if card == 'bs':
-        bands = [b + 'b' for b in bands]
-    elif card == 'c6':
-        bands = [b + 'c' for b in bands]
-    elif card == 'c1':
-        bands = [b + 'c' for b in bands]
-
-    while True:
-        rowset = incurs.fetchmany(size=10000)
-        if not rowset:
-            break
-
-        tseries = []
-        for r in rowset:
-            rast = r[1]
-
-            pulx, puly, prast = wkbReader.wkbImage(rast)
-
-            rows, cols = getIndices(pulx, puly, prast, ulx, uly, dx, dims)
-
-            if len(rows) > 0 or len(cols) > 0:
-                b0 = getStats(data[0, np.uint16(rows), np.uint16(cols)], 0.0)
-                if b0:
-                    tseries.append((r[0], bands[0], *b0))
-                    for b in range(1, len(bands)):
-                        bN = getStats(data[b, np.uint16(rows),
-                                           np.uint16(cols)], 0.0, True)
-                        tseries.append((r[0], bands[b], *bN))
-
-        # Prepare as pandas DataFrame and copy into database
-        df = pd.DataFrame(tseries, columns=[
-                          'pid', 'band', 'count', 'mean', 'std',
-                          'min', 'max', 'p25', 'p50', 'p75'])
-        df['obsid'] = oid
-
-        if len(df) > 0:
-            df.dropna(inplace=True)
-            # print(df)
-            totalrows += len(df)
-            if len(df.values) > 0:
-                s_buf = io.StringIO()
-                df.to_csv(s_buf, header=False, index=False, sep=',')
-                s_buf.seek(0)
-                outcurs = outconn.cursor()
-                tuples = [tuple(x) for x in df.to_numpy()]
-                df_columns = ','.join(list(df.columns))
-                query = "INSERT INTO %s(%s) VALUES %%s" % (
-                    dbconfig['tables']['sigs_table'], df_columns)
-                try:
-                    extras.execute_values(outcurs, query, tuples)
-                    outconn.commit()
-                except psycopg2.IntegrityError as e:
-                    print("IntegrityError", e)
-                except psycopg2.DatabaseError as e:
-                    print("DatabaseError", e)
-                except Exception as e:
-                    print(e)
-                finally:
-                    outcurs.close()
-
-    incurs.close()
-    inconn.close()
-    outconn.close()
-
-    print(f"{totalrows} processed")
-    if totalrows == 0:
-        return "No parcels"
+def completeIndex(source, dims):
+    # The complete index of a parcelIndexSource, fetching (and caching) all
+    # batches if it was not loaded from the cache
+    index, batches, builder, cachepath = source
+    if index is not None:
+        return index
+    if builder is None:
+        builder = parcelIndex.IndexBuilder(dims)
+        for batch in batches:
+            builder.append(*batch)
     else:
-        return "extracted"
-
-
-def indexRasterMeans(v):
-    # the single band image is expected as a VRT with single pixel spacing and
+        for batch in batches:
+            pass
+        if cachepath:
+            builder.save(cachepath)
+    return builder.index()
+
+
+def planStats(vrt, window, index, plan, threads=1):
+    # Statistics for the parcels of each part of a read plan, reading only
+    # that part of the window
+    pids, offsets, pixels = index
+    offsets = np.asarray(offsets)
+    pixels = np.asarray(pixels)
+    for row0, col0, height, width, sel in plan:
+        data = bandReader.readBands(
+            vrt, Window(window[0] + col0, window[1] + row0, width, height),
+            threads)
+        flat = data.reshape(data.shape[0], height * width)
+        with imageTimings.span('index'):
+            soffsets, spixels = readPlan.getSubIndex(
+                offsets, pixels, sel, window[2], row0, col0, width)
+        with imageTimings.span('stats'):
+            stats, valid = getBatchStats(flat, soffsets, spixels, 0.0)
+        imageTimings.count('parcels', len(sel))
+        yield pids[sel], stats, valid
+
+
+def batchStats(flat, batches):
+    # Statistics per batch of the parcel index
+    for pids, offsets, pixels in batches:
+        with imageTimings.span('stats'):
+            stats, valid = getBatchStats(flat, offsets, pixels, 0.0)
+        imageTimings.count('parcels', len(pids))
+        yield pids, stats, valid
+
+
+def writeBandStats(writer, pids, stats, valid, bands, oid):
+    # Write the statistics of the valid parcels, one row per parcel and band
+    totalrows = 0
+    sel = np.flatnonzero(valid)
+    for b in range(len(bands)):
+        bstats = stats[sel, b]
+        totalrows += writer.write({
+            'pid': pids[sel], 'band': bands[b], 'count': bstats[:, 0],
+            'mean': bstats[:, 1], 'std': bstats[:, 2], 'min': bstats[:, 3],
+            'max': bstats[:, 4], 'p25': bstats[:, 5], 'p50': bstats[:, 6],
+            'p75': bstats[:, 7], 'obsid': oid})
+    return totalrows
+
+
+def indexRasterStats(oid, reference, bands, card, prefetched=None,
+                     session=None):
+    # the multiband image is expected as a VRT with single pixel spacing and
     # projection. First read only metadata so that we can set up windowed reads
-    with rasterio.open(v) as src:
+    # prefetched is the (window, data) of prefetchWindow, if read ahead
+    with rasterio.open(f"data/{reference}.vrt") as src:
         profile = src.profile
         imgcrs = src.crs.to_epsg()
 
@@ -301,169 +619,462 @@ def indexRasterMeans(v):
     imgwidth = profile['width']
     imgheight = profile['height']
     print(imgulx, imguly)
-    print(f"full image dimension {imgwidth}*{imgheight}",
-          f"requires {4*imgwidth*imgheight/(1024*1024)} MB")
+    print(f"full image dimension {imgwidth} * {imgheight} requires \
+          {4 * imgwidth * imgheight / (1024 * 1024)} MB")
 
-    # 2. database configuration parsing from json
-    with open('db_config.json', 'r') as f:
-        dbconfig = json.load(f)
-    dbconfig = dbconfig['database']
+    # 2. database configuration, set up once per run by the caller
+    if session is None:
+        session = dbSession.DbSession()
+    config = session.config
+    dbconfig = session.dbconfig
 
     # Input data base is postgis
-    connString = "host={} dbname={} user={} port={} password={}".format(
-        dbconfig['connection']['host'], dbconfig['connection']['dbname'],
-        dbconfig['connection']['dbuser'], dbconfig['connection']['port'],
-        dbconfig['connection']['dbpasswd'])
-
-    inconn = psycopg2.connect(connString)
+    inconn = session.reader()
     if not inconn:
         print("No in connection established")
         return "No in db"
 
-    incurs = inconn.cursor()
+    if prefetched is None:
+        incurs = inconn.cursor()
 
-    parcel_vector_table = f"{dbconfig['tables']['parcel_table']}"
-    parcel_raster_table = f"{dbconfig['tables']['parcel_table']}_{imgcrs}_{dx}_rast"
+        # Select the extent of the parcel selection in this image footprint
+        window = aoiWindow(incurs, dbconfig['args']['name'], imgcrs, profile)
+        if window is None:
+            session.release(inconn)
+            return "No extent"
 
-    # Select the extent of the parcel selection in this image footprint and
-    # projection
-    extSql = f"""WITH ext as (
-        SELECT st_transform(st_setsrid(st_extent(wkb_geometry),
-        (SELECT distinct st_srid(wkb_geometry)
-        FROM {parcel_vector_table})), {imgcrs}) bbox FROM {parcel_vector_table})
-        SELECT st_xmin(bbox) ulx, st_ymax(bbox) uly, st_xmax(bbox) lrx,
-            st_ymin(bbox) lry FROM ext;"""
+        # Close cursor to allow for named cursor
+        incurs.close()
+    else:
+        window, data = prefetched
+
+    w0x, w0y, wdx, wdy = window[:4]
+    print(w0x, w0y, wdx, wdy)
+
+    # With a read budget, the window is read in strips that fit in it,
+    # instead of all at once. With sparse blocks, only the sub-windows
+    # around the image blocks that hold parcels are read.
+    budget = config.get('extraction', {}).get('read_budget_mb')
+    sparse = config.get('extraction', {}).get('sparse_block')
+    engine = config.get('extraction', {}).get('engine', 'parcel')
+    if (budget or sparse) and engine == 'parcel' and prefetched is None:
+        dims = (profile['count'], wdy, wdx)
+        source = parcelIndexSource(config, inconn, oid, imgcrs, dx, window,
+                                   dims, 10000)
+        if isinstance(source, str):
+            session.release(inconn)
+            return source
+        index = completeIndex(source, dims)
+        builder = None
+        height = None
+        if budget:
+            height = readPlan.stripHeight(budget, dims,
+                                          np.dtype(profile['dtype']).itemsize)
+        if sparse:
+            plan = readPlan.sparsePlan(index, dims, window, sparse, height)
+            print(f"window read in {len(plan)} sub-windows covering",
+                  f"{100.0 * sum(p[2] * p[3] for p in plan) / (wdx * wdy):.1f}%",
+                  "of it")
+        else:
+            plan = readPlan.stripPlan(index, dims, height)
+            print(f"window read in {len(plan)} strips of {height} rows or more")
+        results = planStats(f"data/{reference}.vrt", window, index, plan,
+                            config.get('extraction', {}).get('read_threads', 1))
+    else:
+        # Now we're ready to do a windowed read, bands in parallel
+        if prefetched is None:
+            try:
+                data = bandReader.readBands(
+                    f"data/{reference}.vrt", Window(w0x, w0y, wdx, wdy),
+                    config.get('extraction', {}).get('read_threads', 1))
+            except (Exception, rasterio.errors.RasterioIOError) as e:
+                # This likely occurs only if there is a memory error
+                print(e)
+                session.release(inconn)
+                return "Rio error"
+
+        dims = data.shape
+        print(f"partial image dimension {dims[1]}*{dims[2]} requires",
+              f"{4*dims[1]*dims[2]/(1024*1024)} MB",
+              f"({100.0*dims[1]*dims[2]/(imgheight*imgwidth)})")
+
+        # Bands by flattened pixel offset, a view on data for the stats kernel
+        flat = data.reshape(dims[0], dims[1] * dims[2])
+
+        source = parcelIndexSource(config, inconn, oid, imgcrs, dx, window,
+                                   dims, 10000)
+        if isinstance(source, str):
+            session.release(inconn)
+            return source
+        index, batches, builder, cachepath = source
+
+        # The label image engine needs the complete index up front, the
+        # parcel engine computes statistics per fetched batch
+        if engine == 'label':
+            index = completeIndex(source, dims)
+            builder = None
+            results = labelStatsBatches(flat, index, dims, cachepath, 10000)
+        else:
+            results = batchStats(flat, batches)
+
+    outconn = session.writer()
+    if not outconn:
+        print("No out connection established")
+        session.release(inconn)
+        return "No out db"
+
+    # band renaming for S1
+    if card == 'bs':
+        bands = [b + 'b' for b in bands]
+    elif card == 'c6':
+        bands = [b + 'c' for b in bands]
+    elif card == 'c1':
+        bands = [b + 'c' for b in bands]
 
     try:
-        incurs.execute(extSql)
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-        inconn.close()
-        return "No extent"
+        writer = resultWriter.openWriter(
+            config, outconn, dbconfig['tables']['sigs_table'],
+            ['pid', 'band', 'count', 'mean', 'std', 'min', 'max', 'p25',
+             'p50', 'p75', 'obsid'], {'card': card}, ['obsid'])
+    except (ValueError, psycopg2.DatabaseError) as e:
+        print(e)
+        session.release(inconn)
+        session.release(outconn)
+        return "No out table"
+
+    # Strips and sub-windows are read while the results are written
+    try:
+        for pids, stats, valid in results:
+            writeBandStats(writer, pids, stats, valid, bands, oid)
+        totalrows = writer.close()
+    except (Exception, rasterio.errors.RasterioIOError) as e:
+        # This likely occurs only if there is a memory error
+        print(e)
+        writer.close()
+        return "Rio error"
+    finally:
+        session.release(inconn)
+        session.release(outconn)
+
+    if builder is not None:
+        builder.save(source[3])
+
+    if totalrows is None:
+        return "Copy error"
+    print(f"{totalrows} processed")
+    if totalrows == 0:
+        return "No parcels"
+    else:
+        return "extracted"
 
-    pclext = incurs.fetchone()
-    # print(pclext)
-    wulx = pclext[0]
-    if wulx < imgulx:
-        wulx = imgulx
 
-    wuly = pclext[1]
-    if wuly > imguly:
-        wuly = imguly
+def meansIndexSource(config, inconn, parcel_raster_table, dx, window, dims,
+                     size):
+    # Parcel index of all parcel rasters in the read window of
+    # indexRasterMeans, as (index, batches, builder, cachepath) like
+    # parcelIndexSource, or an error status string
+    ulx, uly = window[4:]
+
+    # The parcel index may already be cached from an earlier VRT on this grid
+    cachedir = config.get('extraction', {}).get('index_cache')
+    cachepath = None
+    builder = None
+    if cachedir:
+        cachepath = parcelIndex.cachePath(
+            cachedir, inconn, parcel_raster_table, ulx, uly, dx, dims,
+            config.get('extraction', {}).get('index_cache_gb', 20))
+    if cachepath:
+        index = parcelIndex.loadIndex(cachepath)
+        if index is not None:
+            print(f"Parcel index loaded from {cachepath}")
+            return index, parcelIndex.batches(index, size), None, cachepath
+        builder = parcelIndex.IndexBuilder(dims)
+
+    store = parcelStore.openStore(config, parcel_raster_table)
+    if store is not None:
+        return (None, parcelStore.storeBatches(store, ulx, uly, dx, dims,
+                                               size, builder),
+                builder, cachepath)
 
-    wlrx = pclext[2]
+    # we need a named cursor to be able to use fetchmany
+    incurs = inconn.cursor(name='fetch_raster_parcels',
+                           cursor_factory=psycopg2.extras.DictCursor)
 
-    if wlrx > imgulx + imgwidth * dx:
-        wlrx = imgulx + imgwidth * dx
+    # Select parcels in this image footprint, in the correct rasterized
+    # format
+    pidSql = f"""select pid, st_asbinary(rast) from {parcel_raster_table}"""
 
-    wlry = pclext[3]
+    try:
+        incurs.execute(pidSql)
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return "Parcel SQL"
 
-    if wlry < imguly - imgheight * dx:
-        wlry = imguly - imgheight * dx
+    return (None, fetchIndexBatches(incurs, ulx, uly, dx, dims, size, builder),
+            builder, cachepath)
 
-    # print(wulx, wuly, wlrx, wlry)
 
-    w0x = int(np.floor((wulx - imgulx) / dx))
-    w0y = int(np.floor((imguly - wuly) / dx))
-    wdx = int(np.ceil((wlrx - wulx) / dx))
-    wdy = int(np.ceil((wuly - wlry) / dx))
+def meansWindow(v, session, inconn):
+    # Profile, EPSG, dx and read window of the single band VRT v for the
+    # extent of the parcel table, or an error status string
+    with rasterio.open(v) as src:
+        profile = src.profile
+        imgcrs = src.crs.to_epsg()
 
-    print(w0x, w0y, wdx, wdy)
+    # dx is needed to select the correct rasterized parcels and band resolutions
+    dx = int(np.round(profile['transform'][0]))
 
-    # Now we're ready to do a windowed read
+    print(profile['transform'][2], profile['transform'][5])
+    print(f"full image dimension {profile['width']}*{profile['height']}",
+          f"requires {4*profile['width']*profile['height']/(1024*1024)} MB")
+
+    # Select the extent of the parcel selection in this image footprint and
+    # projection
+    incurs = inconn.cursor()
+    window = parcelExtentWindow(
+        incurs, session.dbconfig['tables']['parcel_table'], imgcrs, profile)
+    incurs.close()
+    if window is None:
+        return "No extent"
+    print(*window[:4])
+    return profile, imgcrs, dx, window
+
+
+def readMeansWindow(v, window):
+    # Single band window read, or an error status string
     with rasterio.open(v) as src:
         try:
-            data = src.read(window=Window(w0x, w0y, wdx, wdy))
+            return src.read(window=Window(*window[:4]))
         except (Exception, rasterio.errors.RasterioIOError) as e:
             # This likely occurs only if there is a memory error
             print(e)
-            inconn.close()
             return "Rio error"
 
-    dims = data.shape
-    print(f"partial image dimension {dims[1]}*{dims[2]} requires",
-          f"{4*dims[1]*dims[2]/(1024*1024)} MB",
-          f"({100.0*dims[1]*dims[2]/(imgheight*imgwidth)})")
 
-    ulx = wulx
-    uly = wuly
+def openMeansWriter(session, outconn):
+    try:
+        return resultWriter.openWriter(
+            session.config, outconn, session.dbconfig['tables']['sigs_table'],
+            ['pid', 'count', 'mean', 'rtfid'], keys=['rtfid'])
+    except (ValueError, psycopg2.DatabaseError) as e:
+        print(e)
+        return None
 
-    # Close cursor to allow for named cursor
-    incurs.close()
 
-    # we need a named cursor to be able to use fetchmany
-    incurs = inconn.cursor(name='fetch_raster_parcels',
-                           cursor_factory=psycopg2.extras.DictCursor)
+def vrtId(v):
+    return v.split('/')[-1].replace('.vrt', '')
 
-    # Select parcels in this image footprint, in the correct rasterized format
-    pidSql = f"""select pid, st_asbinary(rast) from {parcel_raster_table}"""
 
-    try:
-        incurs.execute(pidSql)
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-        inconn.close()
-        return "Parcel SQL"
+def indexRasterMeans(v, session=None):
+    # the single band image is expected as a VRT with single pixel spacing and
+    # projection. First read only metadata so that we can set up windowed reads
 
-    totalrows = 0
+    # 2. database configuration, set up once per run by the caller
+    if session is None:
+        session = dbSession.DbSession()
+    config = session.config
+    dbconfig = session.dbconfig
+
+    # Input data base is postgis
+    inconn = session.reader()
+    if not inconn:
+        print("No in connection established")
+        return "No in db"
 
-    outconn = psycopg2.connect(connString)
+    grid = meansWindow(v, session, inconn)
+    if isinstance(grid, str):
+        session.release(inconn)
+        return grid
+    profile, imgcrs, dx, window = grid
+
+    # Now we're ready to do a windowed read
+    data = readMeansWindow(v, window)
+    if isinstance(data, str):
+        session.release(inconn)
+        return data
+
+    dims = data.shape
+    print(f"partial image dimension {dims[1]}*{dims[2]} requires",
+          f"{4*dims[1]*dims[2]/(1024*1024)} MB",
+          f"({100.0*dims[1]*dims[2]/(profile['height']*profile['width'])})")
+
+    flat = data.reshape(dims[0], dims[1] * dims[2])
+
+    parcel_raster_table = f"{dbconfig['tables']['parcel_table']}_{imgcrs}_{dx}_rast"
+    source = meansIndexSource(config, inconn, parcel_raster_table, dx, window,
+                              dims, 10000)
+    if isinstance(source, str):
+        session.release(inconn)
+        return source
+    index, batches, builder, cachepath = source
+
+    outconn = session.writer()
     if not outconn:
         print("No out connection established")
+        session.release(inconn)
         return "No out db"
 
-    while True:
-        rowset = incurs.fetchmany(size=10000)
-        if not rowset:
-            break
+    writer = openMeansWriter(session, outconn)
+    if writer is None:
+        session.release(inconn)
+        session.release(outconn)
+        return "No out table"
 
-        tseries = []
-        for r in rowset:
-            rast = r[1]
-
-            pulx, puly, prast = wkbReader.wkbImage(rast)
-
-            rows, cols = getIndices(pulx, puly, prast, ulx, uly, dx, dims)
-
-            if len(rows) > 0 or len(cols) > 0:
-                b0 = getMeans(data[0, np.uint16(rows), np.uint16(cols)], 0.0)
-                if b0:
-                    tseries.append((r[0], *b0))
-
-        # Prepare as pandas DataFrame and copy into database
-        df = pd.DataFrame(tseries, columns=['pid', 'count', 'mean'])
-        df['rtfid'] = v.split('/')[-1].replace('.vrt', '')
-
-        if len(df) > 0:
-            df.dropna(inplace=True)
-            # print(df)
-            totalrows += len(df)
-            if len(df.values) > 0:
-                df_columns = list(df)
-                # print(df_columns)
-                s_buf = io.StringIO()
-                df.to_csv(s_buf, header=False, index=False, sep=',')
-                s_buf.seek(0)
-                outcurs = outconn.cursor()
-                try:
-                    outcurs.copy_from(s_buf, dbconfig['tables']['sigs_table'],
-                                      columns=tuple(df_columns), sep=',')
-                    outconn.commit()
-                except psycopg2.IntegrityError as e:
-                    print("IntegrityError", e)
-                except psycopg2.DatabaseError as e:
-                    print("DatabaseError", e)
-                except Exception as e:
-                    print(e)
-                finally:
-                    outcurs.close()
+    rtfid = vrtId(v)
+    for pids, offsets, pixels in batches:
+        counts, means, valid = getBatchMeans(flat, offsets, pixels, 0.0)
 
-    incurs.close()
-    inconn.close()
-    outconn.close()
+        sel = np.flatnonzero(valid)
+        writer.write({'pid': pids[sel], 'count': counts[sel],
+                      'mean': means[sel], 'rtfid': rtfid})
 
+    totalrows = writer.close()
+
+    if builder is not None:
+        builder.save(cachepath)
+
+    session.release(inconn)
+    session.release(outconn)
+
+    if totalrows is None:
+        return "Copy error"
     print(f"{totalrows} processed")
     if totalrows == 0:
         return "No parcels"
     else:
         return "Extracted"
+
+
+# Parcel index shared with the processes of indexRasterMeansBatch, as the
+# shared memory blocks and the (pids, offsets, pixels) arrays on them
+sharedIndex = None
+
+
+def shareIndex(index):
+    # Copy the index into shared memory blocks, returns the blocks and the
+    # (name, dtype, shape) to attach them in other processes
+    blocks = []
+    specs = []
+    for a in index:
+        a = np.asarray(a)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, a.nbytes))
+        np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[:] = a
+        blocks.append(shm)
+        specs.append((shm.name, a.dtype.str, a.shape))
+    return blocks, specs
+
+
+def attachIndex(specs):
+    # Pool initializer. The pool processes run in parallel, so the kernels
+    # run single threaded in each of them.
+    global sharedIndex
+    numba.set_num_threads(1)
+    blocks = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+    sharedIndex = (blocks, tuple(
+        np.ndarray(shape, dtype=dtype, buffer=b.buf)
+        for b, (_, dtype, shape) in zip(blocks, specs)))
+
+
+def vrtMeans(job):
+    # Means of the shared index parcels in one VRT, in a pool process.
+    # Returns (v, pids, counts, means) or (v, error status string)
+    v, window = job
+    data = readMeansWindow(v, window)
+    if isinstance(data, str):
+        return v, data
+    pids, offsets, pixels = sharedIndex[1]
+    counts, means, valid = getBatchMeans(
+        data.reshape(data.shape[0], data.shape[1] * data.shape[2]), offsets,
+        pixels, 0.0)
+    sel = np.flatnonzero(valid)
+    return v, pids[sel], counts[sel], means[sel]
+
+
+def indexRasterMeansBatch(vrts, session=None, processes=None):
+    # indexRasterMeans for many single band VRTs on the same grid, e.g. a
+    # CARD-COH12 time series. The parcel index is built once and shared with
+    # a pool of processes that read and average one VRT each at a time, and
+    # all means are written through one COPY writer. VRTs that are not on
+    # the grid of the first one go through indexRasterMeans. Returns the
+    # status of every VRT.
+    if session is None:
+        session = dbSession.DbSession()
+    config = session.config
+    dbconfig = session.dbconfig
+
+    inconn = session.reader()
+    if not inconn:
+        print("No in connection established")
+        return {v: "No in db" for v in vrts}
+
+    grid = meansWindow(vrts[0], session, inconn)
+    if isinstance(grid, str):
+        session.release(inconn)
+        return {v: grid for v in vrts}
+    profile, imgcrs, dx, window = grid
+
+    batch = []
+    others = []
+    for v in vrts:
+        with rasterio.open(v) as src:
+            if src.crs.to_epsg() == imgcrs and \
+                    src.transform == profile['transform'] and \
+                    src.width == profile['width'] and \
+                    src.height == profile['height']:
+                batch.append(v)
+            else:
+                others.append(v)
+
+    dims = (1, window[3], window[2])
+    parcel_raster_table = f"{dbconfig['tables']['parcel_table']}_{imgcrs}_{dx}_rast"
+    source = meansIndexSource(config, inconn, parcel_raster_table, dx, window,
+                              dims, 10000)
+    if isinstance(source, str):
+        session.release(inconn)
+        return {v: source for v in vrts}
+    index = completeIndex(source, dims)
+    session.release(inconn)
+    print(f"{len(index[0])} parcels indexed for {len(batch)} VRTs")
+
+    outconn = session.writer()
+    if not outconn:
+        print("No out connection established")
+        return {v: "No out db" for v in vrts}
+
+    writer = openMeansWriter(session, outconn)
+    if writer is None:
+        session.release(outconn)
+        return {v: "No out table" for v in vrts}
+
+    # Spawned, not forked, as the numba thread pool of this process does not
+    # survive a fork
+    processes = min(processes or os.cpu_count(), len(batch))
+    blocks, specs = shareIndex(index)
+    status = {}
+    try:
+        with multiprocessing.get_context('spawn').Pool(
+                processes, initializer=attachIndex, initargs=(specs,)) as pool:
+            for result in pool.imap_unordered(vrtMeans,
+                                              [(v, window) for v in batch]):
+                if len(result) == 2:
+                    status[result[0]] = result[1]
+                    continue
+                v, pids, counts, means = result
+                rows = writer.write({'pid': pids, 'count': counts,
+                                     'mean': means, 'rtfid': vrtId(v)})
+                print(f"{rows} processed for {vrtId(v)}")
+                status[v] = "Extracted" if rows else "No parcels"
+        # A failed copy may have held the rows of any VRT
+        if writer.close() is None:
+            status = {v: "Copy error" if s == "Extracted" else s
+                      for v, s in status.items()}
+    finally:
+        for b in blocks:
+            b.close()
+            b.unlink()
+    session.release(outconn)
+
+    for v in others:
+        print(f"{v} is not on the grid of {vrts[0]}")
+        status[v] = indexRasterMeans(v, session)
+    return status
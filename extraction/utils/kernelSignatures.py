@@ -0,0 +1,28 @@
+# kernelSignatures - numba argument types of the extraction kernels
+#
+# Every kernel module lists the signatures it is called with, built from the
+# types below. warmupKernels.py compiles them into the numba cache, so that
+# workers load the kernels from disk instead of compiling them at start up.
+# Arguments of other types still compile on first use.
+from numba import types
+
+# Band types we read: SCL (uint8), S2 L2A (uint16), S1 CARD-BS and
+# coherence (float32)
+BAND_TYPES = [types.uint8, types.uint16, types.float32]
+
+
+def array(dtype, ndim, readonly=False):
+    return types.Array(dtype, ndim, 'C', readonly=readonly)
+
+
+# Parcel index offsets and pixels, writable when built from the database,
+# read-only when memory-mapped from the index cache
+OFFSETS = [array(types.int64, 1, readonly) for readonly in [False, True]]
+PIXELS = [array(t, 1, readonly) for t in [types.int32, types.int64]
+          for readonly in [False, True]]
+
+# parcelIndex.batches rebases the offsets of every batch into a new array
+BATCH_OFFSETS = [array(types.int64, 1)]
+
+# Window cube shape (bands, rows, cols)
+DIMS = types.UniTuple(types.int64, 3)
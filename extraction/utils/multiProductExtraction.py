@@ -0,0 +1,211 @@
+# multiProductExtraction - SCL histograms, 10 m and 20 m band statistics for
+# a Sentinel-2 image in a single run
+#
+# The parcel index is fetched once for the 10 m window, the 20 m index is
+# derived from it, so the image is claimed once and the parcel rasters are
+# fetched and decoded once for all three products.
+import numba
+import numpy as np
+from numba import types
+import psycopg2
+import rasterio
+from rasterio.windows import Window
+
+from . import indexedNumbaHistogram as inh
+from . import indexedNumbaWindowedRasterStats as inw
+from . import bandReader, dbSession, imageTimings, parcelIndex, resultWriter
+from .kernelSignatures import OFFSETS, PIXELS
+
+# A 20 m pixel belongs to a parcel if at least this many of its 4 10 m
+# pixels do, which approximates the pixel center rule of the rasterization
+MIN_SUBPIXELS = 2
+
+
+def coarseWindow(window, factor, width, height):
+    # Window on a grid factor times coarser with the same origin, covering
+    # window and clipped to the coarse image size
+    w0x, w0y, wdx, wdy, ulx, uly = window
+    cw0x = w0x // factor
+    cw0y = w0y // factor
+    cwdx = min(-(-(w0x + wdx) // factor), width) - cw0x
+    cwdy = min(-(-(w0y + wdy) // factor), height) - cw0y
+    return cw0x, cw0y, cwdx, cwdy
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def getCoarseIndex(offsets, pixels, w0x, w0y, wdx, factor, cw0x, cw0y,
+                   cwdx, cwdy, minfine):
+    # Derive a CSR index on the coarse window from one on the fine window.
+    # A coarse pixel is kept for a parcel if at least minfine of its fine
+    # pixels are in the parcel.
+    n = offsets.shape[0] - 1
+    coarse = np.empty(pixels.shape[0], dtype=np.int64)
+    counts = np.zeros(n, dtype=np.int64)
+    for i in numba.prange(n):
+        a = offsets[i]
+        b = offsets[i + 1]
+        m = 0
+        for j in range(a, b):
+            row = (w0y + pixels[j] // wdx) // factor - cw0y
+            col = (w0x + pixels[j] % wdx) // factor - cw0x
+            if row >= 0 and row < cwdy and col >= 0 and col < cwdx:
+                coarse[a + m] = row * cwdx + col
+                m += 1
+        seg = coarse[a:a + m]
+        seg.sort()
+
+        # Keep each coarse pixel with enough fine pixels once, in place
+        k = 0
+        j = 0
+        while j < m:
+            e = j
+            while e < m and seg[e] == seg[j]:
+                e += 1
+            if e - j >= minfine:
+                seg[k] = seg[j]
+                k += 1
+            j = e
+        counts[i] = k
+
+    coffsets = np.zeros(n + 1, dtype=np.int64)
+    coffsets[1:] = np.cumsum(counts)
+    cpixels = np.empty(coffsets[n], dtype=np.int64)
+    for i in numba.prange(n):
+        cpixels[coffsets[i]:coffsets[i + 1]] = \
+            coarse[offsets[i]:offsets[i] + counts[i]]
+    return coffsets, cpixels
+
+
+# Signatures compiled ahead by warmupKernels.py
+SIGNATURES = [
+    (getCoarseIndex, [(o, p) + (types.int64,) * 9 for o in OFFSETS
+                      for p in PIXELS]),
+]
+
+
+def readWindow(vrt, window, threads=1):
+    try:
+        return bandReader.readBands(vrt, Window(*window[:4]), threads)
+    except (Exception, rasterio.errors.RasterioIOError) as e:
+        # This likely occurs only if there is a memory error
+        print(e)
+        return None
+
+
+def extractS2(oid, reference, bands10, bands20, prefetched=None,
+              session=None):
+    # Expects data/{reference}_10.vrt, _20.vrt and _scl.vrt. Returns the
+    # image status. prefetched is the 10 m (window, data) of
+    # indexedNumbaWindowedRasterStats.prefetchWindow, if read ahead.
+    if session is None:
+        session = dbSession.DbSession()
+    config = session.config
+    dbconfig = session.dbconfig
+
+    with rasterio.open(f"data/{reference}_10.vrt") as src:
+        profile10 = src.profile
+        imgcrs = src.crs.to_epsg()
+    with rasterio.open(f"data/{reference}_20.vrt") as src:
+        profile20 = src.profile
+
+    inconn = session.reader()
+    if not inconn:
+        print("No in connection established")
+        return "No in db"
+
+    threads = config.get('extraction', {}).get('read_threads', 1)
+    if prefetched is None:
+        incurs = inconn.cursor()
+        window10 = inw.aoiWindow(incurs, dbconfig['args']['name'], imgcrs,
+                                 profile10)
+        incurs.close()
+        if window10 is None:
+            session.release(inconn)
+            return "No extent"
+        data10 = readWindow(f"data/{reference}_10.vrt", window10, threads)
+    else:
+        window10, data10 = prefetched
+    if data10 is None:
+        session.release(inconn)
+        return "Rio error"
+    dims10 = data10.shape
+    print(f"10 m window {window10[:4]}")
+
+    # The 10 m parcel index, fetched once for all products
+    source = inw.parcelIndexSource(config, inconn, oid, imgcrs, 10, window10,
+                                   dims10, 10000)
+    if isinstance(source, str):
+        session.release(inconn)
+        return source
+    pids, offsets10, pixels10 = inw.completeIndex(source, dims10)
+    session.release(inconn)
+
+    window20 = coarseWindow(window10, 2, profile20['width'],
+                            profile20['height'])
+    with imageTimings.span('index'):
+        offsets20, pixels20 = getCoarseIndex(
+            np.asarray(offsets10), np.asarray(pixels10), window10[0],
+            window10[1], dims10[2], 2, *window20, MIN_SUBPIXELS)
+    print(f"20 m window {window20} derived from 10 m index")
+
+    # The 20 m bands and SCL are read before any results are written, so a
+    # failed read leaves no partial rows of the image
+    data20 = readWindow(f"data/{reference}_20.vrt", window20, threads)
+    scl = readWindow(f"data/{reference}_scl.vrt", window20)
+    if data20 is None or scl is None:
+        return "Rio error"
+
+    outconn = session.writer()
+    if not outconn:
+        print("No out connection established")
+        return "No out db"
+
+    try:
+        writer = resultWriter.openWriter(
+            config, outconn, dbconfig['tables']['sigs_table'],
+            ['pid', 'band', 'count', 'mean', 'std', 'min', 'max', 'p25',
+             'p50', 'p75', 'obsid'], {'card': 's2'}, ['obsid'])
+    except (ValueError, psycopg2.DatabaseError) as e:
+        print(e)
+        session.release(outconn)
+        return "No out table"
+    histwriter = inh.openHistWriter(config, outconn)
+    if histwriter is None:
+        session.release(outconn)
+        return "No out table"
+
+    # 10 m band statistics
+    flat = data10.reshape(dims10[0], dims10[1] * dims10[2])
+    for bpids, boffsets, bpixels in parcelIndex.batches(
+            (pids, offsets10, pixels10), 10000):
+        with imageTimings.span('stats'):
+            stats, valid = inw.getBatchStats(flat, boffsets, bpixels, 0.0)
+        imageTimings.count('parcels', len(bpids))
+        inw.writeBandStats(writer, bpids, stats, valid, bands10, oid)
+    del data10, flat
+
+    # 20 m band statistics and SCL histograms on the derived index
+    flat = data20.reshape(data20.shape[0], -1)
+    sclflat = scl.reshape(-1)
+    counts = np.zeros((10000, inh.SCL_CLASSES), dtype=np.int64)
+    for bpids, boffsets, bpixels in parcelIndex.batches(
+            (pids, offsets20, pixels20), 10000):
+        with imageTimings.span('stats'):
+            stats, valid = inw.getBatchStats(flat, boffsets, bpixels, 0.0)
+        inw.writeBandStats(writer, bpids, stats, valid, bands20, oid)
+        with imageTimings.span('stats'):
+            inh.getClassCounts(sclflat, boffsets, bpixels, counts)
+        inh.writeClassCounts(histwriter, bpids, int(oid),
+                             counts[:len(bpids)])
+
+    sigrows = writer.close()
+    histrows = histwriter.close()
+    session.release(outconn)
+
+    if sigrows is None or histrows is None:
+        return "Copy error"
+
+    print(f"{sigrows} band statistics and {histrows} histograms processed")
+    if sigrows == 0 and histrows == 0:
+        return "No parcels"
+    return "extracted"
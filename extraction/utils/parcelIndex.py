@@ -0,0 +1,212 @@
+# parcelIndex - parcel pixel indices in CSR form, cached on disk per raster grid
+#
+# A parcel index holds, for every parcel in a read window, the flattened pixel
+# offsets (row * window width + col) into that window. It is stored as three
+# arrays: pids (one per parcel), offsets (one more than pids) and pixels, so
+# that the pixels of parcel i are pixels[offsets[i]:offsets[i + 1]].
+#
+# The index only depends on the parcel raster table (which encodes parcel
+# table, EPSG and dx), the map origin and the size of the window, so it is
+# the same for every acquisition on the same grid and can be reused from
+# disk. It is cached under a directory per grid and window, in a
+# subdirectory per version of the parcel raster table, so that a rebuilt
+# table is indexed again. The cache is kept below index_cache_gb by evicting
+# the least recently used indices.
+#
+# The window of S1 images (the AOI in the image footprint) changes with every
+# acquisition, so the cache only pays off for tile gridded S2 and is off by
+# default.
+import glob
+import os
+import shutil
+import time
+
+import numpy as np
+import psycopg2
+
+
+def tableVersion(conn, parcel_raster_table):
+    # The relation file of the table, which changes when it is recreated,
+    # truncated or rewritten, and its comment, which can be set to a new
+    # version after rows are changed in place:
+    #   COMMENT ON TABLE public.parcels_32631_10_rast IS '2';
+    # None if the table does not exist.
+    try:
+        with conn.cursor() as curs:
+            curs.execute("""SELECT relfilenode,
+                    coalesce(obj_description(oid, 'pg_class'), '')
+                FROM pg_class WHERE oid = to_regclass(%s)""",
+                         (parcel_raster_table,))
+            row = curs.fetchone()
+    except psycopg2.DatabaseError as e:
+        print(e)
+        conn.rollback()
+        return None
+    if row is None:
+        return None
+    comment = ''.join(c for c in row[1] if c.isalnum() or c in '.-')
+    return f"v{row[0]}_{comment}" if comment else f"v{row[0]}"
+
+
+def cacheEntries(cachedir):
+    # (mtime, path, bytes) of all cached indices, least recently used first
+    entries = []
+    for path in glob.glob(os.path.join(cachedir, '*', 'v*')):
+        if path.endswith('.tmp'):
+            continue
+        try:
+            size = sum(os.path.getsize(f)
+                       for f in glob.glob(os.path.join(path, '*.npy')))
+            entries.append((os.path.getmtime(path), path, size))
+        except OSError:
+            continue
+    return sorted(entries)
+
+
+def evict(cachedir, maxbytes, keep):
+    # Remove least recently used indices, never keep, until the cache fits
+    # in maxbytes. Replicas that have an evicted index mapped keep reading
+    # it until they unmap it.
+    entries = cacheEntries(cachedir)
+    total = sum(e[2] for e in entries)
+    for mtime, path, size in entries:
+        if total <= maxbytes:
+            break
+        if path == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+        total -= size
+        print(f"Parcel index {path} evicted from cache")
+
+
+def cachePath(cachedir, conn, parcel_raster_table, ulx, uly, dx, dims,
+              maxgb=20):
+    # Cache directory of the index of the window at (ulx, uly) with dims
+    # (bands, rows, cols), None if the table version is not known. Makes
+    # room for it in a cache of maxgb.
+    version = tableVersion(conn, parcel_raster_table)
+    if version is None:
+        return None
+    grid = (f"{parcel_raster_table}_{ulx:.3f}_{uly:.3f}_{dx:.3f}"
+            f"_{dims[2]}_{dims[1]}")
+    path = os.path.join(cachedir, grid, version)
+    evict(cachedir, maxgb * 1024**3, path)
+    return path
+
+
+def pixelType(dims):
+    # int32 offsets are enough for any window we read in practice
+    if dims[1] * dims[2] < 2**31:
+        return np.int32
+    return np.int64
+
+
+# Indices loaded by this process. A cached index never changes once it is
+# renamed into place, so a long running worker keeps them mapped until a
+# newer version of the same grid is loaded.
+loaded = {}
+
+
+def touch(path):
+    # Mark an index as used for the LRU eviction, atime is not reliable
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def loadIndex(path):
+    # Returns memory-mapped (pids, offsets, pixels) or None if not cached
+    if path in loaded:
+        touch(path)
+        return loaded[path]
+    for p in [p for p in loaded if os.path.dirname(p) == os.path.dirname(path)]:
+        del loaded[p]
+    if not os.path.isdir(path):
+        return None
+    try:
+        loaded[path] = tuple(np.load(os.path.join(path, f"{a}.npy"),
+                                     mmap_mode='r')
+                             for a in ['pids', 'offsets', 'pixels'])
+    except (OSError, ValueError) as e:
+        print(f"Parcel index cache {path} unreadable ({e})")
+        return None
+    touch(path)
+    return loaded[path]
+
+
+def saveIndex(path, pids, offsets, pixels):
+    # Write into a private directory first and rename, so that concurrent
+    # replicas never see a partial index. The first one to finish wins.
+    tmppath = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(tmppath, exist_ok=True)
+    for a, v in zip(['pids', 'offsets', 'pixels'], [pids, offsets, pixels]):
+        np.save(os.path.join(tmppath, f"{a}.npy"), v)
+    try:
+        os.rename(tmppath, path)
+    except OSError:
+        shutil.rmtree(tmppath, ignore_errors=True)
+        return False
+    print(f"Parcel index cached in {path}")
+    return True
+
+
+def loadLabels(path):
+    # Label image composed from the index in path, memory-mapped, or None
+    try:
+        return np.load(os.path.join(path, 'labels.npy'), mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+
+
+def saveLabels(path, labels):
+    # Only stored next to an existing index, written under a temporary name
+    if not os.path.isdir(path):
+        return False
+    tmpfile = os.path.join(path, f"labels.{os.getpid()}.tmp.npy")
+    np.save(tmpfile, labels)
+    os.replace(tmpfile, os.path.join(path, 'labels.npy'))
+    print(f"Label image cached in {path}")
+    return True
+
+
+def batches(index, size):
+    # Iterate a (cached) index in parcel batches of at most size, with
+    # offsets rebased to the pixels slice
+    pids, offsets, pixels = index
+    for a in range(0, len(pids), size):
+        b = min(a + size, len(pids))
+        yield (pids[a:b], offsets[a:b + 1] - offsets[a],
+               pixels[offsets[a]:offsets[b]])
+
+
+class IndexBuilder:
+    # Collects the batches decoded from the database into one index
+
+    def __init__(self, dims):
+        self.dims = dims
+        self.pids = []
+        self.offsets = [np.zeros(1, dtype=np.int64)]
+        self.pixels = []
+        self.npixels = 0
+
+    def append(self, pids, offsets, pixels):
+        self.pids.append(np.asarray(pids, dtype=np.int64))
+        self.offsets.append(np.asarray(offsets[1:], dtype=np.int64) +
+                            self.npixels)
+        self.pixels.append(np.asarray(pixels, dtype=pixelType(self.dims)))
+        self.npixels += len(pixels)
+
+    def index(self):
+        return (np.concatenate(self.pids) if self.pids
+                else np.zeros(0, dtype=np.int64),
+                np.concatenate(self.offsets),
+                np.concatenate(self.pixels) if self.pixels
+                else np.zeros(0, dtype=pixelType(self.dims)))
+
+    def save(self, path):
+        return saveIndex(path, *self.index())
@@ -0,0 +1,263 @@
+# parcelStore - parcel rasters exported once from the database to local disk
+#
+# A store holds one parcel raster table ({parcel_table}_{crs}_{dx}_rast) as
+# memory-mappable .npy arrays, one entry per parcel: pid, upper left corner
+# (ipx, ipy), width, height and the start of its mask in masks, the masks of
+# all parcels packed to one bit per pixel (row major, np.packbits order).
+#
+# Parcels are sorted by the cell of a regular grid their upper left corner
+# falls in, and cells holds the parcel offsets of every cell (one more than
+# cells), so that the parcels in a window are found from the cells around it.
+# Workers then build parcel indices from local disk, without querying the
+# parcel raster table for every image.
+#
+# The store is a snapshot, it has to be exported again (exportParcelStore.py)
+# when the parcel table changes.
+import json
+import os
+import shutil
+
+import numba
+import numpy as np
+from numba import types
+
+from . import wkbReader, parcelIndex, imageTimings
+from .kernelSignatures import array
+
+STORE_ARRAYS = ['pids', 'ipx', 'ipy', 'widths', 'heights', 'starts', 'masks',
+                'cells']
+
+
+def storePath(storedir, parcel_raster_table):
+    return os.path.join(storedir, parcel_raster_table)
+
+
+def exportStore(conn, parcel_raster_table, path, cell=10000, size=10000):
+    # Export all parcel rasters of parcel_raster_table into a store in path,
+    # with grid cells of cell map units. Returns the number of parcels.
+    curs = conn.cursor(name='export_raster_parcels')
+    curs.execute(f"select pid, st_asbinary(rast) from {parcel_raster_table}")
+
+    def rowsets():
+        n = 0
+        while True:
+            rowset = curs.fetchmany(size=size)
+            if not rowset:
+                break
+            n += len(rowset)
+            print(f"{n} parcels exported")
+            yield rowset
+
+    built = buildStore(rowsets(), rasterDx(conn, parcel_raster_table), cell)
+    curs.close()
+    if built is None:
+        print(f"No parcels in {parcel_raster_table}")
+        return 0
+
+    saveStore(path, *built)
+    return len(built[0]['pids'])
+
+
+def buildStore(rowsets, dx, cell):
+    # Store arrays and grid of the parcel rasters in rowsets of (pid, wkb),
+    # or None if there are none
+    parts = {a: [] for a in STORE_ARRAYS[:-1]}
+    nbits = 0
+    for rowset in rowsets:
+        pids, ipx, ipy, widths, heights, offsets, masks = wkbReader.wkbBatch(rowset)
+        # Every batch starts on a byte boundary of masks
+        packed = np.packbits(masks == 1)
+        parts['pids'].append(pids)
+        parts['ipx'].append(ipx)
+        parts['ipy'].append(ipy)
+        parts['widths'].append(widths)
+        parts['heights'].append(heights)
+        parts['starts'].append(offsets[:-1] + nbits)
+        parts['masks'].append(packed)
+        nbits += 8 * len(packed)
+
+    if not parts['pids']:
+        return None
+    store = {a: np.concatenate(v) for a, v in parts.items()}
+
+    # Sort the parcels by grid cell. The mask bits stay in place, they are
+    # found from starts.
+    grid = {'cell': cell, 'dx': dx, 'x0': float(store['ipx'].min()),
+            'y0': float(store['ipy'].max())}
+    grid['maxwidth'] = float(store['widths'].max() * dx)
+    grid['maxheight'] = float(store['heights'].max() * dx)
+    cols = ((store['ipx'] - grid['x0']) // cell).astype(np.int64)
+    rows = ((grid['y0'] - store['ipy']) // cell).astype(np.int64)
+    grid['ncols'] = int(cols.max()) + 1
+    grid['nrows'] = int(rows.max()) + 1
+    keys = rows * grid['ncols'] + cols
+    order = np.argsort(keys, kind='stable')
+    for a in ['pids', 'ipx', 'ipy', 'widths', 'heights', 'starts']:
+        store[a] = store[a][order]
+    store['cells'] = np.searchsorted(
+        keys[order], np.arange(grid['nrows'] * grid['ncols'] + 1))
+    return store, grid
+
+
+def rasterDx(conn, parcel_raster_table):
+    # Pixel size of the parcel rasters
+    curs = conn.cursor()
+    curs.execute(f"select st_scalex(rast) from {parcel_raster_table} limit 1")
+    dx = abs(curs.fetchone()[0])
+    curs.close()
+    return dx
+
+
+def saveStore(path, store, grid):
+    # Written into a private directory and swapped into place, so that
+    # workers never see a partial store. Workers that still map an earlier
+    # export keep reading it until they restart.
+    tmppath = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(tmppath, exist_ok=True)
+    for a in STORE_ARRAYS:
+        np.save(os.path.join(tmppath, f"{a}.npy"), store[a])
+    with open(os.path.join(tmppath, 'grid.json'), 'w') as f:
+        json.dump(grid, f)
+    oldpath = f"{path}.{os.getpid()}.old"
+    if os.path.isdir(path):
+        os.rename(path, oldpath)
+    os.rename(tmppath, path)
+    shutil.rmtree(oldpath, ignore_errors=True)
+    print(f"Parcel store saved in {path}")
+
+
+# Stores opened by this process, kept mapped by long running workers
+opened = {}
+
+
+def loadStore(path):
+    # Returns the memory-mapped store in path or None if not exported
+    if path in opened:
+        return opened[path]
+    if not os.path.isdir(path):
+        return None
+    try:
+        store = {a: np.load(os.path.join(path, f"{a}.npy"), mmap_mode='r')
+                 for a in STORE_ARRAYS}
+        with open(os.path.join(path, 'grid.json'), 'r') as f:
+            store['grid'] = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Parcel store {path} unreadable ({e})")
+        return None
+    opened[path] = store
+    return store
+
+
+def openStore(config, parcel_raster_table):
+    # The store of parcel_raster_table, if configured and exported
+    storedir = config.get('extraction', {}).get('parcel_store')
+    if not storedir:
+        return None
+    return loadStore(storePath(storedir, parcel_raster_table))
+
+
+def queryStore(store, ulx, uly, lrx, lry):
+    # Positions of the parcels whose raster intersects the box, in store
+    # order
+    grid = store['grid']
+    cell = grid['cell']
+    # A parcel in the box has its corner at most one parcel extent to the
+    # left of it. Rows are mapped as in getIndices (upwards from ipy), but
+    # the box is widened by a parcel extent both ways vertically, so that
+    # the selection holds whichever way up the parcels were rasterized.
+    c0 = max(0, int((ulx - grid['maxwidth'] - grid['x0']) // cell))
+    c1 = min(grid['ncols'] - 1, int((lrx - grid['x0']) // cell))
+    r0 = max(0, int((grid['y0'] - uly - grid['maxheight']) // cell))
+    r1 = min(grid['nrows'] - 1,
+             int((grid['y0'] - lry + grid['maxheight']) // cell))
+    if c0 > c1 or r0 > r1:
+        return np.zeros(0, dtype=np.int64)
+
+    cells = store['cells']
+    rows = np.arange(r0, r1 + 1) * grid['ncols']
+    candidates = np.concatenate([np.arange(cells[r + c0], cells[r + c1 + 1])
+                                 for r in rows])
+
+    dx = grid['dx']
+    ipx = store['ipx'][candidates]
+    ipy = store['ipy'][candidates]
+    height = store['heights'][candidates] * dx
+    keep = ((ipx < lrx) & (ipx + store['widths'][candidates] * dx > ulx) &
+            (ipy + height > lry) & (ipy - height < uly))
+    return candidates[keep]
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def getStoreIndices(sel, ipx, ipy, widths, heights, starts, masks, ulx, uly,
+                    dx, nrows, ncols):
+    # getBatchIndices for the selected parcels of a store, reading the packed
+    # mask bits in place. Returns per parcel pixel counts, offsets and the
+    # pixels, in the order of sel
+    n = sel.shape[0]
+    counts = np.zeros(n, dtype=np.int64)
+    for i in numba.prange(n):
+        p = sel[i]
+        drow = int(np.floor((uly - ipy[p]) / dx))
+        dcol = int(np.floor((ipx[p] - ulx) / dx))
+        for j in range(widths[p] * heights[p]):
+            k = starts[p] + j
+            if (masks[k >> 3] >> (7 - (k & 7))) & 1:
+                row = drow - j // widths[p]
+                col = dcol + j % widths[p]
+                if row >= 0 and row < nrows and col >= 0 and col < ncols:
+                    counts[i] += 1
+
+    poffsets = np.zeros(n + 1, dtype=np.int64)
+    poffsets[1:] = np.cumsum(counts)
+    pixels = np.empty(poffsets[n], dtype=np.int64)
+    for i in numba.prange(n):
+        p = sel[i]
+        drow = int(np.floor((uly - ipy[p]) / dx))
+        dcol = int(np.floor((ipx[p] - ulx) / dx))
+        m = poffsets[i]
+        for j in range(widths[p] * heights[p]):
+            k = starts[p] + j
+            if (masks[k >> 3] >> (7 - (k & 7))) & 1:
+                row = drow - j // widths[p]
+                col = dcol + j % widths[p]
+                if row >= 0 and row < nrows and col >= 0 and col < ncols:
+                    pixels[m] = row * ncols + col
+                    m += 1
+    return counts, poffsets, pixels
+
+
+# Signatures compiled ahead by warmupKernels.py, store arrays are read-only
+# when memory-mapped
+SIGNATURES = [
+    (getStoreIndices, [(array(types.int64, 1), array(types.float64, 1, True),
+                        array(types.float64, 1, True),
+                        array(types.int64, 1, True),
+                        array(types.int64, 1, True),
+                        array(types.int64, 1, True),
+                        array(types.uint8, 1, True),
+                        types.float64, types.float64, types.float64,
+                        types.int64, types.int64)]),
+]
+
+
+def storeBatches(store, ulx, uly, dx, dims, size, builder=None):
+    # Yield CSR batches of the parcels in the window at ulx, uly of shape
+    # dims, like fetchIndexBatches, optionally collecting them for the parcel
+    # index cache
+    with imageTimings.span('parcels'):
+        sel = queryStore(store, ulx, uly, ulx + dims[2] * dx,
+                         uly - dims[1] * dx)
+    print(f"{len(sel)} parcels selected from the parcel store")
+    for a in range(0, len(sel), size):
+        with imageTimings.span('index'):
+            counts, poffsets, pixels = getStoreIndices(
+                sel[a:a + size], store['ipx'], store['ipy'], store['widths'],
+                store['heights'], store['starts'], store['masks'],
+                float(ulx), float(uly), float(dx), dims[1], dims[2])
+        keep = counts > 0
+        batch = (np.asarray(store['pids'][sel[a:a + size]][keep]),
+                 np.concatenate(([0], np.cumsum(counts[keep]))),
+                 pixels.astype(parcelIndex.pixelType(dims)))
+        if builder is not None:
+            builder.append(*batch)
+        yield batch
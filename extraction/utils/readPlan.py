@@ -0,0 +1,205 @@
+# readPlan - split the read window into parts that are read and processed
+# one after another, so that only one part is in memory at a time (strips),
+# or so that parts of the window without parcels are not read (sparse)
+#
+# A plan is a list of (row0, col0, height, width, sel) in window pixels,
+# with sel the positions in the parcel index of the parcels processed on
+# that part. Every parcel is in exactly one part, and a part always covers
+# the complete parcels it holds.
+import numba
+import numpy as np
+from numba import types
+
+from .kernelSignatures import OFFSETS, PIXELS, array
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def getParcelBounds(offsets, pixels, wdx):
+    # Row and column bounds (rmin, rmax, cmin, cmax) of all parcels
+    n = offsets.shape[0] - 1
+    bounds = np.zeros((n, 4), dtype=np.int64)
+    for i in numba.prange(n):
+        rmin = cmin = np.iinfo(np.int64).max
+        rmax = cmax = -1
+        for j in range(offsets[i], offsets[i + 1]):
+            r = pixels[j] // wdx
+            c = pixels[j] % wdx
+            rmin = min(rmin, r)
+            rmax = max(rmax, r)
+            cmin = min(cmin, c)
+            cmax = max(cmax, c)
+        bounds[i, 0] = rmin
+        bounds[i, 1] = rmax
+        bounds[i, 2] = cmin
+        bounds[i, 3] = cmax
+    return bounds
+
+
+@numba.njit(cache=True)
+def getSubIndex(offsets, pixels, sel, wdx, row0, col0, width):
+    # CSR index of the parcels in sel, with pixels relative to the part of
+    # the window at row0, col0 with the given width
+    soffsets = np.zeros(sel.shape[0] + 1, dtype=np.int64)
+    for k in range(sel.shape[0]):
+        soffsets[k + 1] = soffsets[k] + offsets[sel[k] + 1] - offsets[sel[k]]
+    spixels = np.empty(soffsets[-1], dtype=np.int64)
+    for k in range(sel.shape[0]):
+        i = sel[k]
+        m = soffsets[k]
+        for j in range(offsets[i], offsets[i + 1]):
+            spixels[m] = (pixels[j] // wdx - row0) * width + \
+                pixels[j] % wdx - col0
+            m += 1
+    return soffsets, spixels
+
+
+@numba.njit(cache=True)
+def getBlockOccupancy(bounds, w0y, w0x, block, nbrows, nbcols):
+    # Blocks of the image grid, from the one holding the window origin, that
+    # intersect the bounds of any parcel
+    occupied = np.zeros((nbrows, nbcols), dtype=np.bool_)
+    r0 = w0y // block
+    c0 = w0x // block
+    for i in range(bounds.shape[0]):
+        for r in range((w0y + bounds[i, 0]) // block - r0,
+                       (w0y + bounds[i, 1]) // block - r0 + 1):
+            for c in range((w0x + bounds[i, 2]) // block - c0,
+                           (w0x + bounds[i, 3]) // block - c0 + 1):
+                occupied[r, c] = True
+    return occupied
+
+
+# Signatures compiled ahead by warmupKernels.py
+SIGNATURES = [
+    (getParcelBounds, [(o, p, types.int64) for o in OFFSETS for p in PIXELS]),
+    (getSubIndex, [(o, p, array(types.int64, 1), types.int64, types.int64,
+                    types.int64, types.int64) for o in OFFSETS for p in PIXELS]),
+    (getBlockOccupancy, [(array(types.int64, 2), types.int64, types.int64,
+                          types.int64, types.int64, types.int64)]),
+]
+
+
+def stripHeight(budget_mb, dims, itemsize):
+    # Rows per strip so that a strip of all bands fits in budget_mb
+    return max(1, int(budget_mb * 1024 * 1024 // (itemsize * dims[0] * dims[2])))
+
+
+def strips(bounds, sel, row0, row1, col0, col1, height):
+    # The part of the window from row0 to row1 and col0 to col1 holding the
+    # parcels in sel, in strips of height rows. Parcels go to the strip of
+    # their first row, and a strip is extended down to the last row of its
+    # parcels
+    strip = (bounds[sel, 0] - row0) // height
+    order = np.argsort(strip, kind='stable')
+    starts = np.searchsorted(strip[order], np.arange(strip.max() + 2))
+
+    plan = []
+    for k in range(len(starts) - 1):
+        part = sel[order[starts[k]:starts[k + 1]]]
+        if len(part) == 0:
+            continue
+        r0 = row0 + k * height
+        r1 = max(min(r0 + height, row1), bounds[part, 1].max() + 1)
+        plan.append((r0, col0, r1 - r0, col1 - col0, part))
+    return plan
+
+
+def stripPlan(index, dims, height):
+    # Horizontal strips of height rows over the full window width
+    pids, offsets, pixels = index
+    if len(pids) == 0:
+        return []
+    bounds = getParcelBounds(np.asarray(offsets), np.asarray(pixels), dims[2])
+    return strips(bounds, np.arange(len(pids)), 0, dims[1], 0, dims[2], height)
+
+
+def blockClusters(occupied):
+    # Label the 8-connected clusters of occupied blocks (union-find), -1 for
+    # empty blocks
+    nbrows, nbcols = occupied.shape
+    parent = np.arange(nbrows * nbcols)
+
+    def find(a):
+        while parent[a] != a:
+            parent[a] = parent[parent[a]]
+            a = parent[a]
+        return a
+
+    for r, c in zip(*np.nonzero(occupied)):
+        for dr, dc in [(-1, -1), (-1, 0), (-1, 1), (0, -1)]:
+            if 0 <= r + dr and 0 <= c + dc < nbcols and occupied[r + dr, c + dc]:
+                a = find(r * nbcols + c)
+                b = find((r + dr) * nbcols + c + dc)
+                parent[max(a, b)] = min(a, b)
+
+    labels = np.full(nbrows * nbcols, -1)
+    for a in np.flatnonzero(occupied):
+        labels[a] = find(a)
+    return labels.reshape(nbrows, nbcols)
+
+
+def sparsePlan(index, dims, window, block, height=None):
+    # Sub-windows around the clusters of image blocks of block pixels that
+    # hold parcels, so that blocks without parcels are not read. Clusters
+    # whose bounding boxes overlap are merged, so that no pixel is read
+    # twice. Sub-windows are split in strips of height rows, if given.
+    pids, offsets, pixels = index
+    if len(pids) == 0:
+        return []
+    bounds = getParcelBounds(np.asarray(offsets), np.asarray(pixels), dims[2])
+
+    w0x, w0y = window[0], window[1]
+    br0 = w0y // block
+    bc0 = w0x // block
+    nbrows = (w0y + dims[1] - 1) // block - br0 + 1
+    nbcols = (w0x + dims[2] - 1) // block - bc0 + 1
+    labels = blockClusters(getBlockOccupancy(bounds, w0y, w0x, block,
+                                             nbrows, nbcols))
+
+    # Block bounds (rmin, rmax, cmin, cmax) of every cluster
+    boxes = {}
+    for r, c in zip(*np.nonzero(labels >= 0)):
+        b = boxes.setdefault(labels[r, c], [r, r, c, c])
+        boxes[labels[r, c]] = [min(b[0], r), max(b[1], r),
+                               min(b[2], c), max(b[3], c)]
+
+    # Merge overlapping boxes until none overlap
+    merged = {k: k for k in boxes}
+    boxes = list(boxes.items())
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i][1], boxes[j][1]
+                if a[0] <= b[1] and b[0] <= a[1] and a[2] <= b[3] and b[2] <= a[3]:
+                    for k, v in merged.items():
+                        if v == boxes[j][0]:
+                            merged[k] = boxes[i][0]
+                    boxes[i] = (boxes[i][0], [min(a[0], b[0]), max(a[1], b[1]),
+                                              min(a[2], b[2]), max(a[3], b[3])])
+                    del boxes[j]
+                    changed = True
+                    break
+            if changed:
+                break
+
+    # Every parcel goes to the cluster of its first block, which holds all
+    # its blocks
+    first = labels[(w0y + bounds[:, 0]) // block - br0,
+                   (w0x + bounds[:, 2]) // block - bc0]
+    first = np.array([merged[f] for f in first])
+
+    plan = []
+    for k, b in boxes:
+        sel = np.flatnonzero(first == k)
+        # Block bounds back to window pixels
+        row0 = max(0, (br0 + b[0]) * block - w0y)
+        row1 = min(dims[1], (br0 + b[1] + 1) * block - w0y)
+        col0 = max(0, (bc0 + b[2]) * block - w0x)
+        col1 = min(dims[2], (bc0 + b[3] + 1) * block - w0x)
+        if height:
+            plan += strips(bounds, sel, row0, row1, col0, col1, height)
+        else:
+            plan.append((row0, col0, row1 - row0, col1 - col0, sel))
+    return plan
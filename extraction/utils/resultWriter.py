@@ -0,0 +1,236 @@
+# resultWriter - stream extraction results into PostgreSQL with binary COPY
+#
+# Rows are encoded straight from numpy arrays into the PostgreSQL binary COPY
+# format (big-endian, length-prefixed fields) using a structured dtype per
+# block, so no text formatting or per-row tuples are needed. Blocks are
+# buffered and copied to the table once flush_size rows are pending. The rows
+# of an image are only counted by close, as a failed copy is rolled back and
+# stops the writer. Rows committed before the failure stay in the table, like
+# those of an image that stopped in progress.
+import io
+import struct
+
+import numpy as np
+import psycopg2
+
+from . import imageTimings
+
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+COPY_TRAILER = struct.pack('>h', -1)
+
+# Fixed size column types and their big-endian numpy types
+FIXED_TYPES = {
+    'smallint': '>i2',
+    'integer': '>i4',
+    'bigint': '>i8',
+    'real': '>f4',
+    'double precision': '>f8',
+}
+
+# Element types of supported array columns (numpy type, element type oid)
+ARRAY_TYPES = {
+    'smallint[]': ('>i2', 21),
+    'integer[]': ('>i4', 23),
+    'bigint[]': ('>i8', 20),
+}
+
+
+def columnTypes(conn, table):
+    # Column name to PostgreSQL type, as format_type reports it
+    with conn.cursor() as curs:
+        curs.execute("""SELECT attname, format_type(atttypid, atttypmod)
+            FROM pg_attribute WHERE attrelid = %s::regclass
+            AND attnum > 0 AND NOT attisdropped""", (table,))
+        return dict(curs.fetchall())
+
+
+def textType(pgtype):
+    return pgtype in ['text', 'json', 'jsonb'] or \
+        pgtype.startswith('character')
+
+
+class BinaryCopyWriter:
+
+    def __init__(self, conn, table, columns, flush_size=100000):
+        self.conn = conn
+        self.table = table
+        self.columns = list(columns)
+        self.flush_size = flush_size
+        self.blocks = []
+        self.pending = 0
+        self.rows = 0
+        self.failed = False
+
+        types = columnTypes(conn, table)
+        self.types = {}
+        for c in self.columns:
+            pgtype = types.get(c)
+            if pgtype is None:
+                raise ValueError(f"Column {c} not in {table}")
+            if pgtype not in FIXED_TYPES and pgtype not in ARRAY_TYPES \
+                    and not textType(pgtype):
+                raise ValueError(f"Column {c} of {table} has unsupported type {pgtype}")
+            self.types[c] = pgtype
+
+        self.query = f"COPY {table} ({', '.join(self.columns)}) FROM STDIN WITH (FORMAT binary)"
+
+    def textValue(self, c, v):
+        if isinstance(v, str):
+            v = v.encode()
+        # jsonb is sent with its format version in front
+        if self.types[c] == 'jsonb':
+            v = b'\x01' + v
+        return v
+
+    def encodeBlock(self, values, n):
+        # Encode n rows with a structured dtype. Text columns must be
+        # constant for the block, arrays have a fixed number of elements.
+        fields = [('nfields', '>i2')]
+        for c in self.columns:
+            pgtype = self.types[c]
+            fields.append((f"{c}_len", '>i4'))
+            if pgtype in FIXED_TYPES:
+                fields.append((c, FIXED_TYPES[pgtype]))
+            elif pgtype in ARRAY_TYPES:
+                etype = ARRAY_TYPES[pgtype][0]
+                fields.append((f"{c}_hdr", '>i4', (5,)))
+                fields.append((c, [('len', '>i4'), ('val', etype)],
+                               (values[c].shape[1],)))
+            else:
+                fields.append((c, f"S{len(values[c])}"))
+
+        block = np.empty(n, dtype=fields)
+        block['nfields'] = len(self.columns)
+        for c in self.columns:
+            pgtype = self.types[c]
+            if pgtype in FIXED_TYPES:
+                block[f"{c}_len"] = np.dtype(FIXED_TYPES[pgtype]).itemsize
+                block[c] = values[c]
+            elif pgtype in ARRAY_TYPES:
+                etype, oid = ARRAY_TYPES[pgtype]
+                nelem = values[c].shape[1]
+                esize = np.dtype(etype).itemsize
+                block[f"{c}_len"] = 20 + nelem * (4 + esize)
+                # ndim, has nulls, element type, dimension, lower bound
+                block[f"{c}_hdr"] = [1, 0, oid, nelem, 1]
+                block[c]['len'] = esize
+                block[c]['val'] = values[c]
+            else:
+                block[f"{c}_len"] = len(values[c])
+                block[c] = values[c]
+        return block.tobytes()
+
+    def encodeRows(self, values, n):
+        # Slow path for text values that vary per row
+        buf = io.BytesIO()
+        for i in range(n):
+            buf.write(struct.pack('>h', len(self.columns)))
+            for c in self.columns:
+                pgtype = self.types[c]
+                v = values[c]
+                if pgtype in FIXED_TYPES:
+                    v = np.asarray(v[i] if np.ndim(v) else v,
+                                   dtype=FIXED_TYPES[pgtype]).tobytes()
+                elif pgtype in ARRAY_TYPES:
+                    etype, oid = ARRAY_TYPES[pgtype]
+                    row = np.asarray(v[i], dtype=etype)
+                    elems = np.empty(len(row), dtype=[('len', '>i4'), ('val', etype)])
+                    elems['len'] = row.dtype.itemsize
+                    elems['val'] = row
+                    v = struct.pack('>iiiii', 1, 0, oid, len(row), 1) + elems.tobytes()
+                elif isinstance(v, bytes):
+                    # Constant, already encoded by write
+                    pass
+                else:
+                    v = self.textValue(c, v[i])
+                buf.write(struct.pack('>i', len(v)))
+                buf.write(v)
+        return buf.getvalue()
+
+    def write(self, values):
+        # values maps every column to an array of rows or a scalar that is
+        # the same for all rows. Returns the number of rows buffered.
+        n = max([len(v) for v in values.values()
+                 if not isinstance(v, (str, bytes)) and np.ndim(v) > 0])
+        if n == 0:
+            return 0
+
+        values = dict(values)
+        variable = False
+        for c in self.columns:
+            if textType(self.types[c]):
+                if isinstance(values[c], (str, bytes)):
+                    values[c] = self.textValue(c, values[c])
+                else:
+                    variable = True
+
+        with imageTimings.span('write'):
+            if variable:
+                self.blocks.append(self.encodeRows(values, n))
+            else:
+                self.blocks.append(self.encodeBlock(values, n))
+        self.pending += n
+
+        if self.pending >= self.flush_size:
+            self.flush()
+        return n
+
+    def flush(self):
+        # Copy the pending rows and commit. Returns the rows copied. After a
+        # failed copy nothing more is copied, so that an image marked as
+        # failed gets no rows after the failure.
+        if self.failed:
+            self.blocks = []
+            self.pending = 0
+        if self.pending == 0:
+            return 0
+
+        buf = io.BytesIO(b''.join([COPY_HEADER] + self.blocks + [COPY_TRAILER]))
+        pending = self.pending
+        self.blocks = []
+        self.pending = 0
+
+        outcurs = self.conn.cursor()
+        try:
+            with imageTimings.span('write'):
+                outcurs.copy_expert(self.query, buf)
+                self.conn.commit()
+            self.rows += pending
+            imageTimings.count('rows', pending)
+            imageTimings.count('copy_bytes', len(buf.getvalue()))
+            return pending
+        except psycopg2.IntegrityError as e:
+            print("IntegrityError", e)
+        except psycopg2.DatabaseError as e:
+            print("DatabaseError", e)
+        finally:
+            outcurs.close()
+        self.conn.rollback()
+        self.failed = True
+        return 0
+
+    def close(self):
+        # The rows copied, None if any copy failed
+        self.flush()
+        if self.failed:
+            return None
+        return self.rows
+
+
+def openWriter(config, outconn, table, columns, partition=None, keys=()):
+    # The writer of the configured output: binary COPY into table, or with
+    # "output": "parquet" Parquet files under output_dir, partitioned by the
+    # AOI, the partition values and the scalar columns keys (see
+    # columnarWriter). Raises ValueError if the writer cannot be set up.
+    extraction = config.get('extraction', {})
+    flush_size = extraction.get('flush_size', 100000)
+    if extraction.get('output', 'postgres') == 'parquet':
+        try:
+            from . import columnarWriter
+        except ImportError as e:
+            raise ValueError(f"Parquet output needs pyarrow: {e}")
+        return columnarWriter.ParquetWriter(
+            extraction.get('output_dir', 'results'), table, columns,
+            dict(aoi=config['database']['args']['name'], **(partition or {})),
+            keys, flush_size)
+    return BinaryCopyWriter(outconn, table, columns, flush_size)
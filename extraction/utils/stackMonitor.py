@@ -0,0 +1,128 @@
+# stackMonitor - follow the extraction of a stack through status change
+# notifications instead of polling counts
+#
+# A trigger on the catalogue table notifies every status change on the
+# dias_catalogue_status channel. The orchestrator counts the ingested and in
+# progress images of the stack once, keeps the counts up to date from the
+# notifications and returns as soon as both are zero. Counts are checked
+# against the database when they reach zero and every recount seconds, which
+# covers images of other AOIs with the same card and missed notifications.
+# With a workerMetrics.SwarmMetrics, the metrics of the replicas are merged
+# with the queue counts every metrics interval and reported with the counts.
+#
+# Images left in progress by crashed workers must not hold up the stack for
+# ever, but the last images of a stack can take long. The images in progress
+# are given up after stuck seconds without any status change, which must be
+# well above the time of the longest image. With replica metrics, they are
+# given up sooner, once no live replica has reported an image in progress
+# for recount seconds.
+import json
+import select
+import time
+
+CHANNEL = 'dias_catalogue_status'
+
+
+def installTrigger(conn, catalog_table):
+    # (Re)create the status change trigger, needs the table owner
+    triggerSql = f"""CREATE OR REPLACE FUNCTION dias_catalogue_status_notify()
+        RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{CHANNEL}', json_build_object('id', NEW.id,
+                'card', NEW.card, 'old', OLD.status, 'new', NEW.status)::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS dias_catalogue_status_notify ON {catalog_table};
+        CREATE TRIGGER dias_catalogue_status_notify
+            AFTER UPDATE OF status ON {catalog_table} FOR EACH ROW
+            WHEN (OLD.status IS DISTINCT FROM NEW.status)
+            EXECUTE PROCEDURE dias_catalogue_status_notify();"""
+    with conn.cursor() as curs:
+        curs.execute(triggerSql)
+    conn.commit()
+
+
+def queueCounts(curs, countSql):
+    # countSql returns the number of ingested and in progress images
+    curs.execute(countSql)
+    ingested, inprogress = curs.fetchone()
+    return ingested, inprogress
+
+
+def waitForStack(conn, countSql, card, recount=300, report=60, metrics=None,
+                 stuck=3600):
+    # Block until no image of the stack is ingested or in progress, or the
+    # images in progress are orphaned (see above). Returns the number of
+    # images finished while waiting.
+    autocommit = conn.autocommit
+    # Notifications are only delivered outside transactions
+    conn.commit()
+    conn.autocommit = True
+    curs = conn.cursor()
+    curs.execute(f"LISTEN {CHANNEL}")
+
+    ingested, inprogress = queueCounts(curs, countSql)
+    print(f"{ingested} entries to be processed, {inprogress} in progress")
+
+    t0 = time.time()
+    lastchange = lastcount = lastreport = lastheld = t0
+    done = 0
+    wait = min(report, metrics.interval) if metrics else report
+    files = {}
+    lastmetrics = 0
+    while ingested > 0 or inprogress > 0:
+        if select.select([conn], [], [], wait)[0]:
+            conn.poll()
+        for n in conn.notifies:
+            change = json.loads(n.payload)
+            if change['card'] != card:
+                continue
+            if change['old'] == 'ingested':
+                ingested -= 1
+            elif change['old'] == 'inprogress':
+                inprogress -= 1
+                if change['new'] != 'ingested':
+                    done += 1
+            if change['new'] == 'ingested':
+                ingested += 1
+            elif change['new'] == 'inprogress':
+                inprogress += 1
+            lastchange = time.time()
+        conn.notifies.clear()
+
+        now = time.time()
+        if (ingested <= 0 and inprogress <= 0) or now - lastcount > recount:
+            ingested, inprogress = queueCounts(curs, countSql)
+            lastcount = now
+        if metrics and now - lastmetrics >= metrics.interval:
+            files = metrics.update(card, max(0, ingested), max(0, inprogress))
+            lastmetrics = now
+        if ingested == 0 and inprogress > 0:
+            orphaned = now - lastchange > stuck
+            held = metrics.inProgress(files) if metrics else None
+            if held is not None:
+                # Replicas write their metrics every interval, so images
+                # no replica reported for recount seconds have no worker
+                if held:
+                    lastheld = now
+                elif now - max(lastchange, lastheld) > recount:
+                    orphaned = True
+            if orphaned:
+                print(f"{inprogress} entries stuck in progress, not waiting for them")
+                break
+        if now - lastreport >= report:
+            print(f"{done} entries processed ({60 * done / (now - t0):.1f} per minute),",
+                  f"{inprogress} in progress, {ingested} to be processed")
+            if metrics:
+                metrics.report(files)
+            lastreport = now
+
+    if metrics:
+        metrics.report(metrics.update(card, max(0, ingested),
+                                      max(0, inprogress)))
+    curs.execute(f"UNLISTEN {CHANNEL}")
+    curs.close()
+    conn.autocommit = autocommit
+    print(f"{done} entries processed in {(time.time() - t0) / 60:.1f} minutes")
+    return done
@@ -1,34 +1,28 @@
 # updateImageStatus - update image status
 #
-import json
-import psycopg2
+from . import dbSession, imageTimings
 
 
-def updateImageStatus(oid, new_status, current_status):
-    # Spatial database details
-    with open('db_config.json', 'r') as f:
-        dbconfig = json.load(f)['database']
-    dbconn = dbconfig['connection']
-
-    conn_str = f"host={dbconn['host']} dbname={dbconn['dbname']}\
-        user={dbconn['dbuser']} port={dbconn['port']}\
-        password={dbconn['dbpasswd']}"
-
-    conn = psycopg2.connect(conn_str)
-    if not conn:
-        print("No connection established")
-        return(None)
+def updateImageStatus(oid, new_status, current_status, session=None):
+    # session is the dbSession of the caller, if None one is set up for
+    # this update only
+    if session is None:
+        session = dbSession.DbSession()
+    dbconfig = session.dbconfig
 
     updateSql = f"""UPDATE {dbconfig['tables']['catalog_table']}
         SET status='{new_status}'
         WHERE id = {oid} And status = '{current_status}'"""
-    with conn.cursor() as update_cur:
-        update_cur.execute(updateSql)
-        conn.commit()
-        if update_cur.rowcount == 1:
-            print(f"Record for {oid} updated to {new_status} from {current_status}")
-            conn.close()
-            return True
+    with session.connection('write') as conn:
+        if not conn:
+            print("No connection established")
+            return(None)
 
-    conn.close()
+        with conn.cursor() as update_cur, imageTimings.span('status'):
+            update_cur.execute(updateSql)
+            conn.commit()
+            if update_cur.rowcount == 1:
+                print(f"Record for {oid} updated to {new_status} from {current_status}")
+                imageTimings.imageStatus(oid, new_status)
+                return True
     return False
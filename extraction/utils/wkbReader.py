@@ -1,41 +1,115 @@
 import struct
 import numpy as np
 
+# See http://trac.osgeo.org/postgis/browser/trunk/raster/doc/RFC2-WellKnownBinaryFormat
+
+# Header after the endianness byte: version, nbands, scaleX, scaleY, ipX, ipY,
+# skewX, skewY, srid, width, height. 61 bytes including the endianness byte.
+HEADER_FIELDS = ['version', 'nbands', 'scaleX', 'scaleY', 'ipX', 'ipY',
+                 'skewX', 'skewY', 'srid', 'width', 'height']
+HEADER = {0: struct.Struct('>HHddddddiHH'), 1: struct.Struct('<HHddddddiHH')}
+HEADER_SIZE = 61
+
+# PostGIS pixel types (low nibble of the band header byte) and their numpy
+# types. Sub-byte types are stored as one byte per pixel in WKB.
+PIXTYPES = {0: 'u1', 1: 'u1', 2: 'u1', 3: 'i1', 4: 'u1', 5: 'i2', 6: 'u2',
+            7: 'i4', 8: 'u4', 10: 'f4', 11: 'f8'}
+
+# Flags in the high nibble of the band header byte
+IS_OFFLINE = 0x80
+HAS_NODATA = 0x40
+IS_NODATA = 0x20
+
+
 # Function to decypher the WKB header
 def wkbHeader(raw):
-    # See http://trac.osgeo.org/postgis/browser/trunk/raster/doc/RFC2-WellKnownBinaryFormat
-
-    header = {}
-
-    header['endianess'] = struct.unpack('B', raw[0])[0]
-    header['version'] = struct.unpack('H', raw[1:3])[0]
-    header['nbands'] = struct.unpack('H', raw[3:5])[0]
-    header['scaleX'] = struct.unpack('d', raw[5:13])[0]
-    header['scaleY'] = struct.unpack('d', raw[13:21])[0]
-    header['ipX'] = struct.unpack('d', raw[21:29])[0]
-    header['ipY'] = struct.unpack('d', raw[29:37])[0]
-    header['skewX'] = struct.unpack('d', raw[37:45])[0]
-    header['skewY'] = struct.unpack('d', raw[45:53])[0]
-    header['srid'] = struct.unpack('i', raw[53:57])[0]
-    header['width'] = struct.unpack('H', raw[57:59])[0]
-    header['height'] = struct.unpack('H', raw[59:61])[0]
-
+    endianess = raw[0]
+    header = dict(zip(HEADER_FIELDS, HEADER[endianess].unpack_from(raw, 1)))
+    header['endianess'] = endianess
     return header
 
-# Function to decypher the WKB raster data
+
+def bandType(raw, h, offset):
+    # numpy dtype with the raster byte order for the band at offset
+    pixtype = raw[offset] & 0x0F
+    if pixtype not in PIXTYPES:
+        raise ValueError(f"Unknown WKB raster pixel type {pixtype}")
+    return np.dtype(PIXTYPES[pixtype]).newbyteorder(
+        '>' if h['endianess'] == 0 else '<')
+
+
+# Function to decypher a single WKB raster band, returns the pixel values as
+# a (height, width) view on raw, the nodata value (None if not set) and the
+# offset of the next band
+def wkbBand(raw, h, offset):
+    flags = raw[offset]
+    if flags & IS_OFFLINE:
+        raise ValueError("Out-db WKB raster bands are not supported")
+    dtype = bandType(raw, h, offset)
+    nodata = np.frombuffer(raw, dtype=dtype, count=1, offset=offset + 1)[0]
+    offset += 1 + dtype.itemsize
+    band = np.frombuffer(raw, dtype=dtype, count=h['width'] * h['height'],
+                         offset=offset).reshape((h['height'], h['width']))
+    offset += dtype.itemsize * h['width'] * h['height']
+    return band, (nodata if flags & HAS_NODATA else None), offset
+
+
+# Function to decypher the WKB raster data, bands are views on raw
 def wkbImage(raw):
     h = wkbHeader(raw)
     img = [] # array to store image bands
-    offset = 61 # header raw length in bytes
+    offset = HEADER_SIZE
     for i in range(h['nbands']):
-        # Determine pixtype for this band
-        pixtype = struct.unpack('B', raw[offset])[0]>>4
-        # For now, we only handle unsigned byte
-        if pixtype == 4:
-            band = np.frombuffer(raw, dtype='uint8', count=h['width']*h['height'], offset=offset+1)
-            img.append((np.reshape(band, ((h['height'], h['width'])))))
-            offset = offset + 2 + h['width']*h['height']
-        # to do: handle other data types
+        band, nodata, offset = wkbBand(raw, h, offset)
+        img.append(band)
 
     return h['ipX'], h['ipY'], img
 
+
+# Function to decypher one band of all WKB rasters in a rowset of
+# (pid, wkb) into one contiguous buffer. Returns pids, upper left corners,
+# widths, heights, offsets into the buffer (one more than rows) and the
+# buffer. All rasters must have the same pixel type for this band.
+def wkbBatch(rowset, band=0):
+    n = len(rowset)
+    pids = np.empty(n, dtype=np.int64)
+    ipx = np.empty(n, dtype=np.float64)
+    ipy = np.empty(n, dtype=np.float64)
+    widths = np.empty(n, dtype=np.int64)
+    heights = np.empty(n, dtype=np.int64)
+    starts = np.empty(n, dtype=np.int64)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+
+    dtype = None
+    for i, r in enumerate(rowset):
+        raw = r[1]
+        h = wkbHeader(raw)
+        if band >= h['nbands']:
+            raise ValueError(f"WKB raster for {r[0]} has no band {band}")
+        # Walk to the requested band
+        offset = HEADER_SIZE
+        for b in range(band):
+            offset += 1 + bandType(raw, h, offset).itemsize * \
+                (1 + h['width'] * h['height'])
+        btype = bandType(raw, h, offset)
+        if dtype is None:
+            dtype = btype
+        elif btype != dtype:
+            raise ValueError(f"WKB raster for {r[0]} is {btype}, not {dtype}")
+        pids[i] = r[0]
+        ipx[i] = h['ipX']
+        ipy[i] = h['ipY']
+        widths[i] = h['width']
+        heights[i] = h['height']
+        starts[i] = offset + 1 + btype.itemsize
+        offsets[i + 1] = offsets[i] + h['width'] * h['height']
+
+    # The buffer is in native byte order, converting where needed
+    buf = np.empty(offsets[-1], dtype=dtype.newbyteorder('=')
+                   if dtype is not None else 'u1')
+    for i, r in enumerate(rowset):
+        buf[offsets[i]:offsets[i + 1]] = np.frombuffer(
+            r[1], dtype=dtype, count=offsets[i + 1] - offsets[i],
+            offset=starts[i])
+
+    return pids, ipx, ipy, widths, heights, offsets, buf
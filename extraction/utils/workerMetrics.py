@@ -0,0 +1,381 @@
+# workerMetrics - live metrics of the extraction workers in the Prometheus
+# text format
+#
+# A worker adds the timing record of every finished image (utils/imageTimings)
+# to counters and histograms: images by status, parcels, result rows, bytes
+# read and fetched, and seconds per stage. Every metrics_interval seconds it
+# writes them, with the time the images in progress have spent so far and
+# the stage they are in, to metrics_dir/workers/<host>_<pid>.prom, and with
+# metrics_port it serves them at http://<worker>:<port>/metrics.
+#
+# The orchestrator (SwarmMetrics, updated by stackMonitor.waitForStack)
+# merges the files of all replicas with the queue counts of the stack into
+# metrics_dir/extraction.prom, for the node_exporter textfile collector or
+# a scrape of metrics_port on the orchestrator host. With every progress
+# report it prints the throughput of each replica and the images that have
+# been in one stage for more than metrics_stall seconds (mount stalls).
+import glob
+import os
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import imageTimings
+
+# Upper bounds of the stage and image seconds histograms
+BUCKETS = [0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800]
+
+# Counters of the timing records as (count, metric, help)
+COUNTERS = [
+    ('parcels', 'extraction_parcels_total', 'Parcels extracted'),
+    ('rows', 'extraction_rows_total', 'Result rows written'),
+    ('read_bytes', 'extraction_read_bytes_total', 'Image bytes read, decoded'),
+    ('parcel_bytes', 'extraction_parcel_bytes_total',
+     'Parcel raster WKB bytes fetched'),
+    ('copy_bytes', 'extraction_copy_bytes_total',
+     'Result bytes copied to the database'),
+]
+
+SAMPLE = re.compile(r'^(\w+)(\{.*\})? (\S+)$')
+LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+worker = None
+
+
+def labelText(labels):
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+
+
+def family(name, kind, text):
+    return [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.n = 0
+
+    def observe(self, v):
+        for i, b in enumerate(BUCKETS):
+            if v <= b:
+                self.counts[i] += 1
+        self.sum += v
+        self.n += 1
+
+    def lines(self, name, labels):
+        lines = [f"{name}_bucket{labelText(dict(labels, le=str(b)))} {c}"
+                 for b, c in zip(BUCKETS, self.counts)]
+        return lines + [
+            f"{name}_bucket{labelText(dict(labels, le='+Inf'))} {self.n}",
+            f"{name}_sum{labelText(labels)} {self.sum:.4f}",
+            f"{name}_count{labelText(labels)} {self.n}"]
+
+
+class WorkerMetrics:
+
+    def __init__(self, card, session):
+        self.card = card
+        self.labels = {'worker': f"{socket.gethostname()}:{os.getpid()}",
+                       'card': card}
+        self.path = None
+        metricsdir = session.extraction('metrics_dir')
+        if metricsdir:
+            os.makedirs(os.path.join(metricsdir, 'workers'), exist_ok=True)
+            self.path = os.path.join(
+                metricsdir, 'workers',
+                f"{socket.gethostname()}_{os.getpid()}.prom")
+        self.interval = session.extraction('metrics_interval', 10)
+        self.lock = threading.Lock()
+        self.images = {}
+        self.counts = dict.fromkeys([c[0] for c in COUNTERS], 0)
+        self.stages = {s: Histogram()
+                       for s in imageTimings.STAGES + ['other']}
+        self.seconds = Histogram()
+        self.peak = 0.0
+        self.last = 0.0
+        self.stopping = threading.Event()
+        self.server = None
+
+    def observe(self, record):
+        # Add the timing record of a finished image
+        with self.lock:
+            status = record['status'] or 'unknown'
+            self.images[status] = self.images.get(status, 0) + 1
+            for key in self.counts:
+                self.counts[key] += record['counts'].get(key, 0)
+            for stage, seconds in record['stages'].items():
+                self.stages[stage].observe(seconds)
+            self.seconds.observe(record['total_s'])
+            self.peak = record['peak_rss_mb']
+            self.last = time.time()
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines += family('extraction_images_total', 'counter',
+                            'Images finished, by final status')
+            for status, n in sorted(self.images.items()):
+                lines.append(f"extraction_images_total"
+                             f"{labelText(dict(self.labels, status=status))} {n}")
+            for key, name, text in COUNTERS:
+                lines += family(name, 'counter', text)
+                lines.append(f"{name}{labelText(self.labels)} {self.counts[key]}")
+            lines += family('extraction_stage_seconds', 'histogram',
+                            'Seconds per image spent in a stage')
+            for stage, h in self.stages.items():
+                if h.sum > 0:
+                    lines += h.lines('extraction_stage_seconds',
+                                     dict(self.labels, stage=stage))
+            lines += family('extraction_image_seconds', 'histogram',
+                            'Seconds per image, claim to cleanup')
+            lines += self.seconds.lines('extraction_image_seconds',
+                                        self.labels)
+            lines += family('extraction_peak_rss_bytes', 'gauge',
+                            'Peak resident set during the last image')
+            lines.append(f"extraction_peak_rss_bytes{labelText(self.labels)}"
+                         f" {int(self.peak * 2**20)}")
+            lines += family('extraction_last_image_timestamp_seconds',
+                            'gauge', 'Time the last image finished')
+            lines.append(f"extraction_last_image_timestamp_seconds"
+                         f"{labelText(self.labels)} {self.last:.0f}")
+
+        # Images in progress, with the stage they are in now
+        lines += family('extraction_inprogress_seconds', 'gauge',
+                        'Seconds since the claim of an image in progress')
+        lines += family('extraction_inprogress_stage_seconds', 'gauge',
+                        'Seconds an image in progress is in its stage')
+        now = time.perf_counter()
+        for obsid, stage, seconds, inStage in imageTimings.inProgress(now):
+            labels = dict(self.labels, obsid=obsid, stage=stage)
+            lines.append(f"extraction_inprogress_seconds{labelText(labels)}"
+                         f" {seconds:.1f}")
+            lines.append(f"extraction_inprogress_stage_seconds"
+                         f"{labelText(labels)} {inStage:.1f}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        # Replace the textfile at once, so that readers never see half of it
+        if self.path:
+            tmp = f"{self.path}.tmp"
+            with open(tmp, 'w') as f:
+                f.write(self.render())
+            os.replace(tmp, self.path)
+
+    def export(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                print(e)
+
+
+def serve(port, render):
+    # render() on GET /metrics in a daemon thread, None if port is taken
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = ThreadingHTTPServer(('', port), Handler)
+    except OSError as e:
+        print(f"Metrics not served on port {port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start(card, session):
+    # Collect and export the metrics of this worker, if metrics_dir or
+    # metrics_port is set
+    global worker
+    if not session.extraction('metrics_dir') and \
+            not session.extraction('metrics_port'):
+        return None
+    worker = WorkerMetrics(card, session)
+    imageTimings.observers.append(worker.observe)
+    threading.Thread(target=worker.export, daemon=True).start()
+    if session.extraction('metrics_port'):
+        worker.server = serve(session.extraction('metrics_port'),
+                              worker.render)
+    return worker
+
+
+def stop():
+    # Remove the textfile of this worker, which would otherwise be merged
+    # as a live replica
+    global worker
+    if worker is None:
+        return
+    worker.stopping.set()
+    imageTimings.observers.remove(worker.observe)
+    if worker.server is not None:
+        worker.server.shutdown()
+    if worker.path:
+        try:
+            os.remove(worker.path)
+        except OSError:
+            pass
+    worker = None
+
+
+def readSamples(path):
+    # The families of a textfile as {name: (header lines, samples)}, with
+    # samples as (name, labels, value)
+    families = {}
+    current = None
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('# HELP'):
+                current = line.split()[2]
+                families.setdefault(current, ([], []))[0].append(line)
+            elif line.startswith('# TYPE'):
+                families[current][0].append(line)
+            elif line and current is not None:
+                m = SAMPLE.match(line)
+                if m:
+                    families[current][1].append(
+                        (m.group(1), dict(LABEL.findall(m.group(2) or '')),
+                         float(m.group(3))))
+    return families
+
+
+class SwarmMetrics:
+    # The metrics of all replicas of a stack, merged by the orchestrator
+
+    def __init__(self, config):
+        extraction = config.get('extraction', {})
+        # Without metrics_dir the replicas write no textfiles
+        self.exported = bool(extraction.get('metrics_dir'))
+        self.dir = extraction.get('metrics_dir') or 'metrics'
+        self.interval = extraction.get('metrics_interval', 10)
+        self.stall = extraction.get('metrics_stall', 300)
+        # Textfiles of replicas that died without removing them
+        self.keep = extraction.get('metrics_keep', 3600)
+        if self.exported:
+            os.makedirs(os.path.join(self.dir, 'workers'), exist_ok=True)
+        self.text = ''
+        self.previous = {}
+        self.reported = time.time()
+        self.server = None
+        if extraction.get('metrics_port'):
+            self.server = serve(extraction['metrics_port'], lambda: self.text)
+
+    def reset(self):
+        # Forget the replicas of the previous stack
+        if not self.exported:
+            return
+        for path in glob.glob(os.path.join(self.dir, 'workers', '*.prom')):
+            os.remove(path)
+        self.previous = {}
+
+    def workerFiles(self):
+        # Textfiles of the replicas with their age in seconds
+        files = {}
+        if not self.exported:
+            return files
+        now = time.time()
+        for path in glob.glob(os.path.join(self.dir, 'workers', '*.prom')):
+            try:
+                age = now - os.path.getmtime(path)
+                if age > self.keep:
+                    os.remove(path)
+                    self.previous.pop(path, None)
+                    continue
+                files[path] = (age, readSamples(path))
+            except (OSError, ValueError):
+                pass
+        return files
+
+    def inProgress(self, files):
+        # Obsids of the images in progress on replicas that wrote metrics
+        # recently, None if the replicas do not write metrics
+        if not self.exported:
+            return None
+        held = set()
+        for age, families in files.values():
+            if age < 3 * self.interval:
+                for n, labels, v in families.get(
+                        'extraction_inprogress_seconds', ([], []))[1]:
+                    held.add(labels['obsid'])
+        return held
+
+    def update(self, card, ingested, inprogress):
+        # Merge the textfiles of the replicas and the queue counts into
+        # the stack textfile. Returns the textfiles read.
+        files = self.workerFiles()
+        merged = {}
+        for age, families in files.values():
+            for name, (headers, samples) in families.items():
+                merged.setdefault(name, (headers, []))[1].extend(samples)
+
+        lines = family('extraction_queue_images', 'gauge',
+                       'Images of the stack waiting or in progress')
+        lines.append(f'extraction_queue_images{{card="{card}",status="ingested"}} {ingested}')
+        lines.append(f'extraction_queue_images{{card="{card}",status="inprogress"}} {inprogress}')
+        lines += family('extraction_workers', 'gauge',
+                        'Replicas that wrote metrics recently')
+        live = sum(1 for age, families in files.values()
+                   if age < 3 * self.interval)
+        lines.append(f'extraction_workers{{card="{card}"}} {live}')
+        for name, (headers, samples) in merged.items():
+            lines += headers
+            lines += [f"{n}{labelText(labels)} {v:g}"
+                      for n, labels, v in samples]
+        self.text = '\n'.join(lines) + '\n'
+        if not self.exported:
+            return files
+
+        path = os.path.join(self.dir, 'extraction.prom')
+        with open(f"{path}.tmp", 'w') as f:
+            f.write(self.text)
+        os.replace(f"{path}.tmp", path)
+        return files
+
+    def report(self, files):
+        # Throughput of every replica since the last report, and images
+        # stuck in a stage or replicas gone quiet
+        now = time.time()
+        dt = now - self.reported
+        self.reported = now
+        for path, (age, families) in sorted(files.items()):
+            totals = {}
+            stuck = []
+            for name, (headers, samples) in families.items():
+                for n, labels, v in samples:
+                    if n == 'extraction_inprogress_stage_seconds' and \
+                            v > self.stall:
+                        stuck.append(f"{labels['obsid']} in {labels['stage']} for {v:.0f} s")
+                    elif n.endswith('_total'):
+                        totals[n] = totals.get(n, 0) + v
+            before = self.previous.get(path, totals)
+            self.previous[path] = totals
+
+            def rate(name):
+                return (totals.get(name, 0) - before.get(name, 0)) / dt
+
+            name = os.path.basename(path)[:-len('.prom')]
+            print(f"{name}: {60 * rate('extraction_images_total'):.1f} images/min,",
+                  f"{rate('extraction_parcels_total'):.0f} parcels/s,",
+                  f"{rate('extraction_rows_total'):.0f} rows/s,",
+                  f"{rate('extraction_read_bytes_total') / 2**20:.1f} MB/s read")
+            if age > 3 * self.interval:
+                print(f"{name}: no metrics for {age:.0f} s")
+            for s in stuck:
+                print(f"{name}: image {s}")
@@ -0,0 +1,21 @@
+# warmupKernels - compile the numba kernels for all their signatures into the
+# numba cache (utils/__pycache__), so that extraction workers load them from
+# disk instead of compiling them at start up.
+#
+# The code is mounted into the containers, so this runs in the image on the
+# mounted code, once after every code update (see pow_extract_*.py):
+#
+#   python warmupKernels.py
+import time
+
+from utils import indexedNumbaWindowedRasterStats, indexedNumbaHistogram, multiProductExtraction, readPlan, parcelStore
+
+t0 = time.time()
+for module in [indexedNumbaWindowedRasterStats, indexedNumbaHistogram, multiProductExtraction, readPlan, parcelStore]:
+    for kernel, signatures in module.SIGNATURES:
+        t1 = time.time()
+        for sig in signatures:
+            kernel.compile(sig)
+        print(f"{module.__name__}.{kernel.__name__}: {len(signatures)} signatures in {time.time() - t1:.1f} s")
+
+print(f"Kernels compiled or loaded from cache in {time.time() - t0:.1f} s")